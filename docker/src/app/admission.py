@@ -0,0 +1,102 @@
+import ctypes
+import multiprocessing
+import time
+
+
+class DeadlineExceeded(Exception):
+    pass
+
+
+class AdmissionController:
+    """
+    Bounds the number of documents that all workers together are predicting or about to predict.
+
+    A request is admitted with the number of its documents, unless that would take the pending documents beyond
+    'max_pending_documents'. Rejected requests should be answered right away, so that clients back off instead of
+    waiting for a worker. A worker that predicts nothing always admits a request, since it would predict it right
+    away, so the bound is exceeded by at most one request per worker.
+    Only requests a worker started to handle are counted. The requests that wait to be accepted, or that a worker
+    accepted but has no thread for yet, are bounded by the listen backlog and the worker connections of the server.
+    The counts live in shared memory, one slot per gunicorn worker, so that the slot of a worker that died can be
+    cleared without losing track of the others. Create the controller, or call 'reset', in the gunicorn master
+    before the workers are forked.
+    """
+
+    def __init__(self, max_pending_documents=0, slots=1):
+        """
+        :param max_pending_documents: The bound of the pending documents. 0 admits every request
+        :param slots: The number of worker slots
+        """
+        self.max_pending_documents = max_pending_documents
+        self.slot = 0
+        self._pending = multiprocessing.Array(ctypes.c_long, slots)
+
+    def reset(self, slots):
+        self._pending = multiprocessing.Array(ctypes.c_long, slots)
+
+    def set_slot(self, slot):
+        """
+        Set the slot of the current worker
+        """
+        self.slot = slot % len(self._pending)
+
+    def clear_slot(self, slot):
+        """
+        Forget the documents of a worker that died while predicting them
+        """
+        with self._pending.get_lock():
+            self._pending[slot % len(self._pending)] = 0
+
+    def pending_documents(self):
+        with self._pending.get_lock():
+            return sum(self._pending[:])
+
+    def try_admit(self, n_documents):
+        """
+        :return: Whether the documents were admitted. If so, call 'release' once they are predicted
+        """
+        if not self.max_pending_documents:
+            return True
+        with self._pending.get_lock():
+            # a request is always admitted by an idle worker, no matter how large it is
+            if self._pending[self.slot] > 0 and \
+                    sum(self._pending[:]) + n_documents > self.max_pending_documents:
+                return False
+            self._pending[self.slot] += n_documents
+        return True
+
+    def release(self, n_documents):
+        if not self.max_pending_documents:
+            return
+        with self._pending.get_lock():
+            self._pending[self.slot] -= n_documents
+
+
+def get_deadline(headers, default_timeout=None):
+    """
+    The time by which the client needs the response, from the headers of its request:
+
+        X-Request-Deadline: the deadline as a unix timestamp in seconds. It covers the time the request waited
+                            for a worker, but requires the clocks of client and server to be in sync
+        X-Request-Timeout: the seconds the server has for the request, counted from now
+
+    :param headers: The headers of the request
+    :param default_timeout: The timeout of requests without a deadline, or None for no deadline
+    :return: The deadline as a unix timestamp, or None
+    :raise ValueError: If a header is not a number
+    """
+    if headers.get('X-Request-Deadline'):
+        return float(headers['X-Request-Deadline'])
+    if headers.get('X-Request-Timeout'):
+        return time.time() + float(headers['X-Request-Timeout'])
+    if default_timeout:
+        return time.time() + default_timeout
+    return None
+
+
+def check_deadline(deadline):
+    """
+    :raise DeadlineExceeded: If the deadline has passed
+    """
+    if deadline is not None and time.time() > deadline:
+        raise DeadlineExceeded(f"The deadline passed {time.time() - deadline:.3f}s ago")
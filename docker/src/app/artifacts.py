@@ -0,0 +1,237 @@
+import errno
+import hashlib
+import json
+import os
+import shutil
+import time
+import zipfile
+
+from urllib.parse import urlparse
+
+
+def sha256sum(path, block_size=1024 * 1024):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _read_text(path):
+    try:
+        with open(path) as f:
+            return f.read().strip()
+    except FileNotFoundError:
+        return None
+
+
+def _write_text(path, text):
+    # write and rename, so that an interrupted start never leaves a partial file
+    with open(path + ".tmp", "w") as f:
+        f.write(text)
+    os.replace(path + ".tmp", path)
+
+
+def _read_manifest(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def _file_stamp(path):
+    stat = os.stat(path)
+    return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+
+def _copy_from_source(source, model_name, destination):
+    """
+    Fetch the model archive from its source into 'destination'.
+
+    :param source: One of
+                   1. a Google Drive document id (the default source)
+                   2. a file:// URL or a local path to a zip archive
+                   3. a local directory holding the archive as <model_name>.zip, e.g. a mirror of the Google Drive
+    """
+    path = urlparse(source).path if source.startswith("file://") else source
+    if os.path.isdir(path):
+        path = os.path.join(path, model_name + ".zip")
+    if os.path.isfile(path):
+        shutil.copyfile(path, destination)
+    else:
+        import gdown
+        gdown.download('https://drive.google.com/uc?id=' + source, destination, quiet=False)
+        if not os.path.isfile(destination):
+            raise RuntimeError(f"Could not download the model {model_name} from {source}")
+
+
+class ModelArtifactCache:
+    """
+    Keeps the downloaded model archives and their extracted models under 'models_dir', across restarts.
+
+    The archive of a model is downloaded only if there is no verified copy of it yet. Its checksum, size,
+    modification time and source are recorded next to it in <model_name>.zip.manifest.json, so that it is hashed
+    again only if it was changed or replaced since, and fetched again if its source changed. Every archive is
+    extracted into a folder of its own, .versions/<model_name>/<version>, where the version is the start of its
+    checksum, and <model_name> is a symbolic link to the version in use. A new version is thus extracted next to the
+    one the workers are serving, and activated by swapping the link. Downloads and extractions go to temporary paths
+    first, so that an interrupted start is repeated from scratch.
+    """
+
+    # how many versions of a model are kept, including the active one
+    KEEP_VERSIONS = 2
+
+    def __init__(self, models_dir, logger=None):
+        self.models_dir = models_dir
+        self.logger = logger
+
+    def _log(self, message):
+        if self.logger:
+            self.logger.info(message)
+
+    def archive_path(self, model_name):
+        return os.path.join(self.models_dir, model_name + ".zip")
+
+    def model_dir(self, model_name):
+        return os.path.join(self.models_dir, model_name)
+
+    def version_dir(self, model_name, version):
+        return os.path.join(self.models_dir, ".versions", model_name, version)
+
+    def active_version(self, model_name):
+        """
+        :return: The version <model_name> links to, or None
+        """
+        model_dir = self.model_dir(model_name)
+        if not os.path.islink(model_dir):
+            return None
+        return os.path.basename(os.readlink(model_dir))
+
+    def ensure_model(self, model_name, source, sha256=None, activate=True, refresh=False):
+        """
+        Make sure the model is extracted under models_dir.
+
+        :param model_name: The name of the model
+        :param source: Where to fetch the model archive from, see _copy_from_source
+        :param sha256: The expected checksum of the archive. If given, an archive with a different checksum is
+                       downloaded again, and a download with a different checksum is an error
+        :param activate: Whether to link <model_name> to the extracted version right away. Otherwise call 'activate'
+                         once the version is to be used, see model_control.swap_model
+        :param refresh: Whether to fetch the archive again even if there is a verified copy of it
+        :return: A tuple (version, timings), where timings is a dict with the seconds spent in every phase:
+                 'download', 'verify' and 'extract'
+        """
+        timings = {"download": 0.0, "verify": 0.0, "extract": 0.0}
+        if not os.path.exists(self.models_dir):
+            try:
+                os.makedirs(self.models_dir)
+            except OSError as exc:  # Guard against race condition
+                if exc.errno != errno.EEXIST:
+                    raise
+
+        archive = self.archive_path(model_name)
+        manifest_path = archive + ".manifest.json"
+        checksum = None
+        start = time.perf_counter()
+        if os.path.isfile(archive) and not refresh:
+            checksum = self._verify_archive(model_name, archive, manifest_path, source, sha256)
+        timings["verify"] += time.perf_counter() - start
+
+        if checksum is None:
+            start = time.perf_counter()
+            self._log(f"Downloading {model_name} from {source}")
+            _copy_from_source(source, model_name, archive + ".part")
+            timings["download"] = time.perf_counter() - start
+
+            start = time.perf_counter()
+            checksum = sha256sum(archive + ".part")
+            if sha256 is not None and checksum != sha256:
+                os.remove(archive + ".part")
+                raise RuntimeError(f"The archive of {model_name} has the checksum {checksum}, expected {sha256}")
+            os.replace(archive + ".part", archive)
+            _write_text(manifest_path, json.dumps(dict(_file_stamp(archive), sha256=checksum, source=source)))
+            timings["verify"] += time.perf_counter() - start
+        else:
+            self._log(f"Using the cached archive of {model_name}")
+
+        version = checksum[:16]
+        start = time.perf_counter()
+        self._extract(model_name, archive, checksum, self.version_dir(model_name, version))
+        timings["extract"] = time.perf_counter() - start
+        if activate:
+            self.activate(model_name, version)
+        return version, timings
+
+    def _verify_archive(self, model_name, archive, manifest_path, source, sha256):
+        """
+        :return: The checksum of the cached archive, or None if it is to be fetched again
+        """
+        manifest = _read_manifest(manifest_path)
+        if manifest is None:
+            # e.g. the download was interrupted before the manifest was written
+            self._log(f"The cached archive of {model_name} was never verified, downloading it again")
+            return None
+        if manifest.get("source") != source:
+            self._log(f"The source of {model_name} changed, downloading it again")
+            return None
+        checksum = manifest["sha256"]
+        if any(manifest.get(key) != value for key, value in _file_stamp(archive).items()):
+            checksum = sha256sum(archive)
+            # an archive is only trusted if it is the one we recorded after the download
+            if checksum != manifest["sha256"]:
+                self._log(f"The cached archive of {model_name} does not match its checksum, downloading it again")
+                return None
+            _write_text(manifest_path, json.dumps(dict(_file_stamp(archive), sha256=checksum, source=source)))
+        if sha256 is not None and checksum != sha256:
+            self._log(f"The cached archive of {model_name} is not the expected one, downloading it again")
+            return None
+        return checksum
+
+    def _extract(self, model_name, archive, checksum, version_dir):
+        # a version folder is only ever created by the rename below, so it is complete if it exists
+        if _read_text(os.path.join(version_dir, ".archive.sha256")) == checksum:
+            self._log(f"{model_name} is extracted already")
+            return
+        self._log(f"Extracting {archive}")
+        extracting_dir = f"{version_dir}.extracting-{os.getpid()}"
+        shutil.rmtree(extracting_dir, ignore_errors=True)
+        with zipfile.ZipFile(archive, 'r') as zip_ref:
+            zip_ref.extractall(extracting_dir)
+        _write_text(os.path.join(extracting_dir, ".archive.sha256"), checksum)
+        try:
+            os.rename(extracting_dir, version_dir)
+        except OSError:
+            if not os.path.isdir(version_dir):
+                raise
+            # extracted by another process meanwhile
+            shutil.rmtree(extracting_dir, ignore_errors=True)
+
+    def activate(self, model_name, version):
+        """
+        Link <model_name> to an extracted version, atomically, and remove the versions no longer needed.
+        The version that was active before is kept, since workers may still be serving it.
+        """
+        model_dir = self.model_dir(model_name)
+        previous = self.active_version(model_name)
+        if os.path.isdir(model_dir) and not os.path.islink(model_dir):
+            # extracted in place by an earlier release of the server
+            previous = "unversioned-%d" % time.time()
+            os.rename(model_dir, self.version_dir(model_name, previous))
+        link = f"{model_dir}.link-{os.getpid()}"
+        if os.path.lexists(link):
+            os.remove(link)
+        os.symlink(os.path.join(".versions", model_name, version), link)
+        os.replace(link, model_dir)
+        self._log(f"Activated version {version} of {model_name}")
+        self._remove_old_versions(model_name, keep={version, previous})
+
+    def _remove_old_versions(self, model_name, keep):
+        versions_dir = os.path.join(self.models_dir, ".versions", model_name)
+        versions = sorted((entry for entry in os.scandir(versions_dir)
+                           if entry.is_dir(follow_symlinks=False) and ".extracting-" not in entry.name),
+                          key=lambda entry: entry.stat().st_mtime, reverse=True)
+        for entry in versions[self.KEEP_VERSIONS:]:
+            if entry.name not in keep:
+                self._log(f"Removing version {entry.name} of {model_name}")
+                shutil.rmtree(entry.path, ignore_errors=True)
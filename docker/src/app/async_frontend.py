@@ -0,0 +1,298 @@
+"""
+An asyncio front end for the /predict and /predict_raw endpoints, so that slow clients do not hold a model.
+
+The front end receives the request bodies, decompresses and parses them, and sends the responses without blocking,
+so it can hold many more connections than there are copies of the model. The model work is done by a fixed pool of
+inference executors, processes forked after the model was loaded, which only receive the texts to predict.
+Decompressing, parsing, stripping the html and encoding large payloads runs in a thread pool, off the event loop,
+and the html of large corpora is stripped in the preprocessing pool, see preprocessing.build_corpus_texts.
+"""
+import asyncio
+import gzip
+import json
+import multiprocessing
+import os
+import threading
+import time
+import zlib
+
+from aiohttp import web
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from io import BytesIO
+from werkzeug.datastructures import MIMEAccept
+from werkzeug.http import parse_accept_header
+from admission import DeadlineExceeded, check_deadline, get_deadline
+from cpu_topology import configure_worker
+from metrics import observe_request, render_metrics
+from model_control import WARM_UP_TEXTS, is_valid_model_name
+from model_registry import get_model_path
+from preprocessing import build_corpus_texts
+from response_formats import ENCODERS, LEGACY_MIMETYPE, maybe_compress, negotiate_format
+from utils import get_document_text
+
+# the endpoint names of the Flask app, so that the metrics of both modes line up
+ENDPOINTS = {'predict': 'parse_request', 'predict_raw': 'parse_request_raw'}
+
+# set in every inference executor by _init_executor
+_predict_fn = None
+
+
+def _init_executor(predict_fn, layout, pin, next_slot, model_name, ready):
+    global _predict_fn
+    _predict_fn = predict_fn
+    with next_slot.get_lock():
+        slot = next_slot.value
+        next_slot.value += 1
+    configure_worker(layout, slot=slot % layout['workers'], pin=pin)
+    # every executor warms itself up before it takes its first batch
+    predict_fn(model_name, WARM_UP_TEXTS, 1)
+    with ready.get_lock():
+        ready.value += 1
+
+
+def _predict_batch(model_name, texts, top_n, deadline):
+    """
+    Runs in an inference executor.
+
+    :param texts: The texts to predict
+    :return: A tuple (indices, probas, label_array), see serve_model.get_ranked_text_predictions
+    """
+    # the batch may have waited for a free executor
+    check_deadline(deadline)
+    return _predict_fn(model_name, texts, top_n)
+
+
+def _parse(body, gzipped, raw, max_bytes):
+    if gzipped:
+        with gzip.GzipFile(fileobj=BytesIO(body), mode='r') as f:
+            body = f.read(max_bytes + 1) if max_bytes else f.read()
+        if max_bytes and len(body) > max_bytes:
+            raise OverflowError(f"The uncompressed payload is larger than {max_bytes} bytes")
+    if raw:
+        # split on new-lines only, like the gunicorn server. splitlines would split on \r and \u2028 as well
+        return [line for line in body.decode("utf-8").split("\n") if line.strip() != ""]
+    return json.loads(body)
+
+
+def _build_texts(documents, raw):
+    """
+    :param documents: The parsed json documents, or the lines of a raw payload
+    :param raw: Whether the documents are raw lines
+    :return: The texts to predict
+    """
+    if raw:
+        return [get_document_text(line) for line in documents]
+    return build_corpus_texts(documents)
+
+
+def _encode(ranked_predictions, mimetype, accept_encoding, compress_level, min_bytes):
+    return maybe_compress(ENCODERS[mimetype](*ranked_predictions), accept_encoding,
+                          compress_level=compress_level, min_bytes=min_bytes)
+
+
+def _text_response(message, status):
+    return web.Response(text="{'Messsage':'" + message + "'}", status=status, content_type='text/plain')
+
+
+class AsyncFrontend:
+    """
+    Serves the /predict and /predict_raw endpoints with aiohttp and predicts with a pool of inference executors.
+
+    Streaming mode, /predict_ids, the bulk jobs and the /admin endpoints are only served by the gunicorn server.
+    """
+
+    def __init__(self, predict_fn, active_model_fn, layout, admission, allowed_models=(), pin=False,
+                 max_request_documents=0,
+                 max_request_bytes=0, request_timeout=None, retry_after=1, compress_level=6, min_compress_bytes=1024,
+                 io_threads=4, logger=None):
+        """
+        :param predict_fn: A function (model_name, texts, top_n) -> (indices, probas, label_array),
+                           called in the inference executors
+        :param active_model_fn: A function returning the name of the model used unless a request selects one
+        :param layout: A layout from cpu_topology.plan_layout, with one worker per inference executor
+        :param admission: An AdmissionController
+        :param allowed_models: The names of the models that requests may select besides the active model
+        :param pin: Whether to pin the inference executors to their cores
+        :param max_request_documents: The cap on the documents of a request. 0 disables it
+        :param max_request_bytes: The cap on the bytes of a request, compressed or not. 0 disables it
+        :param request_timeout: The seconds requests without a deadline header have, or None
+        :param retry_after: The seconds rejected clients are asked to wait
+        :param compress_level: The gzip level of the responses
+        :param min_compress_bytes: Smaller responses are not gzipped
+        :param io_threads: The size of the thread pool that decompresses, parses and encodes the payloads
+        :param logger: A logger
+        """
+        self.predict_fn = predict_fn
+        self.active_model_fn = active_model_fn
+        self.layout = layout
+        self.admission = admission
+        self.allowed_models = set(allowed_models)
+        self.pin = pin
+        self.max_request_documents = max_request_documents
+        self.max_request_bytes = max_request_bytes
+        self.request_timeout = request_timeout
+        self.retry_after = retry_after
+        self.compress_level = compress_level
+        self.min_compress_bytes = min_compress_bytes
+        self.logger = logger
+        self.io_pool = ThreadPoolExecutor(max_workers=io_threads, thread_name_prefix="io")
+        self.executors = None
+        self._executors_lock = threading.Lock()
+
+    def start_executors(self, model_name):
+        """
+        Fork the inference executors and warm them up. Call it before the event loop starts.
+        """
+        # forked, so that the executors share the model loaded already, and inherit the predict function
+        ready = multiprocessing.Value('i', 0)
+        executors = ProcessPoolExecutor(max_workers=self.layout['workers'],
+                                        mp_context=multiprocessing.get_context("fork"),
+                                        initializer=_init_executor,
+                                        initargs=(self.predict_fn, self.layout, self.pin,
+                                                  multiprocessing.Value('i', 0), model_name, ready))
+        # all executors are forked on the first submit, and each warms itself up in _init_executor
+        while ready.value < self.layout['workers']:
+            # raises BrokenProcessPool if an executor could not start
+            executors.submit(os.getpid).result()
+            time.sleep(0.05)
+        if self.logger:
+            self.logger.info(f"Started {ready.value} inference executors")
+        self.executors = executors
+
+    def _restart_executors(self, broken, model_name):
+        with self._executors_lock:
+            if self.executors is broken:
+                if self.logger:
+                    self.logger.error("An inference executor died, restarting the executors")
+                broken.shutdown(wait=False)
+                self.start_executors(model_name)
+
+    def _rejected(self, message, status):
+        response = _text_response(message, status)
+        response.headers['Retry-After'] = str(self.retry_after)
+        return response
+
+    async def predict(self, request):
+        raw = request.path.startswith("/predict_raw")
+        how_many = int(request.match_info.get('how_many', 4))
+        model_name = request.match_info.get('model')
+        if model_name is None:
+            model_name = self.active_model_fn()
+        elif model_name != self.active_model_fn() and (model_name not in self.allowed_models
+                                                       or not is_valid_model_name(model_name)
+                                                       or not os.path.isdir(get_model_path(model_name))):
+            # the executors would load the model on the request path, and possibly evict the active one
+            return _text_response("No such model", 404)
+
+        try:
+            deadline = get_deadline(request.headers, default_timeout=self.request_timeout)
+            check_deadline(deadline)
+        except ValueError:
+            return _text_response("The deadline headers must be numbers of seconds", 400)
+
+        if request.content_type not in ("text/plain", "application/gzip"):
+            return _text_response("Specify Content-Type in request header. "
+                                  "One of 'text/plain' or 'application/gzip'", 400)
+        # the body is received without blocking anything, no matter how slowly the client sends it
+        body = await request.read()
+        if len(body) == 0:
+            return _text_response("No data in request", 400)
+
+        loop = asyncio.get_event_loop()
+        try:
+            documents = await loop.run_in_executor(self.io_pool, _parse, body,
+                                                   request.content_type == "application/gzip", raw,
+                                                   self.max_request_bytes)
+        except OverflowError as ex:
+            return _text_response(str(ex), 413)
+        except (ValueError, OSError, EOFError, zlib.error) as ex:
+            if self.logger:
+                self.logger.error(ex)
+            return _text_response("Malformatted data", 400)
+        if not isinstance(documents, list):
+            return _text_response("Malformatted data", 400)
+        request['documents'] = len(documents)
+
+        if self.max_request_documents and len(documents) > self.max_request_documents:
+            return _text_response(f"Too many documents, send at most {self.max_request_documents} per request, "
+                                  f"or use /jobs", 413)
+        if not self.admission.try_admit(len(documents)):
+            return self._rejected("The server is busy, retry later", 503)
+        try:
+            # the executors only get the texts, which are cheaper to send than the documents
+            try:
+                texts = await loop.run_in_executor(self.io_pool, _build_texts, documents, raw)
+            except (KeyError, TypeError) as ex:
+                if self.logger:
+                    self.logger.error(ex)
+                return _text_response("Malformatted data", 400)
+            check_deadline(deadline)
+            executors = self.executors
+            ranked_predictions = await loop.run_in_executor(executors, _predict_batch, model_name, texts,
+                                                            how_many, deadline)
+        except BrokenProcessPool:
+            await loop.run_in_executor(self.io_pool, self._restart_executors, executors, self.active_model_fn())
+            return self._rejected("The server is restarting its inference executors, retry later", 503)
+        finally:
+            self.admission.release(len(documents))
+
+        mimetype = negotiate_format(parse_accept_header(request.headers.get('Accept'), MIMEAccept))
+        data, gzipped = await loop.run_in_executor(self.io_pool, _encode, ranked_predictions, mimetype,
+                                                   request.headers.get('Accept-Encoding', ''),
+                                                   self.compress_level, self.min_compress_bytes)
+        if gzipped:
+            # the default format has always been sent as application/gzip when gzipped
+            response = web.Response(body=data, content_type='application/gzip' if mimetype == LEGACY_MIMETYPE
+                                    else mimetype)
+            response.headers['Content-Encoding'] = 'gzip'
+        else:
+            response = web.Response(body=data, content_type=mimetype)
+        response.headers['Vary'] = 'Accept, Accept-Encoding'
+        return response
+
+    async def health(self, request):
+        return web.Response(text="OK", content_type='text/plain')
+
+    async def metrics(self, request):
+        data, content_type = render_metrics()
+        return web.Response(body=data, headers={'Content-Type': content_type})
+
+    @web.middleware
+    async def record_request_metrics(self, request, handler):
+        start = time.perf_counter()
+        endpoint = ENDPOINTS.get(request.path.strip("/").split("/")[0])
+        try:
+            response = await handler(request)
+        except DeadlineExceeded as ex:
+            if self.logger:
+                self.logger.warning(f"Cancelled the request: {ex}")
+            response = _text_response("Deadline exceeded", 504)
+        except web.HTTPException as ex:
+            # e.g. a body larger than client_max_size
+            if endpoint is not None:
+                observe_request(endpoint, ex.status, time.perf_counter() - start,
+                                request_bytes=request.content_length)
+            raise
+        if endpoint is not None:
+            observe_request(endpoint, response.status, time.perf_counter() - start,
+                            request_bytes=request.content_length, response_bytes=response.content_length,
+                            documents=request.get('documents'))
+        return response
+
+    def create_app(self):
+        # larger bodies are rejected by aiohttp with a 413
+        app = web.Application(client_max_size=self.max_request_bytes or 2 ** 40,
+                              middlewares=[self.record_request_metrics])
+        for prefix in ("/predict", "/predict_raw"):
+            app.router.add_post(prefix, self.predict)
+            app.router.add_post(prefix + "/{how_many:\\d+}", self.predict)
+            app.router.add_post(prefix + "/{model}", self.predict)
+            app.router.add_post(prefix + "/{model}/{how_many:\\d+}", self.predict)
+        app.router.add_get("/healthz", self.health)
+        app.router.add_get("/metrics", self.metrics)
+        return app
+
+    def run(self, host, port, model_name):
+        self.start_executors(model_name)
+        web.run_app(self.create_app(), host=host, port=port, print=None)
@@ -0,0 +1,68 @@
+"""
+Find the split of the cores between gunicorn workers and their intra- and inter-op torch threads that predicts
+the most documents per second.
+
+Every candidate layout is started as a gunicorn server in a subprocess, with the model configured in the environment,
+and loaded with synthetic /predict requests from enough concurrent clients to keep all workers busy.
+"""
+from bench_server import get_free_port, make_payloads, run_scenario, start_gunicorn_server, wait_until_healthy
+from cpu_topology import get_cpu_budget, plan_layout
+
+
+def candidate_layouts(cpu_budget=None, inter_op_threads=(1, 2, 4)):
+    """
+    :param cpu_budget: The number of cores to split. Defaults to get_cpu_budget()
+    :param inter_op_threads: The inter-op threads to try with every number of intra-op threads, up to as many
+    :return: The layouts from one worker per core to one worker with all cores
+    """
+    cpu_budget = cpu_budget or get_cpu_budget()
+    intra_op_threads = sorted({t for t in (1, 2, 4, 8, 16) if t <= cpu_budget} | {cpu_budget})
+    return [plan_layout(intra_op_threads=t, inter_op_threads=i, cpu_budget=cpu_budget)
+            for t in intra_op_threads for i in inter_op_threads if i <= t]
+
+
+def thread_args(layout, pin=False):
+    """
+    :return: The options of the gunicorn command for the threads of a layout
+    """
+    args = ["--intra-op-threads", str(layout["intra_op_threads"]),
+            "--inter-op-threads", str(layout["inter_op_threads"])]
+    if pin:
+        args += ["--pin-cores", "1"]
+    return args
+
+
+def autotune(layouts, corpus, docs_per_request=10, requests=50, pin=False, logger=None):
+    """
+    Benchmark every layout.
+
+    :param layouts: Layouts from plan_layout
+    :param corpus: The json documents to send
+    :param docs_per_request: How many documents per /predict request
+    :param requests: How many requests to time per layout, after a warm-up
+    :param pin: Whether to pin the workers to their cores
+    :param logger: A logger
+    :return: The layouts, each with the 'documents_per_second' and 'p99_ms' measured, best first
+    """
+    payloads = make_payloads(corpus, docs_per_request)
+    # every request must reach the model, otherwise we benchmark the prediction cache
+    env = {"PREDICTION_CACHE_SIZE": "0"}
+    results = []
+    for layout in layouts:
+        port = get_free_port()
+        base_url = f"http://127.0.0.1:{port}"
+        process = start_gunicorn_server(port, env, layout["workers"], 1, "sync",
+                                        extra_args=thread_args(layout, pin=pin))
+        try:
+            wait_until_healthy(base_url, timeout=600)
+            concurrency = 2 * layout["workers"]
+            run_scenario(base_url, "/predict", False, payloads, concurrency, concurrency, docs_per_request)
+            result = run_scenario(base_url, "/predict", False, payloads, requests, concurrency, docs_per_request)
+        finally:
+            process.terminate()
+            process.wait(timeout=60)
+        results.append(dict(layout, documents_per_second=result["documents_per_second"],
+                            p99_ms=result.get("p99_ms"), errors=result["errors"]))
+        if logger:
+            logger.info(f"Autotune: {results[-1]}")
+    return sorted(results, key=lambda r: (r["errors"] == 0, r["documents_per_second"]), reverse=True)
@@ -0,0 +1,142 @@
+import gzip
+import json
+import multiprocessing
+import queue
+import time
+
+from cpu_topology import configure_worker, plan_layout
+from streaming import iter_chunks, iter_corpus_file
+
+
+def get_shard_path(output_prefix, shard, n_shards, gzipped=False):
+    return f"{output_prefix}-{shard:05d}-of-{n_shards:05d}.ndjson" + (".gz" if gzipped else "")
+
+
+def _predict_shard(shard, n_shards, chunk_queue, done_queue, predict_fn, output_prefix, gzipped, layout, pin_cores):
+    # every process gets its own share of the cores, so that the processes do not oversubscribe them
+    configure_worker(layout, slot=shard, pin=pin_cores)
+    n_documents = 0
+    try:
+        path = get_shard_path(output_prefix, shard, n_shards, gzipped)
+        with (gzip.open(path, "wb") if gzipped else open(path, "wb")) as f:
+            while True:
+                item = chunk_queue.get()
+                if item is None:
+                    break
+                first_index, json_documents = item
+                predictions = predict_fn(json_documents)
+                f.write("".join(json.dumps({"index": first_index + i, "predictions": p}) + "\n"
+                                for i, p in enumerate(predictions)).encode("utf-8"))
+                n_documents += len(predictions)
+        done_queue.put((shard, n_documents, None))
+    except Exception as ex:
+        done_queue.put((shard, n_documents, f"{type(ex).__name__}: {ex}"))
+        # keep consuming, so that the corpus reader is not blocked by a full queue
+        while chunk_queue.get() is not None:
+            pass
+
+
+def _check_workers(workers, reported=()):
+    """
+    :raise RuntimeError: If a process exited before it reported its shard, e.g. because it was killed
+    """
+    for shard, worker in enumerate(workers):
+        if shard not in reported and worker.exitcode is not None:
+            raise RuntimeError(f"The process of shard {shard} exited with code {worker.exitcode}")
+
+
+def _put(chunk_queue, item, workers, poll_interval=1.0):
+    # a plain put would block forever if the processes that consume the queue died
+    while True:
+        try:
+            chunk_queue.put(item, timeout=poll_interval)
+            return
+        except queue.Full:
+            _check_workers(workers)
+
+
+def _collect(done_queue, workers, poll_interval=1.0):
+    """
+    :return: A dict with the tuple (n_documents, error) of every shard
+    """
+    reported = {}
+    while len(reported) < len(workers):
+        try:
+            shard, shard_documents, error = done_queue.get(timeout=poll_interval)
+            reported[shard] = (shard_documents, error)
+        except queue.Empty:
+            try:
+                _check_workers(workers, reported)
+            except RuntimeError:
+                # the last message of a process may arrive just after it exited
+                try:
+                    shard, shard_documents, error = done_queue.get(timeout=poll_interval)
+                    reported[shard] = (shard_documents, error)
+                except queue.Empty:
+                    raise
+    return reported
+
+
+def predict_file(input_path, output_prefix, predict_fn, processes=2, chunk_size=256, gzipped=False, pin_cores=False,
+                 logger=None):
+    """
+    Predict a corpus file in several processes, each writing its own shard of results.
+
+    The corpus is parsed incrementally and handed out to the processes in chunks, so memory stays bounded no matter
+    how large the file is. Every line of a shard is a json object {"index": <position of the document in the corpus>,
+    "predictions": [ [<predicted_label_1>, <confidence>],... ]}
+
+    :param input_path: A json array or NDJSON file of documents, optionally gzipped
+    :param output_prefix: The shards are written to <output_prefix>-<shard>-of-<processes>.ndjson[.gz]
+    :param predict_fn: A function that takes a list of json documents and returns a list of predictions.
+                       It is called in the forked processes, so a model loaded before the call is shared by them
+    :param processes: The number of processes
+    :param chunk_size: How many documents are sent to a process at a time
+    :param gzipped: Whether to gzip the shards
+    :param pin_cores: Whether to pin every process to its own cores
+    :param logger: A logger
+    :return: A dict with the number of documents, the elapsed time and the documents per second
+    """
+    start = time.perf_counter()
+    layout = plan_layout(workers=processes)
+    # bounded, so that we do not parse the corpus faster than it is predicted
+    chunk_queue = multiprocessing.Queue(maxsize=2 * processes)
+    done_queue = multiprocessing.Queue()
+    workers = [multiprocessing.Process(target=_predict_shard,
+                                       args=(shard, processes, chunk_queue, done_queue, predict_fn, output_prefix,
+                                             gzipped, layout, pin_cores),
+                                       name=f"predict-shard-{shard}")
+               for shard in range(processes)]
+    for worker in workers:
+        worker.start()
+    if logger:
+        logger.info(f"Predicting {input_path} in {processes} processes with {layout['intra_op_threads']} threads each")
+
+    try:
+        first_index = 0
+        for chunk in iter_chunks(iter_corpus_file(input_path), chunk_size):
+            _put(chunk_queue, (first_index, chunk), workers)
+            first_index += len(chunk)
+        for _ in workers:
+            _put(chunk_queue, None, workers)
+        reported = _collect(done_queue, workers)
+    except BaseException:
+        # e.g. a malformatted corpus, or a process that was killed
+        for worker in workers:
+            worker.terminate()
+        raise
+    finally:
+        for worker in workers:
+            worker.join()
+
+    n_documents = 0
+    errors = []
+    for shard, (shard_documents, error) in sorted(reported.items()):
+        n_documents += shard_documents
+        if error is not None:
+            errors.append(f"shard {shard}: {error}")
+    if errors:
+        raise RuntimeError("Prediction failed in " + "; ".join(errors))
+
+    elapsed = time.perf_counter() - start
+    return {"documents": n_documents, "seconds": elapsed, "documents_per_second": n_documents / elapsed}
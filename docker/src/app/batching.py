@@ -0,0 +1,169 @@
+import os
+import queue
+import threading
+import time
+
+from admission import DeadlineExceeded
+
+
+class _PendingRequest:
+    """
+    The texts of one request waiting to be batched, together with the place where its predictions are delivered.
+    """
+
+    def __init__(self, texts, deadline=None):
+        self.texts = texts
+        self.deadline = deadline
+        self.predictions = None
+        self.error = None
+        self.done = threading.Event()
+
+
+class MicroBatcher:
+    """
+    Gathers the texts of concurrent requests into a single inference call.
+
+    Requests are queued and a background thread collects them until either 'max_batch_size' texts are gathered or
+    'max_wait_ms' milliseconds have passed since the first one arrived. The batch is then predicted at once and the
+    predictions are scattered back to each waiting request in order.
+
+    Batching across requests only pays off if a worker serves several requests at a time,
+    i.e. with the gthread worker class and more than one thread per worker.
+    """
+
+    def __init__(self, predict_fn, max_batch_size=32, max_wait_ms=5):
+        """
+        :param predict_fn: A function that takes a list of texts and returns a list of predictions, one per text
+        :param max_batch_size: Stop gathering once the batch holds that many texts
+        :param max_wait_ms: Stop gathering this many milliseconds after the first request of a batch arrived
+        """
+        self.predict_fn = predict_fn
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.0
+        self._lock = threading.Lock()
+        self._queue = None
+        self._thread = None
+        self._pid = None
+        self._closed = False
+
+    def _ensure_started(self):
+        # threads do not survive a fork, so the batching thread is started lazily in the process that uses it.
+        # Call it with the lock held
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._queue = queue.Queue()
+            self._thread = threading.Thread(target=self._run, args=(self._queue,),
+                                            name="micro-batcher", daemon=True)
+            self._thread.start()
+        return self._queue
+
+    def predict(self, texts, deadline=None):
+        """
+        Get the predictions for a list of texts. Blocks until the batch they were put in has been predicted.
+
+        :param texts: A list of texts
+        :param deadline: A unix timestamp. If it passes while the texts wait for their batch, they are not predicted
+        :return: A list of predictions, one per text
+        :raise DeadlineExceeded: If the deadline passed before the batch was predicted
+        """
+        if len(texts) == 0:
+            return []
+        pending = _PendingRequest(texts, deadline)
+        with self._lock:
+            # queued under the lock, so that nothing is queued after the sentinel of close()
+            queued = not self._closed
+            if queued:
+                self._ensure_started().put(pending)
+        if not queued:
+            # closed, e.g. the model was evicted while a request still held it
+            return self.predict_fn(texts)
+        pending.done.wait()
+        if pending.error is not None:
+            raise pending.error
+        return pending.predictions
+
+    def close(self):
+        """
+        Stop the batching thread once the requests queued so far have been served.
+        Texts predicted after that are predicted right away, without batching.
+        """
+        with self._lock:
+            self._closed = True
+            if self._pid == os.getpid() and self._queue is not None:
+                self._queue.put(None)
+
+    def _gather(self, request_queue, first):
+        batch = [first]
+        batch_size = len(first.texts)
+        deadline = time.monotonic() + self.max_wait
+        while batch_size < self.max_batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                pending = request_queue.get(timeout=timeout)
+            except queue.Empty:
+                break
+            if pending is None:
+                # we were closed, put the sentinel back for the main loop
+                request_queue.put(None)
+                break
+            batch.append(pending)
+            batch_size += len(pending.texts)
+        return batch
+
+    @staticmethod
+    def _drop_expired(batch):
+        # the requests whose deadline passed while they waited are cancelled, not predicted
+        now = time.time()
+        live = []
+        for pending in batch:
+            if pending.deadline is not None and now > pending.deadline:
+                pending.error = DeadlineExceeded(f"The deadline passed {now - pending.deadline:.3f}s ago, "
+                                                 f"while waiting for a batch")
+                pending.done.set()
+            else:
+                live.append(pending)
+        return live
+
+    def _run(self, request_queue):
+        try:
+            self._serve(request_queue)
+        finally:
+            # fail whatever is left, e.g. if the thread died, so that no request waits forever
+            while True:
+                try:
+                    pending = request_queue.get_nowait()
+                except queue.Empty:
+                    break
+                if pending is not None:
+                    pending.error = RuntimeError("The micro-batcher stopped before the texts were predicted")
+                    pending.done.set()
+
+    def _serve(self, request_queue):
+        while True:
+            first = request_queue.get()
+            if first is None:
+                # closed. Nothing is queued after the sentinel, so every request has been served
+                return
+            batch = self._gather(request_queue, first)
+            batch = self._drop_expired(batch)
+            if not batch:
+                continue
+
+            texts = [text for pending in batch for text in pending.texts]
+            try:
+                predictions = self.predict_fn(texts)
+            except Exception as ex:
+                for pending in batch:
+                    pending.error = ex
+                    pending.done.set()
+                continue
+
+            # scatter the predictions back to the requests, in the order their texts were batched
+            start = 0
+            for pending in batch:
+                end = start + len(pending.texts)
+                pending.predictions = predictions[start:end]
+                pending.done.set()
+                start = end
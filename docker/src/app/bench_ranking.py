@@ -0,0 +1,70 @@
+"""
+Micro-benchmark of the top-N ranking of predictions.
+
+Compares the former ranking, which built a pandas DataFrame per document, with the vectorized ranking in ranking.py
+for different batch and label counts. Run it with:
+
+    python bench_ranking.py [--top-n 4] [--repeat 3]
+"""
+import argparse
+import numpy as np
+import pandas as pd
+import timeit
+
+from ranking import rank_top_n
+
+
+def rank_top_n_pandas(probabilities, label_list, top_n=4):
+    """
+    The ranking as it was done in get_predictions before it was vectorized
+    """
+    output_list = []
+    for proba in probabilities:
+        predictions_df = pd.DataFrame({"labels": label_list,
+                                       "predicted_proba": proba}).sort_values(by="predicted_proba",
+                                                                              ascending=False).head(top_n)
+        sample_output = [[label, confidence] for label, confidence in zip(predictions_df["labels"],
+                                                                          predictions_df['predicted_proba'])]
+        output_list.append(sample_output)
+    return output_list
+
+
+def make_predictions(n_documents, n_labels, seed=0):
+    """
+    Random softmax outputs, shaped as the probability vectors returned by FARM
+    """
+    rng = np.random.RandomState(seed)
+    logits = rng.normal(size=(n_documents, n_labels)).astype(np.float32)
+    proba = np.exp(logits)
+    proba /= proba.sum(axis=1, keepdims=True)
+    return list(proba)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--top-n', type=int, default=4)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--batch-sizes', type=int, nargs='+', default=[1, 100, 1000, 5000])
+    parser.add_argument('--label-counts', type=int, nargs='+', default=[50, 200, 1000])
+    args = parser.parse_args()
+
+    print(f"{'documents':>10} {'labels':>8} {'pandas [s]':>12} {'numpy [s]':>12} {'speedup':>9}")
+    for n_labels in args.label_counts:
+        label_list = [f"label_{i}" for i in range(n_labels)]
+        label_array = np.array(label_list, dtype=object)
+        for n_documents in args.batch_sizes:
+            probabilities = make_predictions(n_documents, n_labels)
+
+            if rank_top_n_pandas(probabilities, label_list, args.top_n) != \
+                    rank_top_n(probabilities, label_array, args.top_n):
+                raise AssertionError(f"Rankings differ for {n_documents} documents and {n_labels} labels")
+
+            t_pandas = min(timeit.repeat(lambda: rank_top_n_pandas(probabilities, label_list, args.top_n),
+                                         number=1, repeat=args.repeat))
+            t_numpy = min(timeit.repeat(lambda: rank_top_n(probabilities, label_array, args.top_n),
+                                        number=1, repeat=args.repeat))
+            print(f"{n_documents:>10} {n_labels:>8} {t_pandas:>12.5f} {t_numpy:>12.5f} {t_pandas / t_numpy:>8.1f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,251 @@
+"""
+Load test of the prediction server with a stub model, which runs offline without model weights.
+
+The server is started locally, either as the Flask app in this process or as the gunicorn server in a subprocess,
+with the FARM Inferencer replaced by the deterministic stub of stub_inferencer.py.
+Payloads are then replayed against /predict and /predict_raw at the given concurrency, with and without gzip.
+Throughput, latency percentiles and the memory of every server process are reported and saved as json.
+Pass the json of an earlier run with --baseline to compare against it. Run it with:
+
+    python bench_server.py --mode gunicorn --workers 4 --concurrency 8 --output results.json
+"""
+import argparse
+import gzip
+import json
+import os
+import platform
+import socket
+import subprocess
+import sys
+import threading
+import time
+import urllib.request
+
+from bench_text_extraction import make_corpus
+from concurrent.futures import ThreadPoolExecutor
+from streaming import iter_corpus_file
+
+SCENARIOS = [("/predict", False), ("/predict", True), ("/predict_raw", False), ("/predict_raw", True)]
+
+
+def get_free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def wait_until_healthy(url, timeout=120):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            with urllib.request.urlopen(url + "/healthz", timeout=5) as response:
+                if response.status == 200:
+                    return
+        except OSError:
+            time.sleep(0.5)
+    raise RuntimeError(f"The server at {url} did not become healthy within {timeout}s")
+
+
+def start_flask_server(port, env):
+    """
+    Serve the Flask app from a thread of this process
+    """
+    os.environ.update(env)
+    from werkzeug.serving import make_server
+    import serve_model
+    serve_model.model_name = json.loads(env['MODEL_TO_LOAD'])[0]
+    server = make_server("127.0.0.1", port, serve_model.app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def start_gunicorn_server(port, env, workers, threads, worker_class, extra_args=()):
+    """
+    Start the gunicorn server in a subprocess, exactly as in the container, but without downloading the model
+    """
+    command = [sys.executable, "serve_model.py", "gunicorn", "-h", "127.0.0.1", "-p", str(port),
+               "-w", str(workers), "-n", str(threads), "-k", worker_class, "--download-model", "",
+               "--job-runner", ""] + list(extra_args)
+    process = subprocess.Popen(command, env=dict(os.environ, **env),
+                               cwd=os.path.dirname(os.path.abspath(__file__)))
+    return process
+
+
+def get_process_tree(pid):
+    """
+    The pid of a process and of all its descendants
+    """
+    pids = [pid]
+    for task in os.listdir(f"/proc/{pid}/task"):
+        try:
+            with open(f"/proc/{pid}/task/{task}/children") as f:
+                for child in f.read().split():
+                    pids.extend(get_process_tree(int(child)))
+        except FileNotFoundError:
+            pass
+    return pids
+
+
+def get_memory_mb(pid):
+    """
+    The resident and the proportional set size of a process. PSS splits the pages shared copy-on-write between
+    the gunicorn workers, so it is the better measure of the memory a worker costs.
+    """
+    memory = {"pid": pid}
+    for path, field, key in [(f"/proc/{pid}/status", "VmRSS:", "rss_mb"),
+                             (f"/proc/{pid}/smaps_rollup", "Pss:", "pss_mb")]:
+        try:
+            with open(path) as f:
+                for line in f:
+                    if line.startswith(field):
+                        memory[key] = int(line.split()[1]) / 1024
+        except (FileNotFoundError, PermissionError):
+            pass
+    return memory
+
+
+def make_payloads(corpus, docs_per_request):
+    """
+    Split the corpus in /predict payloads and the matching /predict_raw payloads, which hold one text per line
+    """
+    payloads = {"/predict": [], "/predict_raw": []}
+    for start in range(0, len(corpus), docs_per_request):
+        docs = corpus[start:start + docs_per_request]
+        payloads["/predict"].append(json.dumps(docs).encode("utf-8"))
+        lines = [(doc['content'].get('title', '') + ". " + doc['content'].get('fullTextHtml', ''))
+                 .replace("\n", " ") for doc in docs]
+        payloads["/predict_raw"].append("\n".join(lines).encode("utf-8"))
+    return payloads
+
+
+def send_request(url, payload, gzipped):
+    headers = {"Content-Type": "application/gzip" if gzipped else "text/plain"}
+    if gzipped:
+        headers["Accept-Encoding"] = "gzip"
+    request = urllib.request.Request(url, data=payload, headers=headers, method="POST")
+    start = time.perf_counter()
+    with urllib.request.urlopen(request, timeout=600) as response:
+        response.read()
+        if response.status != 200:
+            raise RuntimeError(f"{url} returned {response.status}")
+    return time.perf_counter() - start
+
+
+def percentile(values, q):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(q / 100.0 * (len(ordered) - 1))))]
+
+
+def run_scenario(base_url, endpoint, gzipped, payloads, n_requests, concurrency, docs_per_request):
+    bodies = [gzip.compress(p) if gzipped else p for p in payloads[endpoint]]
+    requests = [bodies[i % len(bodies)] for i in range(n_requests)]
+    errors = []
+
+    def send(body):
+        try:
+            return send_request(base_url + endpoint, body, gzipped)
+        except Exception as ex:
+            errors.append(str(ex))
+            return None
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        latencies = [latency for latency in executor.map(send, requests) if latency is not None]
+    elapsed = time.perf_counter() - start
+
+    result = {"endpoint": endpoint, "gzip": gzipped, "requests": n_requests, "errors": len(errors),
+              "seconds": elapsed, "requests_per_second": len(latencies) / elapsed,
+              "documents_per_second": len(latencies) * docs_per_request / elapsed}
+    if latencies:
+        result.update({f"p{q}_ms": percentile(latencies, q) * 1000 for q in (50, 95, 99)})
+    return result
+
+
+def compare(results, baseline):
+    """
+    Print the change of throughput and p99 latency relative to an earlier run
+    """
+    earlier = {(r["endpoint"], r["gzip"]): r for r in baseline["results"]}
+    print("\nCompared to the baseline:")
+    for result in results:
+        before = earlier.get((result["endpoint"], result["gzip"]))
+        if before is None or "p99_ms" not in result or "p99_ms" not in before:
+            continue
+        throughput = result["documents_per_second"] / before["documents_per_second"] - 1
+        p99 = result["p99_ms"] / before["p99_ms"] - 1
+        print(f"{result['endpoint']:>12} gzip={str(result['gzip']):<5} docs/sec {throughput:+.1%}   p99 {p99:+.1%}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--mode', choices=['flask', 'gunicorn'], default='flask')
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--threads', type=int, default=1)
+    parser.add_argument('--worker-class', default='sync')
+    parser.add_argument('--corpus', default=None, help="A json array or NDJSON file of documents to replay")
+    parser.add_argument('--documents', type=int, default=200, help="Size of the synthetic corpus")
+    parser.add_argument('--docs-per-request', type=int, default=10)
+    parser.add_argument('--requests', type=int, default=100, help="Requests per scenario")
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--stub-labels', type=int, default=100)
+    parser.add_argument('--stub-delay-ms', type=float, default=20)
+    parser.add_argument('--stub-delay-per-doc-ms', type=float, default=2)
+    parser.add_argument('--output', default=None, help="Save the results to this json file")
+    parser.add_argument('--baseline', default=None, help="The json results of an earlier run to compare with")
+    args = parser.parse_args()
+
+    port = get_free_port()
+    base_url = f"http://127.0.0.1:{port}"
+    env = {"INFERENCER": "stub", "MODEL_TO_LOAD": json.dumps(["stub", ""]),
+           "STUB_LABELS": str(args.stub_labels), "STUB_DELAY_MS": str(args.stub_delay_ms),
+           "STUB_DELAY_PER_DOC_MS": str(args.stub_delay_per_doc_ms),
+           # every request must reach the model, otherwise we benchmark the prediction cache
+           "PREDICTION_CACHE_SIZE": "0"}
+
+    process = None
+    if args.mode == 'flask':
+        server = start_flask_server(port, env)
+        root_pid = os.getpid()
+    else:
+        process = start_gunicorn_server(port, env, args.workers, args.threads, args.worker_class)
+        root_pid = process.pid
+
+    try:
+        wait_until_healthy(base_url)
+        corpus = list(iter_corpus_file(args.corpus)) if args.corpus else make_corpus(args.documents)
+        payloads = make_payloads(corpus, args.docs_per_request)
+
+        results = []
+        print(f"{'endpoint':>12} {'gzip':>5} {'req/s':>8} {'docs/s':>9} {'p50 ms':>8} {'p95 ms':>8} "
+              f"{'p99 ms':>8} {'errors':>7}")
+        for endpoint, gzipped in SCENARIOS:
+            result = run_scenario(base_url, endpoint, gzipped, payloads, args.requests, args.concurrency,
+                                  args.docs_per_request)
+            results.append(result)
+            print(f"{endpoint:>12} {str(gzipped):>5} {result['requests_per_second']:>8.1f} "
+                  f"{result['documents_per_second']:>9.1f} {result.get('p50_ms', 0):>8.1f} "
+                  f"{result.get('p95_ms', 0):>8.1f} {result.get('p99_ms', 0):>8.1f} {result['errors']:>7}")
+
+        memory = [get_memory_mb(pid) for pid in get_process_tree(root_pid)]
+        for m in memory:
+            print(f"process {m['pid']}: rss {m.get('rss_mb', 0):.1f} MB, pss {m.get('pss_mb', 0):.1f} MB")
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait(timeout=60)
+        else:
+            server.shutdown()
+
+    report = {"config": vars(args), "platform": platform.platform(), "cpu_count": os.cpu_count(),
+              "timestamp": time.time(), "results": results, "memory": memory}
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Saved the results to {args.output}")
+    if args.baseline:
+        with open(args.baseline) as f:
+            compare(results, json.load(f))
+
+
+if __name__ == '__main__':
+    main()
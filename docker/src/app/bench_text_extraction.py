@@ -0,0 +1,74 @@
+"""
+Benchmark of the html-to-text extraction backends and of the batch construction of Documents.
+
+Every backend is checked against the reference "html.parser" backend and timed on the same corpus.
+The corpus is a json array or NDJSON file (optionally gzipped) following the json schema of /predict.
+Without a corpus, synthetic news articles are used. Run it with:
+
+    python bench_text_extraction.py [--corpus predict_payload.json.gz] [--processes 4]
+"""
+import argparse
+import random
+import time
+
+from preprocessing import build_corpus_texts, build_documents
+from streaming import iter_corpus_file
+from text_extraction import EXTRACTION_BACKENDS, extract_text
+
+
+def make_corpus(n_documents, seed=0):
+    """
+    Synthetic articles with a mix of paragraphs, inline markup, entities and scripts
+    """
+    rng = random.Random(seed)
+    words = ["market", "election", "Zürich", "football", "weather", "&amp;", "&#8211;", "company", "report"]
+    corpus = []
+    for i in range(n_documents):
+        paragraphs = []
+        for _ in range(rng.randint(5, 40)):
+            sentence = " ".join(rng.choice(words) for _ in range(rng.randint(10, 60)))
+            paragraphs.append(f"<p class=\"text\">{sentence} <b>{rng.choice(words)}</b> "
+                              f"<a href=\"https://example.com/{i}\">link</a>.</p>\n")
+        html = "<div>" + "".join(paragraphs) + "<script>var tracking = {};</script><!-- ad --></div>"
+        corpus.append({"metadata": {"publishedAt": "2020-04-20T10:00:00.000Z"},
+                       "content": {"title": f"Article {i}", "fullTextHtml": html}})
+    return corpus
+
+
+def timed(fn, *args, **kwargs):
+    start = time.perf_counter()
+    result = fn(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--corpus', default=None)
+    parser.add_argument('--documents', type=int, default=1000, help="Size of the synthetic corpus")
+    parser.add_argument('--processes', type=int, default=4)
+    args = parser.parse_args()
+
+    corpus = list(iter_corpus_file(args.corpus)) if args.corpus else make_corpus(args.documents)
+    html_documents = [doc['content']['fullTextHtml'] for doc in corpus if 'fullTextHtml' in doc['content']]
+    n_bytes = sum(len(html) for html in html_documents)
+    print(f"{len(html_documents)} html documents, {n_bytes / 1e6:.1f} MB")
+
+    reference, _ = timed(lambda: [extract_text(html, backend="html.parser") for html in html_documents])
+    print(f"{'backend':>12} {'time [s]':>10} {'MB/s':>8} {'identical':>10}")
+    for backend in EXTRACTION_BACKENDS:
+        texts, elapsed = timed(lambda: [extract_text(html, backend=backend) for html in html_documents])
+        identical = sum(text == ref for text, ref in zip(texts, reference))
+        print(f"{backend:>12} {elapsed:>10.3f} {n_bytes / 1e6 / elapsed:>8.1f} "
+              f"{identical:>5}/{len(reference)}")
+
+    _, serial = timed(build_documents, corpus, processes=0)
+    build_documents(corpus[:2], processes=args.processes, min_documents=0)  # start the pool
+    _, pooled = timed(build_documents, corpus, processes=args.processes, min_documents=0)
+    print(f"build_documents: serial {serial:.3f}s, {args.processes} processes {pooled:.3f}s")
+    _, serial = timed(build_corpus_texts, corpus, processes=0)
+    _, pooled = timed(build_corpus_texts, corpus, processes=args.processes, min_documents=0)
+    print(f"build_corpus_texts: serial {serial:.3f}s, {args.processes} processes {pooled:.3f}s")
+
+
+if __name__ == '__main__':
+    main()
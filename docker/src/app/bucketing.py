@@ -0,0 +1,44 @@
+def round_up(value, multiple):
+    return -(-value // multiple) * multiple
+
+
+def max_token_count(text):
+    """
+    An upper bound of the number of tokens of a text, so that texts can be bucketed without tokenizing them twice.
+    Subword tokenizers never make more tokens of a text than it has utf-8 bytes, plus one for the word boundary
+    marker that some add at its start. Unlike a count of words, the bound holds for urls, numbers, code or CJK texts,
+    so no text is truncated more than it would be without bucketing.
+
+    :param text: A raw text
+    :return: The bound, without special tokens
+    """
+    return len(text.encode("utf-8")) + 1
+
+
+def plan_batches(lengths, max_seq_len, token_budget=4096, granularity=16):
+    """
+    Group texts of similar length into batches, so that little compute is wasted on padding.
+
+    The texts are sorted by length and every batch is padded only to the length of its longest text, rounded up to
+    'granularity'. The batch size adapts to that length, so that each batch holds about 'token_budget' tokens.
+    :param lengths: The number of tokens of every text, without special tokens
+    :param max_seq_len: The maximum sequence length of the model, longer texts are truncated to it
+    :param token_budget: The number of tokens (batch size x sequence length) of a batch
+    :param granularity: Sequence lengths are rounded up to a multiple of this, to limit the number of tensor shapes
+    :return: A list of tuples (seq_len, indices), where 'indices' are the positions of the texts in the batch
+    """
+    order = sorted(range(len(lengths)), key=lengths.__getitem__)
+    batches = []
+    batch = []
+    batch_seq_len = 0
+    for i in order:
+        # 2 special tokens are added to every text, [CLS] and [SEP]
+        seq_len = min(max_seq_len, round_up(lengths[i] + 2, granularity))
+        if batch and (len(batch) + 1) * seq_len > token_budget:
+            batches.append((batch_seq_len, batch))
+            batch = []
+        batch.append(i)
+        batch_seq_len = seq_len
+    if batch:
+        batches.append((batch_seq_len, batch))
+    return batches
@@ -0,0 +1,133 @@
+"""
+How the workers of the server share the CPU.
+
+By default every worker would start as many torch threads as the machine has cores, so N workers run N x cores
+threads and oversubscribe the CPU. Instead we split the cores available to the container between the workers:
+each worker gets 'intra_op_threads' threads for the operators of the model, and optionally its own set of cores.
+"""
+import math
+import os
+
+CGROUP_V2_CPU_MAX = "/sys/fs/cgroup/cpu.max"
+CGROUP_V1_CPU_QUOTA = "/sys/fs/cgroup/cpu/cpu.cfs_quota_us"
+CGROUP_V1_CPU_PERIOD = "/sys/fs/cgroup/cpu/cpu.cfs_period_us"
+
+
+def _read_first_line(path):
+    try:
+        with open(path) as f:
+            return f.readline().strip()
+    except (FileNotFoundError, PermissionError):
+        return None
+
+
+def get_cgroup_cpu_limit():
+    """
+    :return: The number of CPUs the cgroup quota of the container allows, e.g. 2.5 for docker run --cpus 2.5,
+             or None if there is no quota
+    """
+    cpu_max = _read_first_line(CGROUP_V2_CPU_MAX)
+    if cpu_max is not None:
+        quota, _, period = cpu_max.partition(" ")
+        if quota != "max" and period:
+            return int(quota) / int(period)
+        return None
+    quota = _read_first_line(CGROUP_V1_CPU_QUOTA)
+    period = _read_first_line(CGROUP_V1_CPU_PERIOD)
+    if quota is not None and period is not None and int(quota) > 0:
+        return int(quota) / int(period)
+    return None
+
+
+def get_available_cpus():
+    """
+    :return: The ids of the CPUs this process may run on
+    """
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+
+def get_physical_cores(cpus):
+    """
+    Group hyperthreads of the same physical core.
+
+    :param cpus: CPU ids
+    :return: A list of lists of CPU ids, one per physical core
+    """
+    cores = {}
+    for cpu in cpus:
+        siblings = _read_first_line(f"/sys/devices/system/cpu/cpu{cpu}/topology/thread_siblings_list")
+        cores.setdefault(siblings or str(cpu), []).append(cpu)
+    return list(cores.values())
+
+
+def get_cpu_budget():
+    """
+    :return: How many threads the container can keep busy, i.e. the physical cores available to it,
+             capped by its cgroup CPU quota
+    """
+    budget = len(get_physical_cores(get_available_cpus()))
+    limit = get_cgroup_cpu_limit()
+    if limit is not None:
+        budget = min(budget, max(1, math.floor(limit)))
+    return max(1, budget)
+
+
+def plan_layout(workers=None, intra_op_threads=None, inter_op_threads=1, cpu_budget=None):
+    """
+    Split the CPU budget between the workers.
+
+    :param workers: The number of workers. By default as many as fit with 'intra_op_threads' each
+    :param intra_op_threads: The torch threads per worker. By default the CPU budget divided by the workers,
+                             or 2 if neither is given, which is a good trade-off between latency and throughput
+                             for BERT-sized models
+    :param inter_op_threads: The torch threads that run independent operators in parallel, per worker
+    :param cpu_budget: The number of cores to split. Defaults to get_cpu_budget()
+    :return: A dict with 'workers', 'intra_op_threads', 'inter_op_threads' and 'cpu_budget'
+    """
+    cpu_budget = cpu_budget or get_cpu_budget()
+    if workers is None and intra_op_threads is None:
+        intra_op_threads = min(2, cpu_budget)
+    if workers is None:
+        workers = max(1, cpu_budget // intra_op_threads)
+    if intra_op_threads is None:
+        intra_op_threads = max(1, cpu_budget // workers)
+    return {"workers": workers, "intra_op_threads": intra_op_threads, "inter_op_threads": inter_op_threads,
+            "cpu_budget": cpu_budget}
+
+
+def get_worker_cpus(slot, layout):
+    """
+    The CPUs a worker is pinned to: the hyperthreads of 'intra_op_threads' physical cores,
+    or all CPUs if there are not enough cores to give every worker its own.
+
+    :param slot: The index of the worker, from 0 to layout['workers'] - 1
+    :param layout: A layout from plan_layout
+    """
+    cpus = get_available_cpus()
+    cores = get_physical_cores(cpus)
+    first = slot * layout["intra_op_threads"]
+    if first + layout["intra_op_threads"] > len(cores):
+        return cpus
+    return [cpu for core in cores[first:first + layout["intra_op_threads"]] for cpu in core]
+
+
+def configure_worker(layout, slot=None, pin=False):
+    """
+    Apply a layout to the current process. Call it in every worker after the fork.
+
+    :param layout: A layout from plan_layout
+    :param slot: The index of the worker, needed to pin it
+    :param pin: Whether to pin the worker to its own cores, see get_worker_cpus
+    """
+    # torch is imported already, so setting OMP_NUM_THREADS and the like would have no effect anymore
+    import torch
+    torch.set_num_threads(layout["intra_op_threads"])
+    try:
+        torch.set_num_interop_threads(layout["inter_op_threads"])
+    except RuntimeError:
+        # the inter-op pool can only be sized once, before it is used, e.g. not if the master predicted already
+        pass
+    if pin and slot is not None and hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, get_worker_cpus(slot, layout))
@@ -0,0 +1,290 @@
+import errno
+import fcntl
+import json
+import os
+import shutil
+import subprocess
+import threading
+import time
+import uuid
+
+from streaming import iter_body, iter_chunks, iter_json_documents
+
+JOB_QUEUED = "queued"
+JOB_RUNNING = "running"
+JOB_DONE = "done"
+JOB_FAILED = "failed"
+
+
+class JobStore:
+    """
+    Spools bulk prediction jobs on disk.
+
+    Every job has its own folder under 'jobs_dir', which holds
+        1. 'input': the corpus as uploaded, a json array or NDJSON, possibly gzipped
+        2. 'status.json': the state of the job and a checkpoint of its progress
+        3. 'results.ndjson': the predictions, one line per document in the order of the corpus
+    The folder is shared by all gunicorn workers, so any worker can answer for any job. The input of a job is
+    removed once it is done, and the whole folder 'results_ttl' seconds after the job finished.
+    """
+
+    def __init__(self, jobs_dir, results_ttl=None):
+        """
+        :param jobs_dir: The folder of the jobs
+        :param results_ttl: How many seconds the results of a finished job are kept. None keeps them forever
+        """
+        self.jobs_dir = jobs_dir
+        self.results_ttl = results_ttl
+
+    def ensure_jobs_dir(self):
+        if not os.path.exists(self.jobs_dir):
+            try:
+                os.makedirs(self.jobs_dir)
+            except OSError as exc:  # Guard against race condition
+                if exc.errno != errno.EEXIST:
+                    raise
+
+    def job_dir(self, job_id):
+        return os.path.join(self.jobs_dir, job_id)
+
+    def input_path(self, job_id):
+        return os.path.join(self.job_dir(job_id), "input")
+
+    def results_path(self, job_id):
+        return os.path.join(self.job_dir(job_id), "results.ndjson")
+
+    def _status_path(self, job_id):
+        return os.path.join(self.job_dir(job_id), "status.json")
+
+    def submit(self, stream, gzipped, model_name, top_n=4, max_bytes=0):
+        """
+        Spool the corpus of a new job to disk and queue the job.
+
+        :param stream: A file-like object with the corpus, e.g. flask.request.stream
+        :param gzipped: Whether the corpus is gzipped
+        :param model_name: The model used to predict the corpus
+        :param top_n: How many labels to return per document
+        :param max_bytes: The cap on the size of the corpus as uploaded. 0 disables it
+        :return: The status of the new job
+        :raise OverflowError: If the corpus is larger than 'max_bytes'. The job is not queued then
+        """
+        job_id = uuid.uuid4().hex
+        os.makedirs(self.job_dir(job_id))
+        size = 0
+        with open(self.input_path(job_id), "wb") as f:
+            for block in iter(lambda: stream.read(1024 * 1024), b""):
+                size += len(block)
+                if max_bytes and size > max_bytes:
+                    break
+                f.write(block)
+        if max_bytes and size > max_bytes:
+            shutil.rmtree(self.job_dir(job_id), ignore_errors=True)
+            raise OverflowError(f"The corpus is larger than {max_bytes} bytes")
+
+        status = {"job_id": job_id, "state": JOB_QUEUED, "model_name": model_name, "top_n": top_n,
+                  "gzipped": gzipped, "input_bytes": os.path.getsize(self.input_path(job_id)),
+                  "input_offset": 0, "documents_done": 0, "results_offset": 0,
+                  "submitted_at": time.time(), "updated_at": time.time(), "error": None}
+        self.write_status(status)
+        return status
+
+    def write_status(self, status):
+        status["updated_at"] = time.time()
+        # write and rename, so that readers never see a partial status
+        tmp_path = self._status_path(status["job_id"]) + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(status, f)
+        os.replace(tmp_path, self._status_path(status["job_id"]))
+
+    def get_status(self, job_id):
+        """
+        :return: The status of a job, or None if there is no such job
+        """
+        # the job id becomes part of a path, so only accept what uuid4().hex produces
+        if len(job_id) != 32 or any(c not in "0123456789abcdef" for c in job_id):
+            return None
+        try:
+            with open(self._status_path(job_id)) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def list_pending(self):
+        """
+        :return: The statuses of the queued or interrupted jobs, oldest first
+        """
+        if not os.path.exists(self.jobs_dir):
+            return []
+        pending = []
+        for job_id in os.listdir(self.jobs_dir):
+            status = self.get_status(job_id)
+            if status is not None and status["state"] in (JOB_QUEUED, JOB_RUNNING):
+                pending.append(status)
+        return sorted(pending, key=lambda s: s["submitted_at"])
+
+    def remove_expired(self):
+        """
+        Remove the jobs that finished more than 'results_ttl' seconds ago, and the uploads that never became a job
+
+        :return: The ids of the removed jobs
+        """
+        if self.results_ttl is None or not os.path.exists(self.jobs_dir):
+            return []
+        expired_before = time.time() - self.results_ttl
+        removed = []
+        for job_id in os.listdir(self.jobs_dir):
+            job_dir = self.job_dir(job_id)
+            if not os.path.isdir(job_dir):
+                continue
+            status = self.get_status(job_id)
+            if status is None:
+                # an upload that failed before its status was written
+                try:
+                    expired = os.path.getmtime(job_dir) < expired_before
+                except FileNotFoundError:
+                    continue
+            else:
+                expired = status["state"] in (JOB_DONE, JOB_FAILED) and status["updated_at"] < expired_before
+            if expired:
+                shutil.rmtree(job_dir, ignore_errors=True)
+                removed.append(job_id)
+        return removed
+
+
+class _CountingReader:
+    """
+    Wraps a file and counts the bytes read from it, so that we can report the progress of a job
+    """
+
+    def __init__(self, f):
+        self.f = f
+        self.offset = 0
+
+    def read(self, size=-1):
+        data = self.f.read(size)
+        self.offset += len(data)
+        return data
+
+
+class JobRunner:
+    """
+    Works through the queued jobs of a JobStore, one at a time.
+
+    The corpus of a job is predicted in chunks. After every chunk the results are flushed to the spool file and
+    the progress is checkpointed, so that a restarted runner resumes a job where it stopped.
+    Only one runner can be active per JobStore, the others wait on a file lock.
+    """
+
+    def __init__(self, store, predict_fn, chunk_size=256, poll_interval=2.0, logger=None):
+        """
+        :param store: The JobStore
+        :param predict_fn: A function (model_name, json_documents, top_n) -> list of predictions, one per document
+        :param chunk_size: How many documents to predict between two checkpoints
+        :param poll_interval: How many seconds to wait before looking for new jobs
+        :param logger: A logger
+        """
+        self.store = store
+        self.predict_fn = predict_fn
+        self.chunk_size = chunk_size
+        self.poll_interval = poll_interval
+        self.logger = logger
+
+    def run_forever(self):
+        self.store.ensure_jobs_dir()
+        with open(os.path.join(self.store.jobs_dir, "runner.lock"), "w") as lock_file:
+            # blocks for as long as another runner is active
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            if self.logger:
+                self.logger.info(f"Job runner {os.getpid()} is active")
+            while True:
+                removed = self.store.remove_expired()
+                if removed and self.logger:
+                    self.logger.info(f"Removed {len(removed)} expired jobs")
+                pending = self.store.list_pending()
+                if not pending:
+                    time.sleep(self.poll_interval)
+                    continue
+                self.run_job(pending[0])
+
+    def run_job(self, status):
+        job_id = status["job_id"]
+        if self.logger:
+            self.logger.info(f"Running job {job_id}, resuming after {status['documents_done']} documents")
+        status["state"] = JOB_RUNNING
+        self.store.write_status(status)
+        try:
+            results_path = self.store.results_path(job_id)
+            if not os.path.exists(results_path):
+                open(results_path, "wb").close()
+            with open(self.store.input_path(job_id), "rb") as input_file, open(results_path, "r+b") as results_file:
+                # drop the results written after the last checkpoint
+                results_file.truncate(status["results_offset"])
+                results_file.seek(status["results_offset"])
+                reader = _CountingReader(input_file)
+                documents = iter_json_documents(iter_body(reader, gzipped=status["gzipped"]))
+                for i, chunk in enumerate(iter_chunks(documents, self.chunk_size)):
+                    if (i + 1) * self.chunk_size <= status["documents_done"]:
+                        # predicted before the restart
+                        continue
+                    skip = max(0, status["documents_done"] - i * self.chunk_size)
+                    predictions = self.predict_fn(status["model_name"], chunk[skip:], status["top_n"])
+                    results_file.write("".join(json.dumps(p) + "\n" for p in predictions).encode("utf-8"))
+                    results_file.flush()
+                    os.fsync(results_file.fileno())
+
+                    status["documents_done"] += len(predictions)
+                    status["results_offset"] = results_file.tell()
+                    status["input_offset"] = reader.offset
+                    self.store.write_status(status)
+            status["state"] = JOB_DONE
+            status["input_offset"] = status["input_bytes"]
+            # the corpus is not needed anymore once all its documents are predicted
+            os.remove(self.store.input_path(job_id))
+        except Exception as ex:
+            if self.logger:
+                self.logger.error(f"Job {job_id} failed: {ex}")
+            status["state"] = JOB_FAILED
+            status["error"] = str(ex)
+        self.store.write_status(status)
+
+
+class JobRunnerSupervisor:
+    """
+    Runs the job runner in a process of its own next to the server, and restarts it whenever it exits.
+
+    The runner is started as a new interpreter, by a thread of the gunicorn master. Since the master reaps all of
+    its children, a forked multiprocessing.Process would never be seen to exit. Popen.wait returns either way.
+    """
+
+    def __init__(self, command, restart_delay=5.0, logger=None):
+        """
+        :param command: The command line of the job runner
+        :param restart_delay: How many seconds to wait before the runner is restarted
+        :param logger: A logger
+        """
+        self.command = command
+        self.restart_delay = restart_delay
+        self.logger = logger
+        self.process = None
+        self._stopped = threading.Event()
+
+    def start(self):
+        threading.Thread(target=self._run, name="job-runner-supervisor", daemon=True).start()
+
+    def stop(self):
+        self._stopped.set()
+        if self.process is not None and self.process.poll() is None:
+            self.process.terminate()
+
+    def _run(self):
+        while not self._stopped.is_set():
+            self.process = subprocess.Popen(self.command)
+            if self.logger:
+                self.logger.info(f"Started the job runner {self.process.pid}")
+            returncode = self.process.wait()
+            if self._stopped.is_set():
+                return
+            if self.logger:
+                self.logger.error(f"The job runner {self.process.pid} exited with {returncode}, "
+                                  f"restarting it in {self.restart_delay}s")
+            self._stopped.wait(self.restart_delay)
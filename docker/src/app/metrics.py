@@ -0,0 +1,127 @@
+"""
+Prometheus metrics of the prediction server.
+
+With gunicorn every worker is its own process, so by default /metrics would only report the worker that happens to
+serve it. Set the environmental variable PROMETHEUS_MULTIPROC_DIR to a folder, e.g. /app/metrics, and every process
+writes its metrics to memory-mapped files in that folder, which /metrics aggregates across all workers.
+The variable must be set before this module is imported.
+"""
+import errno
+import os
+import shutil
+import time
+
+from contextlib import contextmanager
+from prometheus_client import CONTENT_TYPE_LATEST, CollectorRegistry, Counter, Gauge, Histogram, generate_latest
+from prometheus_client import REGISTRY, multiprocess
+
+MULTIPROC_DIR = os.environ.get('PROMETHEUS_MULTIPROC_DIR')
+
+if MULTIPROC_DIR and not os.path.exists(MULTIPROC_DIR):
+    try:
+        os.makedirs(MULTIPROC_DIR)
+    except OSError as exc:  # Guard against race condition
+        if exc.errno != errno.EEXIST:
+            raise
+
+# all metrics have labels, so that no process writes metric files before it observes something
+REQUEST_SECONDS = Histogram('request_duration_seconds', 'Time to serve a request',
+                            ['endpoint'],
+                            buckets=(.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60, 300))
+STAGE_SECONDS = Histogram('stage_duration_seconds', 'Time spent in a stage of serving a request',
+                          ['endpoint', 'stage'],
+                          buckets=(.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60))
+REQUEST_DOCUMENTS = Histogram('request_documents', 'Documents per request',
+                              ['endpoint'],
+                              buckets=(1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000))
+REQUEST_BYTES = Histogram('request_bytes', 'Size of the request body as sent, i.e. possibly gzipped',
+                          ['endpoint'],
+                          buckets=(1e3, 1e4, 1e5, 1e6, 1e7, 1e8, 1e9))
+RESPONSE_BYTES = Histogram('response_bytes', 'Size of the response body as sent, i.e. possibly gzipped',
+                           ['endpoint'],
+                           buckets=(1e2, 1e3, 1e4, 1e5, 1e6, 1e7, 1e8))
+REQUESTS = Counter('requests', 'Served requests', ['endpoint', 'status'])
+STARTUP_SECONDS = Gauge('startup_phase_seconds', 'Time spent in a phase of the server startup',
+                        ['phase'], multiprocess_mode='max')
+
+
+def _current_endpoint():
+    """
+    The Flask endpoint of the request being served, or 'background' outside of a request, e.g. in the job runner
+    """
+    from flask import has_request_context, request
+    if has_request_context() and request.endpoint is not None:
+        return request.endpoint
+    return 'background'
+
+
+@contextmanager
+def timed(stage, endpoint=None):
+    """
+    Time a block of code as a stage of the current request, e.g.
+
+        with timed("inference"):
+            model.predict_proba(texts)
+
+    :param stage: The name of the stage
+    :param endpoint: The endpoint to account the stage to. Defaults to the endpoint of the current Flask request
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        STAGE_SECONDS.labels(endpoint or _current_endpoint(), stage).observe(time.perf_counter() - start)
+
+
+def observe_request(endpoint, status, seconds, request_bytes=None, response_bytes=None, documents=None):
+    REQUESTS.labels(endpoint, str(status)).inc()
+    REQUEST_SECONDS.labels(endpoint).observe(seconds)
+    if request_bytes is not None:
+        REQUEST_BYTES.labels(endpoint).observe(request_bytes)
+    if response_bytes is not None:
+        RESPONSE_BYTES.labels(endpoint).observe(response_bytes)
+    if documents is not None:
+        REQUEST_DOCUMENTS.labels(endpoint).observe(documents)
+
+
+def observe_startup(timings):
+    """
+    :param timings: A dict with the seconds spent in every phase of the startup
+    """
+    for phase, seconds in timings.items():
+        STARTUP_SECONDS.labels(phase).set(seconds)
+
+
+def clear_multiprocess_dir():
+    """
+    Remove the metric files of earlier runs. Call it once in the gunicorn master, before the workers are forked.
+    """
+    if not MULTIPROC_DIR:
+        return
+    for name in os.listdir(MULTIPROC_DIR):
+        path = os.path.join(MULTIPROC_DIR, name)
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        else:
+            os.remove(path)
+
+
+def mark_process_dead(pid):
+    """
+    Drop the live gauges of a dead worker. Histograms and counters of the worker are kept.
+    """
+    if MULTIPROC_DIR:
+        multiprocess.mark_process_dead(pid)
+
+
+def render_metrics():
+    """
+    :return: The metrics in the Prometheus text format, aggregated across all processes in multiprocess mode,
+             and their content type
+    """
+    if MULTIPROC_DIR:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
@@ -0,0 +1,231 @@
+import errno
+import fcntl
+import json
+import os
+import re
+import threading
+import time
+
+# model names become part of paths, so we only accept plain names
+MODEL_NAME_PATTERN = re.compile(r"^[A-Za-z0-9_][A-Za-z0-9_.\-]*$")
+WARM_UP_TEXTS = ["The markets rallied after the central bank kept interest rates unchanged.",
+                 "Der FC Zürich gewann das Spiel am Sonntag mit 2:1."]
+
+
+def is_valid_model_name(model_name):
+    return isinstance(model_name, str) and MODEL_NAME_PATTERN.match(model_name) is not None
+
+
+class ActiveModelState:
+    """
+    The active model of the server, shared by all gunicorn workers through a small json file in 'state_dir':
+
+        {"active": <model name>, "staged": <model name being swapped in, or null>,
+         "staged_version": <the version of the staged model, or null for the one on disk already>,
+         "version": <int>, "error": <why the last swap failed, or null>, "updated_at": <timestamp>}
+
+    Every worker that has loaded the staged model leaves a marker in <state_dir>/ready/<model name>/<pid>.
+    Reading the state only stats the file, unless it changed, so it is cheap enough to do on every request.
+    """
+
+    def __init__(self, state_dir):
+        self.state_dir = state_dir
+        self.path = os.path.join(state_dir, "active_model.json")
+        self._cached = None
+        self._cached_stat = None
+
+    def _default_state(self):
+        return {"active": None, "staged": None, "staged_version": None, "version": 0, "error": None,
+                "updated_at": None}
+
+    def read(self):
+        """
+        :return: The current state
+        """
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            return self._default_state()
+        if self._cached_stat != (st.st_mtime_ns, st.st_ino):
+            with open(self.path) as f:
+                self._cached = json.load(f)
+            self._cached_stat = (st.st_mtime_ns, st.st_ino)
+        return self._cached
+
+    def update(self, **changes):
+        """
+        Change the state atomically, with respect to the other workers.
+
+        :return: The new state
+        """
+        if not os.path.exists(self.state_dir):
+            try:
+                os.makedirs(self.state_dir)
+            except OSError as exc:  # Guard against race condition
+                if exc.errno != errno.EEXIST:
+                    raise
+        with open(self.path + ".lock", "w") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            state = dict(self.read())
+            state.update(changes)
+            state["version"] += 1
+            state["updated_at"] = time.time()
+            # write and rename, so that readers never see a partial state
+            with open(self.path + ".tmp", "w") as f:
+                json.dump(state, f)
+            os.replace(self.path + ".tmp", self.path)
+        return state
+
+    def _ready_dir(self, model_name):
+        return os.path.join(self.state_dir, "ready", model_name)
+
+    def mark_ready(self, model_name, pid):
+        ready_dir = self._ready_dir(model_name)
+        if not os.path.exists(ready_dir):
+            try:
+                os.makedirs(ready_dir)
+            except OSError as exc:  # Guard against race condition
+                if exc.errno != errno.EEXIST:
+                    raise
+        open(os.path.join(ready_dir, str(pid)), "w").close()
+
+    def is_ready(self, model_name, pid):
+        return os.path.exists(os.path.join(self._ready_dir(model_name), str(pid)))
+
+    def ready_workers(self, model_name):
+        """
+        :return: The pids of the live processes that have loaded a model
+        """
+        try:
+            pids = [int(name) for name in os.listdir(self._ready_dir(model_name))]
+        except FileNotFoundError:
+            return []
+        live = []
+        for pid in pids:
+            try:
+                os.kill(pid, 0)
+                live.append(pid)
+            except ProcessLookupError:
+                pass
+            except PermissionError:
+                live.append(pid)
+        return live
+
+    def clear_ready(self, model_name):
+        ready_dir = self._ready_dir(model_name)
+        if os.path.exists(ready_dir):
+            for name in os.listdir(ready_dir):
+                os.remove(os.path.join(ready_dir, name))
+
+    def reset(self, active):
+        """
+        Start from a clean state with the given active model, e.g. when the server starts
+        """
+        ready_root = os.path.join(self.state_dir, "ready")
+        if os.path.exists(ready_root):
+            for model_name in os.listdir(ready_root):
+                self.clear_ready(model_name)
+        return self.update(active=active, staged=None, staged_version=None, error=None)
+
+
+def warm_up(model, rounds=2):
+    """
+    Run a few inferences, so that the first requests do not pay for lazy initialization
+    """
+    for _ in range(rounds):
+        model.run_inference(WARM_UP_TEXTS)
+
+
+class ModelSwapWatcher:
+    """
+    Loads and warms up the model staged for a swap in the background of every worker.
+
+    A thread is started lazily in every process that calls 'ensure_started', since threads do not survive a fork.
+    It polls the ActiveModelState and, when a model is staged that this process has not loaded yet, loads it into
+    the registry, warms it up and marks this process as ready. Requests keep being served by the active model
+    meanwhile.
+    """
+
+    def __init__(self, state, load_fn, poll_interval=1.0, logger=None):
+        """
+        :param state: The ActiveModelState
+        :param load_fn: A function (model_name, version) -> LoadedModel that loads a version of a model into
+                        the registry of this process
+        :param poll_interval: How many seconds to wait between two looks at the state
+        :param logger: A logger
+        """
+        self.state = state
+        self.load_fn = load_fn
+        self.poll_interval = poll_interval
+        self.logger = logger
+        self._lock = threading.Lock()
+        self._pid = None
+
+    def ensure_started(self):
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid != os.getpid():
+                self._pid = os.getpid()
+                threading.Thread(target=self._run, name="model-swap-watcher", daemon=True).start()
+
+    def _run(self):
+        pid = os.getpid()
+        while True:
+            try:
+                state = self.state.read()
+                staged = state["staged"]
+                if staged is not None and not self.state.is_ready(staged, pid):
+                    if self.logger:
+                        self.logger.info(f"Loading the staged model {staged}")
+                    warm_up(self.load_fn(staged, state.get("staged_version")))
+                    self.state.mark_ready(staged, pid)
+                    if self.logger:
+                        self.logger.info(f"The staged model {staged} is ready")
+            except Exception as ex:
+                if self.logger:
+                    self.logger.error(f"Could not load the staged model: {ex}")
+            time.sleep(self.poll_interval)
+
+
+def swap_model(state, model_name, expected_workers, prepare_fn=None, activate_fn=None, timeout=600,
+               poll_interval=1.0, logger=None):
+    """
+    Swap the active model of all workers, without interrupting the requests being served.
+
+    The model is staged, then every worker loads and warms it up in the background (see ModelSwapWatcher).
+    Once all workers are ready, the new model is activated at once, and requests started after that use it.
+    If not all workers are ready within 'timeout' seconds, the swap is abandoned and the active model stays.
+
+    :param state: The ActiveModelState
+    :param model_name: The model to activate
+    :param expected_workers: How many workers must have loaded the model before it is activated
+    :param prepare_fn: A function called before the model is staged, e.g. to download and extract it.
+                       It returns the version of the model to stage, or None for the version on disk already
+    :param activate_fn: A function (version) called before the staged version is activated, e.g. to make it
+                        the version on disk, see artifacts.ModelArtifactCache.activate
+    :param timeout: How many seconds to wait for the workers
+    :param poll_interval: How many seconds to wait between two looks at the workers
+    :param logger: A logger
+    :return: The final state
+    """
+    try:
+        version = prepare_fn() if prepare_fn is not None else None
+        # a worker may have loaded the model in an earlier swap and evicted it since
+        state.clear_ready(model_name)
+        state.update(staged=model_name, staged_version=version, error=None)
+        deadline = time.time() + timeout
+        while len(state.ready_workers(model_name)) < expected_workers:
+            if time.time() > deadline:
+                raise TimeoutError(f"Only {len(state.ready_workers(model_name))} of {expected_workers} workers "
+                                   f"loaded {model_name} within {timeout}s")
+            time.sleep(poll_interval)
+        if logger:
+            logger.info(f"Activating the model {model_name}")
+        if activate_fn is not None and version is not None:
+            activate_fn(version)
+        return state.update(active=model_name, staged=None, staged_version=None)
+    except Exception as ex:
+        if logger:
+            logger.error(f"The swap to {model_name} failed: {ex}")
+        return state.update(staged=None, staged_version=None, error=f"{type(ex).__name__}: {ex}")
@@ -0,0 +1,311 @@
+import gc
+import numpy as np
+import os
+import threading
+
+from collections import OrderedDict
+from batching import MicroBatcher
+from bucketing import max_token_count, plan_batches
+from quantization import quantize_inferencer
+from tokenization import FastTokenizer, load_fast_tokenizer, run_model
+
+# the trained models are downloaded and extracted in this folder
+MODELS_DIR = "/app/trained_models"
+
+
+def get_model_path(model_name, version=None):
+    """
+    Get the local path of a trained FARM model, as extracted from the downloaded model archive.
+
+    :param model_name: The name of the trained model artifact
+    :param version: A version extracted by artifacts.ModelArtifactCache, or None for the active version
+    :return: The path to the FARM model
+    """
+    model_dir = os.path.join(MODELS_DIR, model_name) if version is None else \
+        os.path.join(MODELS_DIR, ".versions", model_name, version)
+    return os.path.join(model_dir, "content/trained_models", model_name)
+
+
+def get_model_version(model_path):
+    """
+    :param model_path: A path returned by get_model_path
+    :return: The checksum of the archive the model was extracted from, or None if it is unknown
+    """
+    model_dir = os.path.join(os.path.realpath(model_path), os.pardir, os.pardir, os.pardir)
+    try:
+        with open(os.path.join(os.path.normpath(model_dir), ".archive.sha256")) as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+
+def get_rss_mb():
+    """
+    The resident memory of this process, or 0 where /proc is not available
+    """
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 1e6
+    except (OSError, ValueError):
+        return 0.0
+
+
+def load_measured(load_fn):
+    """
+    :param load_fn: A function that loads a model
+    :return: A tuple (the result of load_fn, how much the resident memory of the process grew in MB)
+    """
+    rss_before = get_rss_mb()
+    result = load_fn()
+    # e.g. the fp32 weights replaced by quantization are only given back once they are collected
+    gc.collect()
+    return result, max(0.0, get_rss_mb() - rss_before)
+
+
+def load_farm_inferencer(model_path, num_processes=0):
+    """
+    Load a trained FARM model for text classification.
+    """
+    # FARM is imported here, so that the registry can be used with other loaders where FARM is not installed
+    from farm.infer import Inferencer
+    return Inferencer.load(model_path, task_type="text_classification", num_processes=num_processes)
+
+
+class LoadedModel:
+    """
+    A FARM Inferencer that is resident in memory, together with the processed label list used for training.
+    """
+
+    def __init__(self, model_path, inferencer, batcher_options=None, bucketing_options=None, quantized=False,
+                 memory_mb=0.0, tokenization_options=None, version=None):
+        self.model_path = model_path
+        # the checksum of the archive the model was extracted from, see get_model_version
+        self.version = version
+        # how much the resident memory of the process grew when the model was loaded
+        self.memory_mb = memory_mb
+        self.quantized = quantized
+        self.name = os.path.basename(os.path.normpath(model_path)) + ("@int8" if quantized else "")
+        # keys the prediction cache, so that the predictions of a quantized model, or of another version of the
+        # model, are cached separately
+        self.cache_name = self.name if version is None else f"{self.name}@{version[:16]}"
+        self.inferencer = inferencer
+        # the Inferencer is not thread-safe once we change its batch size and sequence length,
+        # and concurrent inference calls would only compete for the same cores anyway
+        self._inference_lock = threading.Lock()
+        # optionally bucket the texts by length, see bucketing.plan_batches
+        self.bucketing_options = bucketing_options
+        # optionally tokenize the texts ourselves and feed the input ids to the model, see tokenization.py
+        processor = inferencer.processor
+        self.max_seq_len = processor.max_seq_len
+        self.fast_tokenizer = None
+        if tokenization_options is not None:
+            self.fast_tokenizer = FastTokenizer(load_fast_tokenizer(processor.tokenizer, model_path),
+                                                processor.max_seq_len, **tokenization_options)
+        # optionally batch the texts of concurrent requests before they reach the Inferencer
+        self.batcher = None
+        if batcher_options is not None:
+            self.batcher = MicroBatcher(self.run_inference, **batcher_options)
+        # get the labels used for training from the FARM Processor
+        label_list = inferencer.processor.tasks['text_classification']['label_list']
+        # rename the labels to their original format, i.e replace "-" with ","
+        self.label_list = [label.replace("-", ",") for label in label_list]
+        # used to map the ranked label indices back to label names
+        self.label_array = np.array(self.label_list, dtype=object)
+
+    def predict_proba(self, texts, deadline=None):
+        """
+        Predict a list of texts, possibly batched together with the texts of concurrent requests.
+
+        :param texts: A list of raw texts
+        :param deadline: The unix timestamp by which the predictions are needed, see MicroBatcher.predict
+        :return: A list with the predicted probabilities over self.label_list, one entry per text
+        """
+        if self.batcher is not None:
+            return self.batcher.predict(texts, deadline=deadline)
+        return self.run_inference(texts)
+
+    def run_inference(self, texts):
+        """
+        Run inference on a list of texts, in a single call to the Inferencer or in length-bucketed batches.
+
+        :param texts: A list of raw texts
+        :return: A list with the predicted probabilities over self.label_list, one entry per text
+        """
+        if self.fast_tokenizer is not None:
+            # tokenized before we take the lock, so that it overlaps with the inference of other threads
+            input_ids = self.fast_tokenizer.encode(texts)
+            with self._inference_lock:
+                return self._infer_token_ids(input_ids)
+        with self._inference_lock:
+            if self.bucketing_options is None or len(texts) < 2:
+                return self._infer(texts)
+            return self._infer_bucketed(texts)
+
+    @property
+    def vocab_size(self):
+        return len(self.inferencer.processor.tokenizer)
+
+    def predict_token_ids(self, input_ids):
+        """
+        Predict pre-tokenized texts, skipping the tokenization altogether.
+
+        :param input_ids: A list with the input ids of every text, including the special tokens,
+                          as produced by the tokenizer of the model
+        :return: A list with the predicted probabilities over self.label_list, one entry per text
+        """
+        with self._inference_lock:
+            return self._infer_token_ids(input_ids)
+
+    def _infer_token_ids(self, input_ids):
+        if hasattr(self.inferencer, 'predict_token_ids'):
+            # e.g. the stub inferencer
+            return self.inferencer.predict_token_ids(input_ids)
+        token_budget = (self.bucketing_options or {}).get('token_budget', 4096)
+        return run_model(self.inferencer.model, input_ids,
+                         pad_id=self.inferencer.processor.tokenizer.pad_token_id or 0, token_budget=token_budget)
+
+    def _infer(self, texts):
+        result = self.inferencer.inference_from_dicts([{"text": text} for text in texts])
+        # FARM returns one entry per inference batch, so we flatten the predictions of all batches
+        return [pred['probability'] for inference_sample in result for pred in inference_sample['predictions']]
+
+    def _infer_bucketed(self, texts):
+        processor = self.inferencer.processor
+        max_seq_len = processor.max_seq_len
+        batch_size = self.inferencer.batch_size
+        # FARM pads every text to the max_seq_len of the Processor, so we lower it for the batches of short texts.
+        # The texts are tokenized by FARM anyway, so we bound their lengths instead, see max_token_count.
+        # FAST_TOKENIZATION buckets the texts by their exact lengths
+        lengths = [min(max_token_count(text), max_seq_len) for text in texts]
+        probabilities = [None] * len(texts)
+        try:
+            for seq_len, indices in plan_batches(lengths, max_seq_len, **self.bucketing_options):
+                processor.max_seq_len = seq_len
+                self.inferencer.batch_size = len(indices)
+                for i, proba in zip(indices, self._infer([texts[i] for i in indices])):
+                    probabilities[i] = proba
+        finally:
+            processor.max_seq_len = max_seq_len
+            self.inferencer.batch_size = batch_size
+        return probabilities
+
+    def close(self):
+        if self.batcher is not None:
+            self.batcher.close()
+
+
+class ModelRegistry:
+    """
+    Keeps the loaded models of a process, keyed by the real path of the model. Since every version of a model is
+    extracted into a folder of its own, see artifacts.ModelArtifactCache, a new version is loaded next to the old one.
+
+    A model is loaded at most once and then served from memory. When more than 'max_models' models are loaded,
+    or the loaded models take more than 'max_memory_mb', the least recently used ones are evicted.
+    Loading a model does not block the requests for the models that are loaded already.
+    If a model is loaded in the gunicorn master before the workers are forked, all workers share it copy-on-write.
+    """
+
+    def __init__(self, max_models=2, num_processes=0, batcher_options=None, bucketing_options=None, loader=None,
+                 quantized_models=None, max_memory_mb=None, tokenization_options=None):
+        """
+        :param max_models: The maximum number of models kept in memory
+        :param num_processes: Passed on to the loader. The default of 0 disables FARM's multiprocessing pool,
+                              since we already run several gunicorn workers
+        :param batcher_options: If given, a dict with the keyword arguments of a MicroBatcher that batches
+                                the texts of concurrent requests for each loaded model
+        :param bucketing_options: If given, a dict with the keyword arguments of bucketing.plan_batches,
+                                  used to predict texts in batches of similar length
+        :param loader: A function (model_path, num_processes) -> Inferencer. Defaults to load_farm_inferencer
+        :param quantized_models: The names of the models to quantize to int8 at load time, see quantize_inferencer
+        :param max_memory_mb: If given, the memory budget of the loaded models. The model loaded last is always kept
+        :param tokenization_options: If given, a dict with the keyword arguments of a FastTokenizer, which then
+                                     tokenizes the texts of every loaded model instead of the FARM Processor
+        """
+        if max_models < 1:
+            raise ValueError("ModelRegistry::max_models must be at least 1")
+        self.max_models = max_models
+        self.num_processes = num_processes
+        self.batcher_options = batcher_options
+        self.bucketing_options = bucketing_options
+        self.loader = loader or load_farm_inferencer
+        self.quantized_models = set(quantized_models or [])
+        self.max_memory_mb = max_memory_mb
+        self.tokenization_options = tokenization_options
+        self._models = OrderedDict()
+        self._lock = threading.Lock()
+        # one lock per model being loaded, so that a model is loaded only once
+        self._loading = {}
+
+    def __contains__(self, model_path):
+        return os.path.realpath(model_path) in self._models
+
+    def __len__(self):
+        return len(self._models)
+
+    def loaded_models(self):
+        """
+        :return: The loaded models, least recently used first
+        """
+        with self._lock:
+            return list(self._models.values())
+
+    def get(self, model_path):
+        """
+        Get a loaded model. The model is loaded from disk if it is not resident yet.
+
+        :param model_path: A path to a locally stored FARM model
+        :return: A LoadedModel
+        """
+        model_path = os.path.realpath(model_path)
+        with self._lock:
+            model = self._models.get(model_path)
+            if model is not None:
+                self._models.move_to_end(model_path)
+                return model
+            loading_lock = self._loading.setdefault(model_path, threading.Lock())
+
+        with loading_lock:
+            with self._lock:
+                model = self._models.get(model_path)
+            if model is not None:
+                # loaded by another thread while we waited
+                return model
+
+            quantized = os.path.basename(os.path.normpath(model_path)) in self.quantized_models
+            inferencer, memory_mb = load_measured(lambda: self._load_inferencer(model_path, quantized))
+            model = LoadedModel(model_path, inferencer, batcher_options=self.batcher_options,
+                                bucketing_options=self.bucketing_options, quantized=quantized,
+                                memory_mb=memory_mb,
+                                tokenization_options=self.tokenization_options,
+                                version=get_model_version(model_path))
+
+            evicted = []
+            with self._lock:
+                self._models[model_path] = model
+                self._loading.pop(model_path, None)
+                # evict the least recently used models
+                while len(self._models) > 1 and (len(self._models) > self.max_models or self._over_budget()):
+                    evicted.append(self._models.popitem(last=False)[1])
+            for m in evicted:
+                m.close()
+            return model
+
+    def _load_inferencer(self, model_path, quantized):
+        inferencer = self.loader(model_path, num_processes=self.num_processes)
+        if quantized:
+            quantize_inferencer(inferencer)
+        return inferencer
+
+    def _over_budget(self):
+        return self.max_memory_mb is not None and \
+            sum(m.memory_mb for m in self._models.values()) > self.max_memory_mb
+
+    def evict(self, model_path):
+        """
+        Remove a model from the registry. Requests in flight that hold a reference to it still get their predictions:
+        its micro-batcher serves the texts queued so far before it stops, and later texts are predicted unbatched.
+        """
+        with self._lock:
+            model = self._models.pop(os.path.realpath(model_path), None)
+        if model is not None:
+            model.close()
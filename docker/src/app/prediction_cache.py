@@ -0,0 +1,137 @@
+import errno
+import hashlib
+import numpy as np
+import os
+import sqlite3
+import threading
+
+from collections import OrderedDict
+
+
+class PredictionCache:
+    """
+    Caches the predicted probabilities of texts, so that documents we have seen before are not predicted again.
+
+    Entries are keyed by a hash of the model name and the text of the Document. They hold the full probability
+    vector, so any number of top labels can be served from them.
+    There are two tiers:
+        1. An in-process LRU cache of at most 'max_entries' entries
+        2. An optional SQLite database on disk, shared by all gunicorn workers, of at most 'max_db_entries' entries.
+           Beyond that, the entries written first are deleted
+    The predictions of several models can be cached side by side, the least recently used entries are evicted first.
+    """
+
+    def __init__(self, max_entries=10000, db_path=None, max_db_entries=1000000):
+        """
+        :param max_entries: The size of the in-process tier
+        :param db_path: The path of the SQLite database of the on-disk tier. None disables the on-disk tier
+        :param max_db_entries: The size of the on-disk tier
+        """
+        self.max_entries = max_entries
+        self.db_path = db_path
+        self.max_db_entries = max_db_entries
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._connection = None
+        self._connection_pid = None
+
+    @staticmethod
+    def get_key(model_name, text):
+        return hashlib.sha1((model_name + "\0" + text).encode("utf-8")).hexdigest()
+
+    def _get_connection(self):
+        # sqlite connections must not be shared across a fork, so every worker opens its own one
+        if self._connection is None or self._connection_pid != os.getpid():
+            db_dir = os.path.dirname(self.db_path)
+            if db_dir and not os.path.exists(db_dir):
+                try:
+                    os.makedirs(db_dir)
+                except OSError as exc:  # Guard against race condition
+                    if exc.errno != errno.EEXIST:
+                        raise
+            connection = sqlite3.connect(self.db_path, timeout=30, check_same_thread=False,
+                                         isolation_level=None)
+            # WAL lets the workers read while another one writes
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            connection.execute("CREATE TABLE IF NOT EXISTS predictions "
+                               "(key TEXT PRIMARY KEY, model TEXT, dtype TEXT, probability BLOB)")
+            self._connection = connection
+            self._connection_pid = os.getpid()
+        return self._connection
+
+    def _remember(self, key, probability):
+        self._entries[key] = probability
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def get_many(self, model_name, texts):
+        """
+        Look up the cached predictions of a model for a list of texts.
+
+        :param model_name: The name of the model
+        :param texts: A list of texts
+        :return: A list with the cached probability vector of every text, or None for the texts not in the cache
+        """
+        keys = [self.get_key(model_name, text) for text in texts]
+        probabilities = [None] * len(texts)
+        with self._lock:
+            disk_keys = []
+            for i, key in enumerate(keys):
+                probability = self._entries.get(key)
+                if probability is not None:
+                    self._entries.move_to_end(key)
+                    probabilities[i] = probability
+                    self.hits += 1
+                else:
+                    disk_keys.append(i)
+
+            if disk_keys and self.db_path is not None:
+                connection = self._get_connection()
+                # look up in batches, sqlite limits the number of query parameters
+                for start in range(0, len(disk_keys), 500):
+                    batch = disk_keys[start:start + 500]
+                    rows = connection.execute(
+                        "SELECT key, dtype, probability FROM predictions WHERE key IN (%s)" %
+                        ",".join("?" * len(batch)), [keys[i] for i in batch]).fetchall()
+                    found = {key: np.frombuffer(blob, dtype=dtype) for key, dtype, blob in rows}
+                    for i in batch:
+                        probability = found.get(keys[i])
+                        if probability is not None:
+                            probabilities[i] = probability
+                            self._remember(keys[i], probability)
+                            self.disk_hits += 1
+
+            self.misses += sum(probability is None for probability in probabilities)
+        return probabilities
+
+    def put_many(self, model_name, texts, probabilities):
+        """
+        Cache the predictions of a model for a list of texts.
+        """
+        entries = [(self.get_key(model_name, text), np.asarray(probability))
+                   for text, probability in zip(texts, probabilities)]
+        with self._lock:
+            for key, probability in entries:
+                self._remember(key, probability)
+            if self.db_path is not None:
+                connection = self._get_connection()
+                connection.executemany(
+                    "INSERT OR REPLACE INTO predictions (key, model, dtype, probability) VALUES (?, ?, ?, ?)",
+                    [(key, model_name, probability.dtype.str, probability.tobytes())
+                     for key, probability in entries])
+                # every insert takes a rowid above all others, a replaced entry included, so the entries beyond
+                # the newest 'max_db_entries' have the lowest rowids
+                connection.execute("DELETE FROM predictions WHERE rowid <= (SELECT MAX(rowid) FROM predictions) - ?",
+                                   (self.max_db_entries,))
+
+    def stats(self):
+        """
+        :return: The hit and miss counters of this process
+        """
+        return {"entries": len(self._entries),
+                "hits": self.hits, "disk_hits": self.disk_hits, "misses": self.misses}
@@ -0,0 +1,71 @@
+import os
+import threading
+
+from concurrent.futures import ProcessPoolExecutor
+from utils import Document, build_texts
+
+# how many processes a worker uses to build the Documents of a request. 0 disables the process pool
+PREPROCESSING_PROCESSES = int(os.environ.get('PREPROCESSING_PROCESSES', 0))
+# smaller requests are not worth the overhead of sending the documents to the pool
+PREPROCESSING_MIN_DOCUMENTS = int(os.environ.get('PREPROCESSING_MIN_DOCUMENTS', 200))
+
+_pool = None
+_pool_pid = None
+_pool_lock = threading.Lock()
+
+
+def _get_pool(processes):
+    # the pool is created lazily, so that every gunicorn worker gets its own one after the fork
+    global _pool, _pool_pid
+    with _pool_lock:
+        if _pool is None or _pool_pid != os.getpid():
+            _pool = ProcessPoolExecutor(max_workers=processes)
+            _pool_pid = os.getpid()
+        return _pool
+
+
+def _build_chunk(json_documents):
+    return [Document(doc['metadata'], doc['content']) for doc in json_documents]
+
+
+def _map_chunks(build_chunk, json_corpus, processes, min_documents):
+    processes = PREPROCESSING_PROCESSES if processes is None else processes
+    min_documents = PREPROCESSING_MIN_DOCUMENTS if min_documents is None else min_documents
+
+    if processes < 1 or len(json_corpus) < max(min_documents, 2):
+        return build_chunk(json_corpus)
+
+    # a few chunks per process, so that a chunk of long articles does not hold up the others
+    n_chunks = processes * 4
+    chunk_size = -(-len(json_corpus) // n_chunks)
+    chunks = [json_corpus[i:i + chunk_size] for i in range(0, len(json_corpus), chunk_size)]
+
+    results = []
+    for chunk_results in _get_pool(processes).map(build_chunk, chunks):
+        results.extend(chunk_results)
+    return results
+
+
+def build_documents(json_corpus, processes=None, min_documents=None):
+    """
+    Build the Documents of a parsed json corpus, as sent to /predict.
+
+    Building a Document strips the html of its content, which is expensive for long articles.
+    Large corpora are therefore split in chunks and built in a process pool.
+    :param json_corpus: A list of documents following the json schema of the challenge
+    :param processes: The size of the process pool (default PREPROCESSING_PROCESSES). 0 disables the pool
+    :param min_documents: Corpora with fewer documents are built in the current process
+                          (default PREPROCESSING_MIN_DOCUMENTS)
+    :return: A list of Documents, in the order of the corpus
+    """
+    return _map_chunks(_build_chunk, json_corpus, processes, min_documents)
+
+
+def build_corpus_texts(json_corpus, processes=None, min_documents=None):
+    """
+    Like build_documents, but only build the texts to predict, without a Document per document.
+    The pool sends back plain strings, which are also cheaper to pickle than Documents.
+
+    :return: A list of texts, in the order of the corpus
+    """
+    return _map_chunks(build_texts, json_corpus, processes, min_documents)
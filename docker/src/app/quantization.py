@@ -0,0 +1,78 @@
+import numpy as np
+import time
+
+from ranking import top_n_indices
+
+
+def quantize_inferencer(inferencer):
+    """
+    Apply dynamic int8 quantization to the linear layers of the model of a FARM Inferencer, in place.
+
+    The weights of the linear layers are stored as int8 and the activations are quantized on the fly,
+    which makes CPU inference faster and the model smaller, at the price of slightly different probabilities.
+    Use the 'validate-quantization' command to decide whether that is acceptable for a model.
+
+    :param inferencer: A FARM Inferencer
+    :return: The Inferencer
+    """
+    model = getattr(inferencer, "model", None)
+    if model is None:
+        # e.g. the stub inferencer, which has no torch model
+        return inferencer
+    import torch
+    inferencer.model = torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+    return inferencer
+
+
+def _timed_predictions(model, texts):
+    start = time.perf_counter()
+    probabilities = np.asarray(model.run_inference(texts))
+    return probabilities, time.perf_counter() - start
+
+
+def compare_models(reference, quantized, texts, top_n=4):
+    """
+    Compare the predictions of a model with those of its quantized version.
+
+    :param reference: The fp32 LoadedModel
+    :param quantized: The quantized LoadedModel
+    :param texts: A sample of raw texts
+    :param top_n: How many labels are compared per text
+    :return: A dict with
+                'top1_agreement': the fraction of texts with the same most confident label
+                'top_n_agreement': the fraction of texts with the same top N labels in the same order
+                'top_n_overlap': the mean fraction of the top N labels of the reference found in the top N of the
+                                 quantized model
+                'max_abs_proba_diff', 'mean_abs_proba_diff': the differences of the probabilities of all labels
+                'speedup': how many times faster the quantized model predicts the texts
+                'memory_reduction': how many times less resident memory the quantized model takes,
+                                    from the 'memory_mb' of both models
+    :raises ValueError: If there are no texts
+    """
+    if not texts:
+        raise ValueError("Compare the models on at least one text")
+    # warm up, so that the first call of either model does not pay for lazy initialization
+    reference.run_inference(texts[:1])
+    quantized.run_inference(texts[:1])
+    reference_proba, reference_seconds = _timed_predictions(reference, texts)
+    quantized_proba, quantized_seconds = _timed_predictions(quantized, texts)
+
+    reference_top, _ = top_n_indices(reference_proba, top_n)
+    quantized_top, _ = top_n_indices(quantized_proba, top_n)
+    overlap = [len(set(r) & set(q)) / len(r) for r, q in zip(reference_top.tolist(), quantized_top.tolist())]
+    abs_diff = np.abs(reference_proba - quantized_proba)
+
+    return {
+        "documents": len(texts),
+        "top1_agreement": float(np.mean(reference_top[:, 0] == quantized_top[:, 0])),
+        "top_n_agreement": float(np.mean(np.all(reference_top == quantized_top, axis=1))),
+        "top_n_overlap": float(np.mean(overlap)),
+        "max_abs_proba_diff": float(abs_diff.max()),
+        "mean_abs_proba_diff": float(abs_diff.mean()),
+        "reference_seconds": reference_seconds,
+        "quantized_seconds": quantized_seconds,
+        "speedup": reference_seconds / quantized_seconds,
+        "reference_memory_mb": reference.memory_mb,
+        "quantized_memory_mb": quantized.memory_mb,
+        "memory_reduction": reference.memory_mb / quantized.memory_mb if quantized.memory_mb else None,
+    }
@@ -0,0 +1,62 @@
+import numpy as np
+
+
+def top_n_indices(probabilities, top_n):
+    """
+    Find the top N most confident labels for a whole batch of predictions at once.
+
+    Instead of fully sorting every row, we partially sort with argpartition and then sort only the N selected items.
+    Ties are ranked like a stable sort would, by label index, also when they straddle the N-th place.
+    :param probabilities: A list of predicted probability vectors or a matrix of shape (n_documents, n_labels)
+    :param top_n: How many labels to return per document
+    :return: A tuple (indices, probas) of matrices of shape (n_documents, min(top_n, n_labels)),
+             holding the label indices and their probabilities ranked by decreasing confidence
+    """
+    proba_matrix = np.asarray(probabilities)
+    if proba_matrix.size == 0 and proba_matrix.ndim < 2:
+        # an empty batch
+        proba_matrix = proba_matrix.reshape(0, 0)
+    n_documents, n_labels = proba_matrix.shape
+    k = max(0, min(top_n, n_labels))
+    if k == 0:
+        candidates = np.empty((n_documents, 0), dtype=np.intp)
+    elif k < n_labels:
+        # the N-th highest probability of every document
+        kth = -np.partition(-proba_matrix, k - 1, axis=1)[:, k - 1:k]
+        above = proba_matrix > kth
+        # of the labels tied with the N-th, those with the lowest indices fill the remaining places
+        tied = proba_matrix == kth
+        selected = above | (tied & (np.cumsum(tied, axis=1) <= k - above.sum(axis=1, keepdims=True)))
+        candidates = np.nonzero(selected)[1].reshape(n_documents, k)
+    else:
+        candidates = np.broadcast_to(np.arange(n_labels), proba_matrix.shape)
+
+    candidate_probas = np.take_along_axis(proba_matrix, candidates, axis=1)
+    # the candidates are in the order of their indices, so the stable sort ranks ties by index
+    order = np.argsort(-candidate_probas, axis=1, kind='stable')
+    return np.take_along_axis(candidates, order, axis=1), np.take_along_axis(candidate_probas, order, axis=1)
+
+
+def rank_top_n(probabilities, label_array, top_n=4):
+    """
+    Rank the predictions of a batch of documents and format them as returned by the /predict* endpoints.
+
+    :param probabilities: A list of predicted probability vectors or a matrix of shape (n_documents, n_labels)
+    :param label_array: A numpy object array with the label names, in the order of the probability vectors
+    :param top_n: How many labels to return per document
+    :return: A list of lists of the format [ [doc_1], [doc_2], ..., [doc_N]],
+             where [doc_X] = [ [<predicted_label_1>, <confidence>],..., [[<predicted_label_M>, <confidence>]] ]
+    """
+    if len(probabilities) == 0:
+        return []
+    indices, probas = top_n_indices(probabilities, top_n)
+    return format_top_n(indices, probas, label_array)
+
+
+def format_top_n(indices, probas, label_array):
+    """
+    Format ranked predictions, as returned by top_n_indices, as nested lists of [<label>, <confidence>]
+    """
+    # tolist() gives python strings and floats, so the output is the same as when iterating over a pandas Series
+    return [[[label, confidence] for label, confidence in zip(labels, confidences)]
+            for labels, confidences in zip(label_array[indices].tolist(), probas.tolist())]
@@ -0,0 +1,123 @@
+"""
+The formats the /predict* endpoints can respond in, negotiated through the Accept header of the request.
+
+    text/plain (default): the python repr of the nested lists [ [ [<label>, <confidence>],... ],... ], as before
+    application/json: the same nested lists as json
+    application/msgpack: the same nested lists as MessagePack, with float32 confidences. Requires msgpack
+    application/vnd.text-classifier.columnar: the compact binary layout described in encode_columnar
+"""
+import gzip
+import json
+import numpy as np
+import struct
+
+from ranking import format_top_n
+
+try:
+    import msgpack
+    HAS_MSGPACK = True
+except ImportError:
+    HAS_MSGPACK = False
+
+LEGACY_MIMETYPE = "text/plain"
+COLUMNAR_MIMETYPE = "application/vnd.text-classifier.columnar"
+COLUMNAR_MAGIC = b"TCC1"
+# magic, number of documents, labels per document, size of the label table in bytes
+_COLUMNAR_HEADER = struct.Struct("<4sIII")
+
+
+def _encode_nested(indices, probas, label_array, encode_label, separator):
+    """
+    Write ranked predictions as nested lists [ [ [<label>, <confidence>],... ],... ] straight into bytes, one
+    document at a time, without building the lists or the text of the whole response first.
+
+    :param encode_label: A function giving the literal of a label
+    :param separator: The separator of the items of a list
+    """
+    # every label used is encoded once
+    used_labels, table_indices = np.unique(indices.ravel(), return_inverse=True)
+    labels = np.array([encode_label(label) for label in label_array[used_labels].tolist()],
+                      dtype=object)[table_indices.reshape(indices.shape)]
+    # floats are written as their repr, like str() and json.dumps do
+    rows = (("[" + separator.join(f"[{label}{separator}{confidence!r}]" for label, confidence in zip(*row)) + "]")
+            .encode("utf-8") for row in zip(labels.tolist(), probas.tolist()))
+    return b"[" + separator.encode("utf-8").join(rows) + b"]"
+
+
+def encode_legacy(indices, probas, label_array):
+    # the same as str(format_top_n(...))
+    return _encode_nested(indices, probas, label_array, repr, ", ")
+
+
+def encode_json(indices, probas, label_array):
+    # the same as json.dumps(format_top_n(...), ensure_ascii=False, separators=(",", ":"))
+    return _encode_nested(indices, probas, label_array, lambda label: json.dumps(label, ensure_ascii=False), ",")
+
+
+def encode_msgpack(indices, probas, label_array):
+    return msgpack.packb(format_top_n(indices, probas, label_array), use_single_float=True)
+
+
+def encode_columnar(indices, probas, label_array):
+    """
+    Encode ranked predictions in a columnar binary layout, all numbers little endian:
+
+        header: b"TCC1", uint32 n_documents, uint32 top_n, uint32 n_bytes of the label table
+        label table: the utf-8 names of the labels used in the response, separated by newlines
+        label indices: n_documents x top_n int32 indices into the label table, ranked by decreasing confidence
+        confidences: n_documents x top_n float32
+
+    Use decode_columnar to read it.
+    """
+    used_labels, table_indices = np.unique(indices, return_inverse=True)
+    table = "\n".join(label_array[used_labels].tolist()).encode("utf-8")
+    n_documents, top_n = indices.shape
+    return b"".join([_COLUMNAR_HEADER.pack(COLUMNAR_MAGIC, n_documents, top_n, len(table)), table,
+                     table_indices.astype("<i4").tobytes(), np.asarray(probas, dtype="<f4").tobytes()])
+
+
+def decode_columnar(data):
+    """
+    :param data: A response encoded by encode_columnar
+    :return: A tuple (labels, confidences) of arrays of shape (n_documents, top_n)
+    """
+    magic, n_documents, top_n, table_size = _COLUMNAR_HEADER.unpack_from(data)
+    if magic != COLUMNAR_MAGIC:
+        raise ValueError("Not a columnar prediction response")
+    offset = _COLUMNAR_HEADER.size
+    table = data[offset:offset + table_size].decode("utf-8")
+    label_table = np.array(table.split("\n") if table_size else [], dtype=object)
+    offset += table_size
+    count = n_documents * top_n
+    indices = np.frombuffer(data, dtype="<i4", count=count, offset=offset).reshape(n_documents, top_n)
+    probas = np.frombuffer(data, dtype="<f4", count=count, offset=offset + 4 * count).reshape(n_documents, top_n)
+    return label_table[indices], probas
+
+
+ENCODERS = {
+    LEGACY_MIMETYPE: encode_legacy,
+    "application/json": encode_json,
+    COLUMNAR_MIMETYPE: encode_columnar,
+}
+if HAS_MSGPACK:
+    ENCODERS["application/msgpack"] = encode_msgpack
+
+
+def negotiate_format(accept_mimetypes):
+    """
+    :param accept_mimetypes: The parsed Accept header, i.e. flask.request.accept_mimetypes
+    :return: The mimetype of the best format the client accepts. The legacy format if the client does not say
+    """
+    # the legacy format comes first, so that it wins for "Accept: */*"
+    return accept_mimetypes.best_match(list(ENCODERS), default=LEGACY_MIMETYPE)
+
+
+def maybe_compress(body, accept_encoding, compress_level=6, min_bytes=1024):
+    """
+    Gzip a response body if the client accepts it and the body is large enough for it to pay off.
+
+    :return: A tuple (body, whether it is gzipped)
+    """
+    if 'gzip' not in accept_encoding or len(body) < min_bytes:
+        return body, False
+    return gzip.compress(body, compresslevel=compress_level), True
@@ -1,30 +1,144 @@
+import gc
 import gzip
-import pandas as pd
-import gdown
+import hmac
 import json
 import logging
+import numpy as np
 import os
-import zipfile
+import sys
+import threading
+import time
+import torch
+import zlib
 
 from json import JSONDecodeError
 from io import StringIO, BytesIO
-from farm.infer import Inferencer
+from functools import partial
+from itertools import chain, islice
 from flask import Flask
+from flask import Request
+from flask import g
+from flask import has_request_context
 from flask import request
 from flask import Response
+from flask import stream_with_context
+from flask import send_file
 from flask_script import Manager, Command, Option
-from gunicorn.app.base import Application
-from utils import Document
+from gunicorn.app.base import BaseApplication
+from utils import PredictionDocument
+from admission import AdmissionController, DeadlineExceeded, check_deadline, get_deadline
+from artifacts import ModelArtifactCache
+from batch_predict import predict_file
+from cpu_topology import configure_worker, plan_layout
+from jobs import JobRunner, JobRunnerSupervisor, JobStore, JOB_DONE
+from metrics import clear_multiprocess_dir, mark_process_dead, observe_request, observe_startup, render_metrics, timed
+from model_control import ActiveModelState, ModelSwapWatcher, is_valid_model_name, swap_model
+from model_registry import MODELS_DIR, LoadedModel, ModelRegistry, get_model_path, load_farm_inferencer, load_measured
+from prediction_cache import PredictionCache
+from quantization import compare_models, quantize_inferencer
+from preprocessing import build_corpus_texts
+from ranking import format_top_n, top_n_indices
+from response_formats import ENCODERS, LEGACY_MIMETYPE, maybe_compress, negotiate_format
+from streaming import iter_body, iter_chunks, iter_compressed, iter_corpus_file, iter_json_documents, iter_lines
+from streaming import READ_SIZE, iter_ndjson
+from tokenization import validate_input_ids
+from stub_inferencer import load_stub_inferencer
 from simple_logging.custom_logging import setup_custom_logger
-from optparse import OptionParser
 
 
 # -------------------------------------
 # Set up the app
 # -------------------------------------
+class ServerRequest(Request):
+
+    @property
+    def max_content_length(self):
+        # in streaming mode the payload is never held in memory, so its size does not matter
+        if 'application/x-ndjson' in self.headers.get('Accept', ''):
+            return None
+        if self.endpoint == 'submit_job':
+            return MAX_JOB_BYTES or None
+        return super().max_content_length
+
+
 app = Flask(__name__)
-# we keep the active model used by the /predict* endpoints in this variable
+app.request_class = ServerRequest
+# the model configured at startup. The active model used by the /predict* endpoints can be swapped at runtime,
+# see get_active_model_name
 model_name = None
+# optionally batch the documents of concurrent requests into one inference call.
+# This needs a worker class that serves several requests at a time, e.g. '-k gthread --threads 8'
+if os.environ.get('MICRO_BATCHING', '0') == '1':
+    batcher_options = {'max_batch_size': int(os.environ.get('MICRO_BATCHING_MAX_SIZE', 32)),
+                       'max_wait_ms': float(os.environ.get('MICRO_BATCHING_MAX_WAIT_MS', 5))}
+else:
+    batcher_options = None
+# optionally predict documents in batches of similar length, which wastes less compute on padding
+if os.environ.get('LENGTH_BUCKETING', '0') == '1':
+    bucketing_options = {'token_budget': int(os.environ.get('LENGTH_BUCKETING_TOKEN_BUDGET', 4096))}
+else:
+    bucketing_options = None
+# optionally tokenize the texts with a fast tokenizer, cut to the max_seq_len of the model beforehand and cached,
+# instead of with the FARM Processor
+if os.environ.get('FAST_TOKENIZATION', '0') == '1':
+    tokenization_options = {'cache_size': int(os.environ.get('TOKEN_CACHE_SIZE', 10000)),
+                            'chars_per_token': float(os.environ.get('PRE_TRUNCATION_CHARS_PER_TOKEN', 8))}
+else:
+    tokenization_options = None
+# INFERENCER=stub replaces the FARM models by a deterministic stub, e.g. to benchmark the server offline
+model_loader = load_stub_inferencer if os.environ.get('INFERENCER', 'farm') == 'stub' else load_farm_inferencer
+# the models loaded in this process. Models preloaded by the gunicorn master are shared by all workers.
+# The models listed in QUANTIZED_MODELS, a json list of model names, are quantized to int8 at load time
+model_registry = ModelRegistry(max_models=int(os.environ.get('MODEL_REGISTRY_SIZE', 2)),
+                               batcher_options=batcher_options,
+                               bucketing_options=bucketing_options,
+                               loader=model_loader,
+                               quantized_models=json.loads(os.environ.get('QUANTIZED_MODELS', '[]')),
+                               max_memory_mb=float(os.environ.get('MODEL_MEMORY_BUDGET_MB', 0)) or None,
+                               tokenization_options=tokenization_options)
+# predictions of documents we have seen before are served from this cache, if PREDICTION_CACHE_SIZE is set.
+# Set PREDICTION_CACHE_DB to a path under /app to share the cache across all workers
+if int(os.environ.get('PREDICTION_CACHE_SIZE', 0)) > 0:
+    prediction_cache = PredictionCache(max_entries=int(os.environ.get('PREDICTION_CACHE_SIZE', 0)),
+                                       db_path=os.environ.get('PREDICTION_CACHE_DB'),
+                                       max_db_entries=int(os.environ.get('PREDICTION_CACHE_DB_SIZE', 1000000)))
+else:
+    prediction_cache = None
+# in streaming mode we predict the documents in chunks of that size
+STREAMING_CHUNK_SIZE = int(os.environ.get('STREAMING_CHUNK_SIZE', 256))
+# responses are gzipped at this level if the client accepts it, unless they are smaller than RESPONSE_GZIP_MIN_BYTES
+RESPONSE_GZIP_LEVEL = int(os.environ.get('RESPONSE_GZIP_LEVEL', 6))
+RESPONSE_GZIP_MIN_BYTES = int(os.environ.get('RESPONSE_GZIP_MIN_BYTES', 1024))
+# bulk prediction jobs are spooled in this folder, which all workers share.
+# The results of a job are removed JOB_RESULTS_TTL seconds after it finished
+job_store = JobStore(os.environ.get('JOBS_DIR', '/app/jobs'),
+                     results_ttl=float(os.environ.get('JOB_RESULTS_TTL', 7 * 24 * 3600)) or None)
+# the cap on the size of a corpus as uploaded, and on the jobs waiting for the job runner
+MAX_JOB_BYTES = int(os.environ.get('MAX_JOB_BYTES', 10 ** 9))
+MAX_QUEUED_JOBS = int(os.environ.get('MAX_QUEUED_JOBS', 100))
+# how many documents of a job are predicted between two checkpoints
+JOB_CHUNK_SIZE = int(os.environ.get('JOB_CHUNK_SIZE', 256))
+# the active model is shared by all workers through a file in this folder, so that it can be swapped at runtime
+model_state = ActiveModelState(os.environ.get('MODEL_STATE_DIR', MODELS_DIR))
+# a json list of the models that requests may select with /predict/<model> besides the active model. Other models
+# are only served while they are loaded already, so that requests cannot load models and evict the active one
+ALLOWED_MODELS = set(json.loads(os.environ.get('ALLOWED_MODELS', '[]')))
+# how long a model swap waits for all workers to load the new model
+MODEL_SWAP_TIMEOUT = float(os.environ.get('MODEL_SWAP_TIMEOUT', 600))
+# the /admin endpoints require the header "X-Admin-Token: <ADMIN_TOKEN>". They are disabled unless it is set
+ADMIN_TOKEN = os.environ.get('ADMIN_TOKEN')
+# admission control of the /predict* endpoints. A limit of 0 disables it
+# the documents that all workers together are predicting. Beyond that, requests are rejected with a 503
+admission = AdmissionController(max_pending_documents=int(os.environ.get('MAX_PENDING_DOCUMENTS', 0)))
+# the documents and the bytes of a single request, compressed or not. Larger requests are rejected with a 413
+MAX_REQUEST_DOCUMENTS = int(os.environ.get('MAX_REQUEST_DOCUMENTS', 0))
+MAX_REQUEST_BYTES = int(os.environ.get('MAX_REQUEST_BYTES', 0))
+app.config['MAX_CONTENT_LENGTH'] = MAX_REQUEST_BYTES or None
+# how many seconds requests without a deadline header have, see admission.get_deadline
+REQUEST_TIMEOUT = float(os.environ.get('REQUEST_TIMEOUT', 0)) or None
+# how many seconds rejected clients are asked to wait before they retry
+RETRY_AFTER = int(os.environ.get('RETRY_AFTER', 1))
+PREDICT_ENDPOINTS = ('parse_request', 'parse_request_raw', 'parse_request_ids')
 
 # -------------------------------------
 # Set up logger
@@ -32,48 +146,368 @@ model_name = None
 LOGGING_LEVEL = logging.DEBUG
 log_file = os.path.join('./log', 'web_server.log')
 
-app.logger = setup_custom_logger('FLASK_WEB_SERVER', LOGGING_LEVEL, flog=log_file)
+# LOG_ASYNC=1 takes the writing of the log off the request threads. LOG_RATE_LIMIT (records per second) and
+# LOG_SAMPLE_RATE thin out the records logged on every request, see simple_logging.custom_logging.RateLimitFilter
+app.logger = setup_custom_logger('FLASK_WEB_SERVER', LOGGING_LEVEL, flog=log_file,
+                                 async_mode=os.environ.get('LOG_ASYNC', '0') == '1',
+                                 per_process=os.environ.get('LOG_PER_PROCESS', '0') == '1',
+                                 max_bytes=int(os.environ.get('LOG_MAX_BYTES', 0)),
+                                 backup_count=int(os.environ.get('LOG_BACKUP_COUNT', 5)),
+                                 rate=float(os.environ.get('LOG_RATE_LIMIT', 0)) or None,
+                                 sample_rate=float(os.environ.get('LOG_SAMPLE_RATE', 1.0)))
 app.logger.newline()
 
 app.logger.info("App is initializing")
 
+# every worker loads the models staged for a swap in the background
+swap_watcher = ModelSwapWatcher(model_state,
+                                lambda name, version: model_registry.get(get_model_path(name, version)),
+                                logger=app.logger)
 
-def get_predictions(model_path, docs_to_predict, top_n=4):
+
+def get_active_model_name():
     """
-    This is a convenience function, which takes a path to a trained FARM model and a list of Documents and
-    returns the predictions of the model for each Document.
+    The model used by the /predict* endpoints, unless the request selects another one
+    """
+    return model_state.read()['active'] or model_name
+
 
-    The model must exist locally at the specified path.
+def resolve_model(requested_model):
+    """
+    :param requested_model: The model selected by the request, or None for the active model
+    :return: A tuple (model name, error Response or None)
+    """
+    if requested_model is None:
+        selected = get_active_model_name()
+        if selected is None:
+            app.logger.error("No model configured yet")
+            return None, Response("{'Messsage':'No model configured yet'}",
+                                  status=500, mimetype='text/plain')
+        return selected, None
+    if not is_valid_model_name(requested_model):
+        return None, Response("{'Messsage':'No such model'}", status=404, mimetype='text/plain')
+    if requested_model == get_active_model_name() or get_model_path(requested_model) in model_registry:
+        return requested_model, None
+    if requested_model not in ALLOWED_MODELS or not os.path.isdir(get_model_path(requested_model)):
+        return None, Response("{'Messsage':'No such model'}", status=404, mimetype='text/plain')
+    return requested_model, None
+
+
+def get_ranked_predictions(model_path, docs_to_predict, top_n=4):
+    """
+    Like get_ranked_text_predictions, for a list of Documents
+    """
+    return get_ranked_text_predictions(model_path, [doc.get_text() for doc in docs_to_predict], top_n=top_n)
+
+
+def get_ranked_text_predictions(model_path, texts, top_n=4):
+    """
+    This is a convenience function, which takes a path to a trained FARM model and the texts of a list of Documents
+    and returns the top N predictions of the model for each Document.
+
+    The model must exist locally at the specified path. It is loaded only once per process and then
+    served from the model registry. Documents we have predicted before are served from the prediction cache.
     :param model_path: A path to a locally stored FARM model
-    :param docs_to_predict: A list of Documents to predict
+    :param texts: The texts of the Documents to predict, see Document.get_text
+    :param top_n: Return the top N predictions ranked according to confidence (default 4)
+    :return: A tuple (indices, probas, label_array), where indices and probas are matrices of shape
+             (n_documents, top_n) with the label indices and their probabilities ranked by decreasing confidence,
+             and label_array maps the label indices to label names
+    """
+    with timed("load_model"):
+        model = model_registry.get(model_path)
+
+    if prediction_cache is None:
+        check_request_deadline()
+        with timed("inference"):
+            probabilities = model.predict_proba(texts, deadline=get_request_deadline())
+    else:
+        with timed("cache_lookup"):
+            probabilities = prediction_cache.get_many(model.cache_name, texts)
+        # predict only the documents we have not seen before
+        missing = [i for i, proba in enumerate(probabilities) if proba is None]
+        if missing:
+            missing_texts = [texts[i] for i in missing]
+            check_request_deadline()
+            with timed("inference"):
+                predicted = model.predict_proba(missing_texts, deadline=get_request_deadline())
+            with timed("cache_store"):
+                prediction_cache.put_many(model.cache_name, missing_texts, predicted)
+            for i, proba in zip(missing, predicted):
+                probabilities[i] = proba
+
+    return rank_predictions(probabilities, model.label_array, top_n=top_n)
+
+
+def rank_predictions(probabilities, label_array, top_n=4):
+    """
+    :param probabilities: A list with the predicted probabilities of every Document
+    :param label_array: Maps the label indices to label names
     :param top_n: Return the top N predictions ranked according to confidence (default 4)
+    :return: A tuple (indices, probas, label_array), see get_ranked_text_predictions
+    """
+    if len(probabilities) == 0:
+        return np.empty((0, 0), dtype=np.intp), np.empty((0, 0), dtype=np.float32), label_array
+    # rank the predictions of all documents at once
+    with timed("ranking"):
+        indices, probas = top_n_indices(probabilities, top_n)
+    return indices, probas, label_array
+
+
+def get_predictions(model_path, docs_to_predict, top_n=4):
+    """
+    Like get_ranked_predictions, but formatted as returned by the /predict* endpoints.
+
     :return: A list of lists of the format [ [doc_1], [doc_2], ..., [doc_N]],
              where [doc_X] = [ [<predicted_label_1>, <confidence>],..., [[<predicted_label_M>, <confidence>]] ]
              we return as many predicted labels as requested from top_n
     """
-    nlp = Inferencer.load(model_path, task_type="text_classification")
-    # get the labels used for training from the FARM Processor
-    label_list = nlp.processor.tasks['text_classification']['label_list']
+    return format_top_n(*get_ranked_predictions(model_path, docs_to_predict, top_n=top_n))
+
+
+def predictions_response(ranked_predictions):
+    """
+    Encode ranked predictions in the format the client asks for with the Accept header, see response_formats.py,
+    and gzip them if the client specifies "Accept-Encoding: gzip".
+
+    :param ranked_predictions: A tuple (indices, probas, label_array) as returned by get_ranked_predictions
+    :return: A Response
+    """
+    mimetype = negotiate_format(request.accept_mimetypes)
+    with timed("serialize"):
+        data = ENCODERS[mimetype](*ranked_predictions)
+    with timed("compress"):
+        data, gzipped = maybe_compress(data, request.headers.get('Accept-Encoding', ''),
+                                       compress_level=RESPONSE_GZIP_LEVEL, min_bytes=RESPONSE_GZIP_MIN_BYTES)
+    if gzipped:
+        app.logger.info("Accepts gzip, will return gzipped data")
+        # the default format has always been sent as application/gzip when gzipped
+        response = Response(data, status=200,
+                            mimetype='application/gzip' if mimetype == LEGACY_MIMETYPE else mimetype)
+        response.headers['Content-Encoding'] = 'gzip'
+    else:
+        response = Response(data, status=200, mimetype=mimetype)
+    response.headers['Vary'] = 'Accept, Accept-Encoding'
+    response.headers['Content-Length'] = len(data)
+    return response
+
+
+def get_request_deadline():
+    """
+    :return: The deadline of the current request as a unix timestamp, or None
+    """
+    return g.get('deadline') if has_request_context() else None
+
+
+def check_request_deadline():
+    """
+    Cancel the current request if its deadline has passed, so that we do not spend inference on a response the
+    client does not wait for anymore.
+
+    :raise DeadlineExceeded: If the deadline has passed
+    """
+    check_deadline(get_request_deadline())
+
+
+def admit_documents(n_documents, capped=True):
+    """
+    Admit the documents of the current request for prediction. They are released when the request ends.
+
+    :param n_documents: How many documents the request holds, or holds at once in streaming mode
+    :param capped: Whether MAX_REQUEST_DOCUMENTS applies to the request
+    :return: None if the documents were admitted, otherwise the Response rejecting the request
+    """
+    if capped and MAX_REQUEST_DOCUMENTS and n_documents > MAX_REQUEST_DOCUMENTS:
+        return Response(f"{{'Messsage':'Too many documents, send at most {MAX_REQUEST_DOCUMENTS} per request, "
+                        f"or use /jobs'}}", status=413, mimetype='text/plain')
+    if not admission.try_admit(n_documents):
+        app.logger.warning(f"Rejected {n_documents} documents, {admission.pending_documents()} are pending")
+        response = Response("{'Messsage':'The server is busy, retry later'}",
+                            status=503, mimetype='text/plain')
+        response.headers['Retry-After'] = str(RETRY_AFTER)
+        return response
+    g.admitted_documents += n_documents
+    return None
+
+
+def read_request_body(max_bytes):
+    """
+    Read the body of the current request in memory.
+
+    :param max_bytes: The cap on the size of the body. 0 disables it
+    :return: The body, or None if it is larger than 'max_bytes'
+    """
+    if not max_bytes:
+        return request.get_data()
+    # chunked requests have no Content-Length to check beforehand, so the cap is enforced while reading
+    chunks = []
+    size = 0
+    while size <= max_bytes:
+        chunk = request.stream.read(min(READ_SIZE, max_bytes + 1 - size))
+        if not chunk:
+            return b"".join(chunks)
+        chunks.append(chunk)
+        size += len(chunk)
+    return None
+
+
+def read_request_data():
+    """
+    Read the body of the current request in memory and uncompress it, if it is gzipped.
+    The body is capped at MAX_REQUEST_BYTES, compressed and uncompressed.
+
+    :return: A tuple (data, error Response), one of which is None
+    """
+    body = read_request_body(MAX_REQUEST_BYTES)
+    if body is None:
+        return None, Response(f"{{'Messsage':'The payload is larger than {MAX_REQUEST_BYTES} bytes'}}",
+                              status=413, mimetype='text/plain')
+    if len(body) == 0:
+        return None, Response("{'Messsage':'No data in request'}",
+                              status=400, mimetype='text/plain')
+    if request.content_type == "text/plain":
+        # we got a plain text
+        return body, None
+    elif request.content_type == "application/gzip":
+        # we got gzipped data
+        with timed("decompress"):
+            compressed_data = BytesIO(body)
+            if not MAX_REQUEST_BYTES:
+                return gzip.GzipFile(fileobj=compressed_data, mode='r').read(), None
+            # a small gzipped body can uncompress to a huge one, so we stop reading beyond the limit
+            uncompressed_data = gzip.GzipFile(fileobj=compressed_data, mode='r').read(MAX_REQUEST_BYTES + 1)
+        if len(uncompressed_data) > MAX_REQUEST_BYTES:
+            return None, Response(f"{{'Messsage':'The uncompressed payload is larger than {MAX_REQUEST_BYTES} "
+                                  f"bytes'}}", status=413, mimetype='text/plain')
+        return uncompressed_data, None
+    return None, Response("{'Messsage':'Specify Content-Type in request header. "
+                          "One of 'text/plain' or 'application/gzip'}",
+                          status=400, mimetype='text/plain')
+
+
+def accepts_streaming():
+    """
+    Clients opt in to the streaming mode by specifying "Accept: application/x-ndjson"
+    """
+    return 'application/x-ndjson' in request.headers.get('Accept', '')
+
 
-    # rename the labels to their original format, i.e replace "-" with ","
-    label_list = [label.replace("-", ",") for label in label_list]
+def iter_request_body():
+    """
+    Read the body of the current request incrementally, instead of loading it in memory at once.
 
-    to_predict = [{"text": doc.get_text()} for doc in docs_to_predict]
-    result = nlp.inference_from_dicts(to_predict)
+    :return: A generator over the uncompressed chunks of the body, or None if the Content-Type is not supported
+    """
+    if request.content_type in ("text/plain", "application/x-ndjson"):
+        return iter_body(request.stream)
+    elif request.content_type == "application/gzip":
+        return iter_body(request.stream, gzipped=True)
+    return None
 
-    # we now just have to loop through the 'result' structure and format the expected output accordingly
-    output_list = []
-    for inference_sample in result:
-        predictions = inference_sample['predictions']
-        for pred in predictions:
-            predictions_df = pd.DataFrame({"labels": label_list,
-                                           "predicted_proba": pred['probability']}).sort_values(by="predicted_proba",
-                                                                                                ascending=False).head(
-                top_n)
-            sample_output = [[label, confidence] for label, confidence in zip(predictions_df["labels"],
-                                                                              predictions_df['predicted_proba'])]
-            output_list.append(sample_output)
-    return output_list
+
+def stream_predictions(model_path, documents, top_n=4):
+    """
+    Predict Documents in chunks of STREAMING_CHUNK_SIZE and stream back the results as they become ready.
+
+    The response is NDJSON, where each line holds the predictions of one Document in the format
+    [ [<predicted_label_1>, <confidence>],..., [<predicted_label_M>, <confidence>] ]
+    It is gzipped as a stream if the client specifies "Accept-Encoding: gzip".
+    :param model_path: A path to a locally stored FARM model
+    :param documents: An iterable over the Documents to predict, typically parsed lazily from the request
+    :param top_n: Return the top N predictions ranked according to confidence (default 4)
+    :return: A streamed Response
+    """
+    chunks = iter_chunks(documents, STREAMING_CHUNK_SIZE)
+    # parse the first chunk before responding, so that we can still reject malformatted data
+    try:
+        first_chunk = next(chunks, None)
+    except (ValueError, KeyError, TypeError, zlib.error) as ex:
+        app.logger.error(ex)
+        return Response("{'Messsage':'Malformatted data'}",
+                        status=400, mimetype='text/plain')
+    if first_chunk is None:
+        return Response("{'Messsage':'No data in request'}",
+                        status=400, mimetype='text/plain')
+    # a stream holds at most one chunk at a time, so it is admitted with the size of its first chunk.
+    # The cap on the documents of a request does not apply, streaming is meant for large corpora
+    error_response = admit_documents(len(first_chunk), capped=False)
+    if error_response is not None:
+        return error_response
+
+    def predict_chunks():
+        try:
+            for chunk in chain([first_chunk], chunks):
+                yield get_predictions(model_path, chunk, top_n=top_n)
+        except (ValueError, KeyError, TypeError, zlib.error) as ex:
+            # the response has started already, all we can do is to end it early
+            app.logger.error(f"Malformatted data, ending the streamed response early: {ex}")
+        except DeadlineExceeded as ex:
+            app.logger.warning(f"Ending the streamed response early: {ex}")
+
+    gzipped = 'gzip' in request.headers.get('Accept-Encoding', '')
+    response = Response(stream_with_context(iter_ndjson(predict_chunks(), gzipped=gzipped,
+                                                        compress_level=RESPONSE_GZIP_LEVEL)),
+                        status=200, mimetype='application/x-ndjson')
+    if gzipped:
+        app.logger.info("Accepts gzip, will stream gzipped data")
+        response.headers['Content-Encoding'] = 'gzip'
+        response.headers['Vary'] = 'Accept-Encoding'
+    return response
+
+
+@app.before_request
+def start_timer():
+    g.start_time = time.perf_counter()
+    g.documents = None
+    g.admitted_documents = 0
+    swap_watcher.ensure_started()
+
+
+@app.before_request
+def check_admission():
+    """
+    Reject requests to the /predict* endpoints that are too large or late already, before we read their payload
+    """
+    if request.endpoint not in PREDICT_ENDPOINTS:
+        return None
+    try:
+        g.deadline = get_deadline(request.headers, default_timeout=REQUEST_TIMEOUT)
+    except ValueError:
+        return Response("{'Messsage':'The deadline headers must be numbers of seconds'}",
+                        status=400, mimetype='text/plain')
+    check_request_deadline()
+    # in streaming mode the payload is never held in memory, so its size does not matter
+    if MAX_REQUEST_BYTES and not accepts_streaming() and (request.content_length or 0) > MAX_REQUEST_BYTES:
+        return Response(f"{{'Messsage':'The payload is larger than {MAX_REQUEST_BYTES} bytes'}}",
+                        status=413, mimetype='text/plain')
+    return None
+
+
+@app.teardown_request
+def release_admitted_documents(exception=None):
+    # streamed responses are torn down once the stream ends
+    if g.get('admitted_documents'):
+        admission.release(g.admitted_documents)
+        g.admitted_documents = 0
+
+
+@app.errorhandler(DeadlineExceeded)
+def deadline_exceeded(ex):
+    app.logger.warning(f"Cancelled the request: {ex}")
+    return Response("{'Messsage':'Deadline exceeded'}", status=504, mimetype='text/plain')
+
+
+@app.after_request
+def record_request_metrics(response):
+    """
+    Record the duration, the payload sizes and the number of documents of every request.
+    For streamed responses the duration is the time to the first byte, the response size and documents are unknown.
+    """
+    if request.endpoint is not None and request.endpoint != 'metrics':
+        observe_request(request.endpoint, response.status_code, time.perf_counter() - g.start_time,
+                        request_bytes=request.content_length, response_bytes=response.content_length,
+                        documents=g.documents)
+    return response
 
 
 @app.route('/healthz', methods=['GET'])
@@ -86,9 +520,104 @@ def health():
     return "I am healthy. Served by worker: " + str(os.getpid())
 
 
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """
+    The request and stage latencies, payload sizes and document counts in the Prometheus text format.
+    With PROMETHEUS_MULTIPROC_DIR set they are aggregated across all workers.
+    """
+    data, content_type = render_metrics()
+    return Response(data, status=200, mimetype=content_type)
+
+
+@app.route('/cache', methods=['GET'])
+def cache_stats():
+    """
+    The hit and miss counters of the prediction cache and of the token caches of the worker serving the request
+    """
+    if prediction_cache is None:
+        stats = {"enabled": False}
+    else:
+        stats = dict(prediction_cache.stats(), enabled=True, worker=os.getpid())
+    stats["token_caches"] = {m.name: m.fast_tokenizer.stats() for m in model_registry.loaded_models()
+                             if m.fast_tokenizer is not None}
+    return Response(json.dumps(stats), status=200, mimetype='application/json')
+
+
+def is_admin_request():
+    if not ADMIN_TOKEN:
+        return False
+    return hmac.compare_digest(request.headers.get('X-Admin-Token', '').encode("utf-8"), ADMIN_TOKEN.encode("utf-8"))
+
+
+@app.route('/admin/model', methods=['GET'])
+def model_status():
+    """
+    The active model, the model being swapped in and the models loaded by the worker serving the request
+    """
+    if not is_admin_request():
+        return Response("{'Messsage':'Forbidden'}", status=403, mimetype='text/plain')
+    status = dict(model_state.read(), active=get_active_model_name(), worker=os.getpid(),
+                  loaded_models=[{"name": m.name, "version": m.version, "memory_mb": m.memory_mb}
+                                 for m in model_registry.loaded_models()])
+    if status['staged'] is not None:
+        status['ready_workers'] = len(model_state.ready_workers(status['staged']))
+    return Response(json.dumps(status), status=200, mimetype='application/json')
+
+
+@app.route('/admin/model', methods=['POST'])
+def activate_model():
+    """
+    Swap the active model of all workers, without restarting the server or dropping requests.
+
+    The payload is json: {"model_name": <name>, "source": <optional>, "sha256": <optional>}
+    where 'source' is where to fetch the model archive from, i.e. a Google Drive id, a local folder, a zip path or
+    a file:// URL, and 'sha256' its expected checksum. Without a source the model must be in /app/trained_models.
+    The swap runs in the background. Poll GET /admin/model until 'active' is the new model, or 'error' is set.
+    """
+    if not is_admin_request():
+        return Response("{'Messsage':'Forbidden'}", status=403, mimetype='text/plain')
+    try:
+        payload = json.loads(request.data)
+        new_model = payload['model_name']
+    except (JSONDecodeError, KeyError, TypeError):
+        return Response("{'Messsage':'Malformatted data'}", status=400, mimetype='text/plain')
+    if not is_valid_model_name(new_model):
+        return Response("{'Messsage':'Invalid model name'}", status=400, mimetype='text/plain')
+
+    state = model_state.read()
+    if state['staged'] is not None and not payload.get('force', False):
+        # another swap is in progress. Pass "force": true to override a swap whose worker died
+        return Response(json.dumps(state), status=409, mimetype='application/json')
+    source = payload.get('source')
+    if source is None and not os.path.isdir(get_model_path(new_model)):
+        return Response("{'Messsage':'No such model'}", status=404, mimetype='text/plain')
+
+    prepare_fn = activate_fn = None
+    if source is not None:
+        artifact_cache = ModelArtifactCache(MODELS_DIR, logger=app.logger)
+
+        def prepare_fn():
+            # the new version is extracted next to the one being served, which it replaces once all workers loaded it.
+            # Without a checksum we cannot tell whether the archive at the source changed, so we fetch it again
+            version, _ = artifact_cache.ensure_model(new_model, source, sha256=payload.get('sha256'), activate=False,
+                                                     refresh=payload.get('sha256') is None)
+            return version
+        activate_fn = partial(artifact_cache.activate, new_model)
+    app.logger.info(f"Swapping the active model to {new_model}")
+    threading.Thread(target=swap_model, args=(model_state, new_model, int(os.environ.get('SERVER_WORKERS', 1))),
+                     kwargs={'prepare_fn': prepare_fn, 'activate_fn': activate_fn, 'timeout': MODEL_SWAP_TIMEOUT,
+                             'logger': app.logger},
+                     name="model-swap", daemon=True).start()
+    return Response(json.dumps({"model_name": new_model, "state": "swapping"}), status=202,
+                    mimetype='application/json')
+
+
 @app.route('/predict_raw', methods=['POST'])
 @app.route('/predict_raw/<int:how_many>', methods=['POST'])
-def parse_request_raw(how_many=4):
+@app.route('/predict_raw/<model>', methods=['POST'])
+@app.route('/predict_raw/<model>/<int:how_many>', methods=['POST'])
+def parse_request_raw(how_many=4, model=None):
     """
     A convenience endpoint to predict on raw texts.
 
@@ -99,12 +628,16 @@ def parse_request_raw(how_many=4):
     "Content-Type: application/gzip". Otherwise use "Content-Type: text/plain"
 
     The endpoint also optionally returns gzipped data. Specify "Accept-Encoding: gzip" to enable that.
+    The predictions can be returned as json, MessagePack or in a compact binary format instead of the default
+    python repr. Specify the format with the Accept header, see response_formats.py
 
     Note that no preprocessing will be done on the texts, except for new-line and tabs removal.
     The purpose of this function is to easily test the model on new texts, without the need to package them in the
     expected json schema.
     By default we return the top 4 most confident labels for each Document, unless the endpoint is invoked
-    with the optional 'how_many' parameter
+    with the optional 'how_many' parameter.
+    The Documents are predicted by the active model, unless the endpoint is invoked with the name of a model in
+    /app/trained_models, e.g. /predict/<model>/<how_many>
 
     :return: A list of lists of the format [ [doc_1], [doc_2], ..., [doc_N]],
              where [doc_X] = [ [<predicted_label_1>, <confidence>],..., [[<predicted_label_M>, <confidence>]] ]
@@ -113,73 +646,55 @@ def parse_request_raw(how_many=4):
 
     app.logger.info("Got a POST for /predict_raw")
 
-    global model_name
-
-    if model_name is None:
-        app.logger.error("No model configured yet")
-        return Response("{'Messsage':'No model configured yet'}",
-                        status=500, mimetype='text/plain')
-
-    if len(request.data) == 0:
-        return Response("{'Messsage':'No data in request'}",
-                        status=400, mimetype='text/plain')
-
-    if request.content_type == "text/plain":
-        # we got a plain text
-        uncompressed_data = request.data
-    elif request.content_type == "application/gzip":
-        # we got gzipped data
-        compressed_data = BytesIO(request.data)
-        uncompressed_data = gzip.GzipFile(fileobj=compressed_data, mode='r').read()
-    else:
-        return Response("{'Messsage':'Specify Content-Type in request header. "
-                        "One of 'text/plain' or 'application/gzip'}",
-                        status=400, mimetype='text/plain')
+    # resolved once, so that a model swap does not affect the requests in flight
+    served_model, error_response = resolve_model(model)
+    if error_response is not None:
+        return error_response
+
+    if accepts_streaming():
+        # stream the request and the response, so that memory stays bounded no matter how many texts we get
+        body = iter_request_body()
+        if body is None:
+            return Response("{'Messsage':'Specify Content-Type in request header. "
+                            "One of 'text/plain' or 'application/gzip'}",
+                            status=400, mimetype='text/plain')
+        documents = (PredictionDocument(content=line) for line in iter_lines(body) if line.strip() != "")
+        return stream_predictions(get_model_path(served_model), documents, top_n=how_many)
+
+    uncompressed_data, error_response = read_request_data()
+    if error_response is not None:
+        return error_response
 
     # parse the payload
     try:
-        f = StringIO(uncompressed_data.decode("utf-8"))
-        predict_documents = []
-        for doc in f:
-            # skip empty lines
-            if doc.strip() != "":
-                d = Document(content=doc)
-                predict_documents.append(d)
+        with timed("parse"):
+            f = StringIO(uncompressed_data.decode("utf-8"))
+            predict_documents = []
+            for doc in f:
+                # skip empty lines
+                if doc.strip() != "":
+                    d = PredictionDocument(content=doc)
+                    predict_documents.append(d)
     except Exception as ex:
         app.logger.error(ex)
+    g.documents = len(predict_documents)
+    error_response = admit_documents(len(predict_documents))
+    if error_response is not None:
+        return error_response
 
-    model_path = os.path.join("/app/trained_models/", model_name,
-                              "content/trained_models", model_name)
-    output_list = get_predictions(model_path, predict_documents, top_n=how_many)
+    model_path = get_model_path(served_model)
+    ranked_predictions = get_ranked_predictions(model_path, predict_documents, top_n=how_many)
 
     # finally return
-    # return type depends on what the client supports
-    if 'gzip' in request.headers.get('Accept-Encoding', ''):
-        # yes, we will return gzipped data
-        gzip_buffer = BytesIO()
-        gzip_file = gzip.GzipFile(mode='wb', fileobj=gzip_buffer)
-
-        gzip_file.write(str(output_list).encode('utf-8'))
-        gzip_file.close()
-
-        app.logger.info("Accepts gzip, will return gzipped data")
-        response = Response(gzip_buffer.getvalue(), status=200,
-                            mimetype='application/gzip')
-        response.headers['Content-Encoding'] = 'gzip'
-        response.headers['Vary'] = 'Accept-Encoding'
-        response.headers['Content-Length'] = len(response.data)
-    else:
-        # no, return plain text
-        response = Response(str(output_list).encode('utf-8'), status=200,
-                            mimetype='text/plain')
-        response.headers['Content-Length'] = len(response.data)
-
-    return response
+    # the format and the compression depend on what the client supports
+    return predictions_response(ranked_predictions)
 
 
 @app.route('/predict', methods=['POST'])
 @app.route('/predict/<int:how_many>', methods=['POST'])
-def parse_request(how_many=4):
+@app.route('/predict/<model>', methods=['POST'])
+@app.route('/predict/<model>/<int:how_many>', methods=['POST'])
+def parse_request(how_many=4, model=None):
     """
     This is the main predict endpoints that can be used on json data formatted according to the schema in the challenge.
 
@@ -189,9 +704,13 @@ def parse_request(how_many=4):
     Otherwise use "Content-Type: text/plain"
 
     The endpoint also optionally returns gzipped data. Specify "Accept-Encoding: gzip" to enable that.
+    The predictions can be returned as json, MessagePack or in a compact binary format instead of the default
+    python repr. Specify the format with the Accept header, see response_formats.py
 
     By default we return the top 4 most confident labels for each Document, unless the endpoint is invoked
-    with the optional 'how_many' parameter
+    with the optional 'how_many' parameter.
+    The Documents are predicted by the active model, unless the endpoint is invoked with the name of a model in
+    /app/trained_models, e.g. /predict/<model>/<how_many>
 
     :return: A list of lists of the format [ [doc_1], [doc_2], ..., [doc_N]],
              where [doc_X] = [ [<predicted_label_1>, <confidence>],..., [[<predicted_label_M>, <confidence>]] ]
@@ -200,88 +719,311 @@ def parse_request(how_many=4):
 
     app.logger.info("Got a POST for /predict")
 
-    global model_name
+    # resolved once, so that a model swap does not affect the requests in flight
+    served_model, error_response = resolve_model(model)
+    if error_response is not None:
+        return error_response
+
+    if accepts_streaming():
+        # stream the request and the response, so that memory stays bounded no matter how large the corpus is
+        body = iter_request_body()
+        if body is None:
+            return Response("{'Messsage':'Specify Content-Type in request header. "
+                            "One of 'text/plain', 'application/x-ndjson' or 'application/gzip'}",
+                            status=400, mimetype='text/plain')
+        documents = (PredictionDocument(doc['metadata'], doc['content']) for doc in iter_json_documents(body))
+        return stream_predictions(get_model_path(served_model), documents, top_n=how_many)
+
+    uncompressed_data, error_response = read_request_data()
+    if error_response is not None:
+        return error_response
 
-    if model_name is None:
-        app.logger.error("No model configured yet")
-        return Response("{'Messsage':'No model configured yet'}",
-                        status=500, mimetype='text/plain')
-
-    if len(request.data) == 0:
-        return Response("{'Messsage':'No data in request'}",
+    # parse the payload
+    try:
+        with timed("parse"):
+            json_corpus = json.loads(uncompressed_data)
+    except JSONDecodeError as jde:
+        app.logger.error(jde)
+        return Response("{'Messsage':'Malformatted data'}",
                         status=400, mimetype='text/plain')
+    # admitted before the html is stripped, which is costly for large corpora as well
+    error_response = admit_documents(len(json_corpus))
+    if error_response is not None:
+        return error_response
 
-    if request.content_type == "text/plain":
-        # we got a plain text
-        uncompressed_data = request.data
-    elif request.content_type == "application/gzip":
-        # we got gzipped data
-        compressed_data = BytesIO(request.data)
-        uncompressed_data = gzip.GzipFile(fileobj=compressed_data, mode='r').read()
-    else:
-        return Response("{'Messsage':'Specify Content-Type in request header. "
-                        "One of 'text/plain' or 'application/gzip'}",
-                        status=400, mimetype='text/plain')
+    # stripping the html of large corpora is spread across a process pool
+    with timed("build_documents"):
+        predict_texts = build_corpus_texts(json_corpus)
+    g.documents = len(predict_texts)
+    # the corpus may have waited for the preprocessing pool
+    check_request_deadline()
+
+    model_path = get_model_path(served_model)
+    ranked_predictions = get_ranked_text_predictions(model_path, predict_texts, top_n=how_many)
+
+    # finally return
+    # the format and the compression depend on what the client supports
+    return predictions_response(ranked_predictions)
+
+
+@app.route('/predict_ids', methods=['POST'])
+@app.route('/predict_ids/<int:how_many>', methods=['POST'])
+@app.route('/predict_ids/<model>', methods=['POST'])
+@app.route('/predict_ids/<model>/<int:how_many>', methods=['POST'])
+def parse_request_ids(how_many=4, model=None):
+    """
+    An endpoint to predict Documents that the client has tokenized already, which skips the tokenization on the server.
+
+    It expects a json list with the input ids of every Document in the payload, e.g. [[101, 7592, 2088, 102], ...],
+    as produced by the tokenizer of the model, including the special tokens and at most max_seq_len of them.
+    The payload data can optionally be gzipped, in which case the request must contain the header
+    "Content-Type: application/gzip". Otherwise use "Content-Type: text/plain"
+
+    The response is the same as for /predict, in the format negotiated with the Accept header.
+    By default we return the top 4 most confident labels for each Document, unless the endpoint is invoked
+    with the optional 'how_many' parameter, and the active model predicts them, unless the endpoint is invoked
+    with the name of a model, e.g. /predict_ids/<model>/<how_many>
+
+    :return: A list of lists of the format [ [doc_1], [doc_2], ..., [doc_N]],
+             where [doc_X] = [ [<predicted_label_1>, <confidence>],..., [[<predicted_label_M>, <confidence>]] ]
+    """
+    app.logger.info("Got a POST for /predict_ids")
+
+    served_model, error_response = resolve_model(model)
+    if error_response is not None:
+        return error_response
+
+    uncompressed_data, error_response = read_request_data()
+    if error_response is not None:
+        return error_response
 
     # parse the payload
     try:
-        json_corpus = json.loads(uncompressed_data)
+        with timed("parse"):
+            input_ids = json.loads(uncompressed_data)
     except JSONDecodeError as jde:
         app.logger.error(jde)
         return Response("{'Messsage':'Malformatted data'}",
                         status=400, mimetype='text/plain')
 
-    predict_documents = []
-    for doc in json_corpus:
-        d = Document(doc['metadata'], doc['content'])
-        predict_documents.append(d)
+    with timed("load_model"):
+        loaded_model = model_registry.get(get_model_path(served_model))
+    try:
+        validate_input_ids(input_ids, loaded_model.max_seq_len, loaded_model.vocab_size)
+    except ValueError as ex:
+        return Response(f"{{'Messsage':'Malformatted data: {ex}'}}",
+                        status=400, mimetype='text/plain')
+    g.documents = len(input_ids)
+    error_response = admit_documents(len(input_ids))
+    if error_response is not None:
+        return error_response
 
-    model_path = os.path.join("/app/trained_models/", model_name,
-                              "content/trained_models", model_name)
-    output_list = get_predictions(model_path, predict_documents, top_n=how_many)
+    check_request_deadline()
+    with timed("inference"):
+        probabilities = loaded_model.predict_token_ids(input_ids)
+    return predictions_response(rank_predictions(probabilities, loaded_model.label_array, top_n=how_many))
 
-    # finally return
-    # return type depends on what the client supports
-    if 'gzip' in request.headers.get('Accept-Encoding', ''):
-        # yes, we will return gzipped data
-        gzip_buffer = BytesIO()
-        gzip_file = gzip.GzipFile(mode='wb', fileobj=gzip_buffer)
 
-        gzip_file.write(str(output_list).encode('utf-8'))
-        gzip_file.close()
+@app.route('/jobs', methods=['POST'])
+@app.route('/jobs/<int:how_many>', methods=['POST'])
+def submit_job(how_many=4):
+    """
+    Submit a corpus for asynchronous bulk prediction.
 
-        app.logger.info("Accepts gzip, will return gzipped data")
-        response = Response(gzip_buffer.getvalue(), status=200,
-                            mimetype='application/gzip')
-        response.headers['Content-Encoding'] = 'gzip'
-        response.headers['Vary'] = 'Accept-Encoding'
-        response.headers['Content-Length'] = len(response.data)
+    The payload is the same as for /predict, a json array of documents, or NDJSON with one document per line.
+    It can optionally be gzipped, in which case the request must contain the header "Content-Type: application/gzip".
+    The corpus is spooled to disk and predicted in the background by the job runner, without holding up a worker.
+
+    :return: The status of the job as json, including its 'job_id'. Poll /jobs/<job_id> for the progress and
+             download the results from /jobs/<job_id>/results once the job is done
+    """
+    app.logger.info("Got a POST for /jobs")
+
+    served_model, error_response = resolve_model(None)
+    if error_response is not None:
+        return error_response
+
+    if request.content_type in ("text/plain", "application/x-ndjson"):
+        gzipped = False
+    elif request.content_type == "application/gzip":
+        gzipped = True
     else:
-        # no, return plain text
-        response = Response(str(output_list).encode('utf-8'), status=200,
-                            mimetype='text/plain')
-        response.headers['Content-Length'] = len(response.data)
+        return Response("{'Messsage':'Specify Content-Type in request header. "
+                        "One of 'text/plain', 'application/x-ndjson' or 'application/gzip'}",
+                        status=400, mimetype='text/plain')
+
+    if MAX_JOB_BYTES and (request.content_length or 0) > MAX_JOB_BYTES:
+        return Response(f"{{'Messsage':'The corpus is larger than {MAX_JOB_BYTES} bytes'}}",
+                        status=413, mimetype='text/plain')
+    if MAX_QUEUED_JOBS and len(job_store.list_pending()) >= MAX_QUEUED_JOBS:
+        app.logger.warning(f"Rejected a job, {MAX_QUEUED_JOBS} jobs are pending")
+        response = Response("{'Messsage':'Too many jobs are pending, retry later'}",
+                            status=503, mimetype='text/plain')
+        response.headers['Retry-After'] = str(RETRY_AFTER)
+        return response
+
+    try:
+        # chunked uploads have no Content-Length, so the cap is enforced while spooling as well
+        status = job_store.submit(request.stream, gzipped, served_model, top_n=how_many, max_bytes=MAX_JOB_BYTES)
+    except OverflowError as ex:
+        return Response(f"{{'Messsage':'{ex}'}}", status=413, mimetype='text/plain')
+    app.logger.info(f"Queued job {status['job_id']}")
+    response = Response(json.dumps(status), status=202, mimetype='application/json')
+    response.headers['Location'] = f"/jobs/{status['job_id']}"
+    return response
+
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def job_status(job_id):
+    """
+    The status of a job. 'progress' is the fraction of the uploaded corpus predicted so far.
+    """
+    status = job_store.get_status(job_id)
+    if status is None:
+        return Response("{'Messsage':'No such job'}", status=404, mimetype='text/plain')
+    status['progress'] = status['input_offset'] / status['input_bytes'] if status['input_bytes'] else 1.0
+    return Response(json.dumps(status), status=200, mimetype='application/json')
 
+
+@app.route('/jobs/<job_id>/results', methods=['GET'])
+def job_results(job_id):
+    """
+    The results of a finished job as NDJSON, one line per document in the order of the corpus.
+    Specify "Accept-Encoding: gzip" to get them gzipped.
+    """
+    status = job_store.get_status(job_id)
+    if status is None:
+        return Response("{'Messsage':'No such job'}", status=404, mimetype='text/plain')
+    if status['state'] != JOB_DONE:
+        return Response(json.dumps(status), status=409, mimetype='application/json')
+
+    results_path = job_store.results_path(job_id)
+    if 'gzip' not in request.headers.get('Accept-Encoding', ''):
+        return send_file(results_path, mimetype='application/x-ndjson')
+
+    def iter_results():
+        with open(results_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                yield chunk
+
+    response = Response(iter_compressed(iter_results(), RESPONSE_GZIP_LEVEL), status=200,
+                        mimetype='application/x-ndjson')
+    response.headers['Content-Encoding'] = 'gzip'
+    response.headers['Vary'] = 'Accept-Encoding'
     return response
 
 
+def predict_json_documents(model_name, json_documents, top_n=4):
+    """
+    Predict documents following the json schema of the challenge with the given model, as done for a job
+    """
+    return format_top_n(*get_ranked_text_predictions(get_model_path(model_name), build_corpus_texts(json_documents),
+                                                     top_n=top_n))
+
+
+def predict_texts(model_name, texts, top_n=4):
+    """
+    Predict the texts of Documents with the given model, as done by the inference executors of the async server
+    """
+    return get_ranked_text_predictions(get_model_path(model_name), texts, top_n=top_n)
+
+
+def run_job_runner(threads=1, niceness=10):
+    """
+    Run the job runner in the current process, at a lower priority and with few threads,
+    so that the interactive /predict* requests are not slowed down by jobs.
+    """
+    os.nice(niceness)
+    torch.set_num_threads(threads)
+    JobRunner(job_store, predict_json_documents, chunk_size=JOB_CHUNK_SIZE, logger=app.logger).run_forever()
+
+
 if __name__ == '__main__':
 
     # We want to download our model before the server starts
+    def prepare_server(download_model, preload_model, logger, startup_start):
+        """
+        Activate the model of MODEL_TO_LOAD, and optionally download it and load it before the server forks.
+
+        :return: Whether the server can start
+        """
+        # Download the model specified in the env. variable MODEL_TO_LOAD
+        try:
+            model_list = json.loads(os.environ['MODEL_TO_LOAD'])
+        except (KeyError, JSONDecodeError):
+            logger.error("Environmental variable MODEL_TO_LOAD not properly defined")
+            return False
+
+        # [model_name, document id in google drive] and optionally the sha256 checksum of the model archive
+        if len(model_list) not in (2, 3):
+            logger.error("Env. Variable MODEL_TO_LOAD has the wrong format")
+            return False
+
+        global model_name
+        model_name = model_list[0]
+        # the configured model is active after a restart, even if another model was swapped in before
+        try:
+            model_state.reset(model_name)
+        except OSError as ex:
+            logger.warning(f"Cannot write the model state to {model_state.state_dir}, "
+                           f"models cannot be swapped at runtime: {ex}")
+
+        # drop the metrics of earlier runs, before any process of this run records some
+        clear_multiprocess_dir()
+
+        model_gdrive_id = model_list[1]
+        model_sha256 = model_list[2] if len(model_list) == 3 else None
+
+        timings = {}
+        if download_model:
+            # the archive is only downloaded and extracted if there is no verified copy of it yet.
+            # MODEL_SOURCE can point to a local folder or a file:// URL with the archive instead of Google Drive
+            logger.info("Will donwload model before server starts")
+            artifact_cache = ModelArtifactCache(MODELS_DIR, logger=logger)
+            _, artifact_timings = artifact_cache.ensure_model(model_name,
+                                                              os.environ.get('MODEL_SOURCE', model_gdrive_id),
+                                                              sha256=model_sha256)
+            timings.update(artifact_timings)
+            logger.info("Done. Starting WSGI server")
+
+        if preload_model:
+            # load the model before gunicorn forks the workers, which then share it copy-on-write
+            logger.info(f"Preloading model {model_name}")
+            start = time.perf_counter()
+            model_registry.get(get_model_path(model_name))
+            # move the objects created so far out of reach of the garbage collector. Otherwise its
+            # bookkeeping writes to their pages in every worker and the pages are no longer shared
+            gc.freeze()
+            timings["load_model"] = time.perf_counter() - start
+
+        timings["total"] = time.perf_counter() - startup_start
+        observe_startup(timings)
+        logger.info("Startup took " + ", ".join(f"{phase} {seconds:.2f}s" for phase, seconds in timings.items()))
+        return True
+
     class GunicornServer(Command):
 
         description = 'Run the backend within Gunicorn'
 
-        def __init__(self, host='127.0.0.1', port=5001, workers=6, timeout=3600,
+        def __init__(self, host='127.0.0.1', port=5001, workers=None, threads=1, timeout=3600,
                      worker_class="sync",
-                     logger=None, download_model=False):
+                     logger=None, download_model=False, preload_model=False, job_runner=False,
+                     job_runner_threads=1, intra_op_threads=None, inter_op_threads=1, pin_cores=False):
             self.port = port
             self.host = host
+            # by default as many workers as fit the cores of the container, see cpu_topology.plan_layout
             self.workers = workers
+            self.threads = threads
+            self.intra_op_threads = intra_op_threads
+            self.inter_op_threads = inter_op_threads
+            self.pin_cores = pin_cores
             self.timeout = timeout
             self.worker_class = worker_class
             self.logger = logger
             self.download_model = download_model
+            self.preload_model = preload_model
+            self.job_runner = job_runner
+            self.job_runner_threads = job_runner_threads
             super().__init__()
 
         def get_options(self):
@@ -301,6 +1043,22 @@ if __name__ == '__main__':
                        dest='workers',
                        type=int,
                        default=self.workers),
+                Option('-n', '--threads',
+                       dest='threads',
+                       type=int,
+                       default=self.threads),
+                Option('--intra-op-threads',
+                       dest='intra_op_threads',
+                       type=int,
+                       default=self.intra_op_threads),
+                Option('--inter-op-threads',
+                       dest='inter_op_threads',
+                       type=int,
+                       default=self.inter_op_threads),
+                Option('--pin-cores',
+                       dest="pin_cores",
+                       type=bool,
+                       default=self.pin_cores),
                 Option('-k', '--worker-class',
                        dest='worker_class',
                        type=str,
@@ -309,6 +1067,18 @@ if __name__ == '__main__':
                        dest="download_model",
                        type=bool,
                        default=self.download_model),
+                Option('-m', '--preload-model',
+                       dest="preload_model",
+                       type=bool,
+                       default=self.preload_model),
+                Option('-j', '--job-runner',
+                       dest="job_runner",
+                       type=bool,
+                       default=self.job_runner),
+                Option('--job-runner-threads',
+                       dest="job_runner_threads",
+                       type=int,
+                       default=self.job_runner_threads),
                 Option('-l', '--logger',
                        dest="logger",
                        default=self.logger)
@@ -316,75 +1086,410 @@ if __name__ == '__main__':
 
         def __call__(self, application=None, *arguments, **kwargs):
 
+            startup_start = time.perf_counter()
             host = kwargs['host']
             port = kwargs['port']
             workers = kwargs['workers']
+            threads = kwargs['threads']
             worker_class = kwargs['worker_class']
             timeout = kwargs['timeout']
             download_model = kwargs['download_model']
+            preload_model = kwargs['preload_model']
+            job_runner = kwargs['job_runner']
+            job_runner_threads = kwargs['job_runner_threads']
+            pin_cores = kwargs['pin_cores']
             logger = kwargs['logger']
 
-            # Download the model specified in the env. variable MODEL_TO_LOAD
-            try:
-                model_list = json.loads(os.environ['MODEL_TO_LOAD'])
-            except (KeyError, JSONDecodeError):
-                logger.error("Environmental variable MODEL_TO_LOAD not properly defined")
-                return
-
-            if len(model_list) != 2:
-                logger.error("Env. Variable MODEL_TO_LOAD has the wrong format")
+            # split the cores between the workers, so that their torch threads do not oversubscribe them
+            layout = plan_layout(workers=workers, intra_op_threads=kwargs['intra_op_threads'],
+                                 inter_op_threads=kwargs['inter_op_threads'])
+            workers = layout['workers']
+            logger.info(f"Worker layout: {layout}, pinned to cores: {bool(pin_cores)}")
+            # a model swap waits until that many workers loaded the new model
+            os.environ['SERVER_WORKERS'] = str(workers)
+            # room for the slots of the workers that replace others, e.g. on a reload
+            admission.reset(slots=2 * workers + 1)
+            # the admission control only sees the requests a worker handles. With it, the connections that wait to
+            # be accepted, and those a worker accepted but has no thread for yet, are bounded as well
+            if admission.max_pending_documents:
+                backlog = int(os.environ.get('SERVER_BACKLOG', workers * threads))
+                worker_connections = int(os.environ.get('SERVER_WORKER_CONNECTIONS', 2 * threads))
+            else:
+                backlog = int(os.environ.get('SERVER_BACKLOG', 2048))
+                worker_connections = int(os.environ.get('SERVER_WORKER_CONNECTIONS', 1000))
+
+            if not prepare_server(download_model, preload_model, logger, startup_start):
                 return
 
-            global model_name
-            model_name = model_list[0]
+            # the job runner predicts the bulk jobs in its own process, next to the gunicorn workers
+            job_runner_supervisor = None
+            if job_runner:
+                job_runner_supervisor = JobRunnerSupervisor([sys.executable, os.path.abspath(__file__), 'job-runner',
+                                                             '--threads', str(job_runner_threads),
+                                                             '--niceness', '10'], logger=logger)
 
-            model_gdrive_id = model_list[1]
+            logger.info("Started WSGI server")
+            # clear kwargs
+            self.server_options = {}
 
-            if download_model:
-                logger.info("Will donwload model before server starts")
+            def assign_cpu_slot(server, worker):
+                # called in the master before a worker is forked. A restarted worker takes over the free slot
+                used_slots = {getattr(w, 'cpu_slot', None) for w in server.WORKERS.values()}
+                worker.cpu_slot = min(set(range(len(used_slots) + 1)) - used_slots)
 
-                # download the model
-                url = 'https://drive.google.com/uc?id=' + model_gdrive_id
-                output = '/app/trained_models/' + model_name + ".zip"
+            def init_worker(server, worker):
+                configure_worker(layout, slot=worker.cpu_slot, pin=pin_cores)
+                admission.set_slot(worker.cpu_slot)
+                swap_watcher.ensure_started()
 
-                logger.debug(f"Downloading {url} to {output}")
-                gdown.download(url, output, quiet=False)
+            def clean_up_worker(server, worker):
+                mark_process_dead(worker.pid)
+                admission.clear_slot(worker.cpu_slot)
 
-                # uncompress the model
-                logger.debug(f"Decompressing")
-                with zipfile.ZipFile(output, 'r') as zip_ref:
-                    zip_ref.extractall(os.path.join("/app/trained_models/", model_name))
+            def start_job_runner(server):
+                if job_runner_supervisor is not None:
+                    job_runner_supervisor.start()
 
-                logger.info("Done. Starting WSGI server")
+            def stop_job_runner(server):
+                if job_runner_supervisor is not None:
+                    job_runner_supervisor.stop()
 
-            logger.info("Started WSGI server")
-            # clear kwargs
-            self.server_options = {}
-
-            class FlaskApplication(Application):
-                def init(self, parser, opts, args):
-                    return {
+            class FlaskApplication(BaseApplication):
+                # configured explicitly, gunicorn's Application would parse our command line options as its own
+                def load_config(self):
+                    config = {
                         'bind': '{0}:{1}'.format(host, port),
                         'workers': workers,
+                        'threads': threads,
                         'worker_class': worker_class,
-                        'timeout': timeout
+                        'timeout': timeout,
+                        'backlog': backlog,
+                        'worker_connections': worker_connections,
+                        'pre_fork': assign_cpu_slot,
+                        'post_fork': init_worker,
+                        'child_exit': clean_up_worker,
+                        'when_ready': start_job_runner,
+                        'on_exit': stop_job_runner
                     }
+                    for key, value in config.items():
+                        self.cfg.set(key, value)
 
                 def load(self):
                     return app
 
             FlaskApplication().run()
 
+    class AsyncServer(Command):
+
+        description = 'Run the /predict endpoints behind an async front end with a pool of inference executors'
+
+        def __init__(self, host='127.0.0.1', port=5001, executors=None, io_threads=4, logger=None,
+                     download_model=False, preload_model=True, intra_op_threads=None, inter_op_threads=1,
+                     pin_cores=False):
+            self.port = port
+            self.host = host
+            # by default as many executors as fit the cores of the container, see cpu_topology.plan_layout
+            self.executors = executors
+            self.io_threads = io_threads
+            self.intra_op_threads = intra_op_threads
+            self.inter_op_threads = inter_op_threads
+            self.pin_cores = pin_cores
+            self.logger = logger
+            self.download_model = download_model
+            self.preload_model = preload_model
+            super().__init__()
+
+        def get_options(self):
+            return (
+                Option('-h', '--host',
+                       dest='host',
+                       default=self.host),
+                Option('-p', '--port',
+                       dest='port',
+                       type=int,
+                       default=self.port),
+                Option('-e', '--executors',
+                       dest='executors',
+                       type=int,
+                       default=self.executors,
+                       help="How many inference executors, i.e. copies of the model, predict at a time"),
+                Option('--io-threads',
+                       dest='io_threads',
+                       type=int,
+                       default=self.io_threads,
+                       help="How many threads decompress, parse and encode the payloads"),
+                Option('--intra-op-threads',
+                       dest='intra_op_threads',
+                       type=int,
+                       default=self.intra_op_threads),
+                Option('--inter-op-threads',
+                       dest='inter_op_threads',
+                       type=int,
+                       default=self.inter_op_threads),
+                Option('--pin-cores',
+                       dest="pin_cores",
+                       type=bool,
+                       default=self.pin_cores),
+                Option('-d', '--download-model',
+                       dest="download_model",
+                       type=bool,
+                       default=self.download_model),
+                Option('-m', '--preload-model',
+                       dest="preload_model",
+                       type=bool,
+                       default=self.preload_model),
+                Option('-l', '--logger',
+                       dest="logger",
+                       default=self.logger)
+            )
+
+        def __call__(self, application=None, *arguments, **kwargs):
+            # aiohttp is only needed by this command
+            from async_frontend import AsyncFrontend
+
+            startup_start = time.perf_counter()
+            logger = kwargs['logger']
+            # the executors split the cores like gunicorn workers would
+            layout = plan_layout(workers=kwargs['executors'], intra_op_threads=kwargs['intra_op_threads'],
+                                 inter_op_threads=kwargs['inter_op_threads'])
+            logger.info(f"Executor layout: {layout}, pinned to cores: {bool(kwargs['pin_cores'])}")
+
+            if not prepare_server(kwargs['download_model'], kwargs['preload_model'], logger, startup_start):
+                return
+
+            frontend = AsyncFrontend(predict_texts, get_active_model_name, layout, admission,
+                                     allowed_models=ALLOWED_MODELS,
+                                     pin=kwargs['pin_cores'],
+                                     max_request_documents=MAX_REQUEST_DOCUMENTS,
+                                     max_request_bytes=MAX_REQUEST_BYTES,
+                                     request_timeout=REQUEST_TIMEOUT,
+                                     retry_after=RETRY_AFTER,
+                                     compress_level=RESPONSE_GZIP_LEVEL,
+                                     min_compress_bytes=RESPONSE_GZIP_MIN_BYTES,
+                                     io_threads=kwargs['io_threads'],
+                                     logger=logger)
+            logger.info("Started async server")
+            frontend.run(kwargs['host'], kwargs['port'], model_name)
+
+    class JobRunnerCommand(Command):
+
+        description = 'Run the job runner for the bulk prediction jobs, e.g. as a sidecar of the gunicorn server'
+
+        def __init__(self, threads=1, niceness=0):
+            self.threads = threads
+            self.niceness = niceness
+            super().__init__()
+
+        def get_options(self):
+            return (
+                Option('-n', '--threads',
+                       dest='threads',
+                       type=int,
+                       default=self.threads),
+                Option('--niceness',
+                       dest='niceness',
+                       type=int,
+                       default=self.niceness),
+            )
+
+        def __call__(self, application=None, *arguments, **kwargs):
+            run_job_runner(kwargs['threads'], niceness=kwargs['niceness'])
+
+    class PredictFileCommand(Command):
+
+        description = 'Predict a corpus file offline, sharded across several processes'
+
+        def __init__(self, processes=2, chunk_size=256, top_n=4):
+            self.processes = processes
+            self.chunk_size = chunk_size
+            self.top_n = top_n
+            super().__init__()
+
+        def get_options(self):
+            return (
+                Option('-i', '--input',
+                       dest='input_path',
+                       required=True,
+                       help="A json array or NDJSON file of documents, optionally gzipped"),
+                Option('-o', '--output',
+                       dest='output_prefix',
+                       required=True,
+                       help="The results are written to <output>-<shard>-of-<processes>.ndjson"),
+                Option('-m', '--model',
+                       dest='model',
+                       default=None,
+                       help="The name of a model in /app/trained_models. Defaults to the model in MODEL_TO_LOAD"),
+                Option('-n', '--processes',
+                       dest='processes',
+                       type=int,
+                       default=self.processes),
+                Option('-c', '--chunk-size',
+                       dest='chunk_size',
+                       type=int,
+                       default=self.chunk_size),
+                Option('-t', '--top-n',
+                       dest='top_n',
+                       type=int,
+                       default=self.top_n),
+                Option('-z', '--gzip',
+                       dest='gzipped',
+                       action='store_true'),
+                Option('--pin-cores',
+                       dest='pin_cores',
+                       action='store_true'),
+            )
+
+        def __call__(self, application=None, *arguments, **kwargs):
+            model = kwargs['model']
+            if model is None:
+                try:
+                    model = json.loads(os.environ['MODEL_TO_LOAD'])[0]
+                except (KeyError, IndexError, JSONDecodeError):
+                    app.logger.error("Specify --model or define the environmental variable MODEL_TO_LOAD")
+                    return
+
+            # loaded before the processes are forked, so that they share it
+            model_registry.get(get_model_path(model))
+            stats = predict_file(kwargs['input_path'], kwargs['output_prefix'],
+                                 partial(predict_json_documents, model, top_n=kwargs['top_n']),
+                                 processes=kwargs['processes'], chunk_size=kwargs['chunk_size'],
+                                 gzipped=kwargs['gzipped'], pin_cores=kwargs['pin_cores'], logger=app.logger)
+            message = (f"Predicted {stats['documents']} documents in {stats['seconds']:.1f}s, "
+                       f"{stats['documents_per_second']:.1f} docs/sec")
+            app.logger.info(message)
+            print(message)
+
+    class ValidateQuantizationCommand(Command):
+
+        description = 'Compare the predictions, speed and size of a model with those of its int8 quantized version'
+
+        def __init__(self, documents=500, top_n=4):
+            self.documents = documents
+            self.top_n = top_n
+            super().__init__()
+
+        def get_options(self):
+            return (
+                Option('-i', '--input',
+                       dest='input_path',
+                       required=True,
+                       help="A json array or NDJSON file of documents, optionally gzipped"),
+                Option('-m', '--model',
+                       dest='model',
+                       default=None,
+                       help="The name of a model in /app/trained_models. Defaults to the model in MODEL_TO_LOAD"),
+                Option('-d', '--documents',
+                       dest='documents',
+                       type=int,
+                       default=self.documents,
+                       help="How many documents of the corpus to compare on"),
+                Option('-t', '--top-n',
+                       dest='top_n',
+                       type=int,
+                       default=self.top_n),
+            )
+
+        def __call__(self, application=None, *arguments, **kwargs):
+            model = kwargs['model']
+            if model is None:
+                try:
+                    model = json.loads(os.environ['MODEL_TO_LOAD'])[0]
+                except (KeyError, IndexError, JSONDecodeError):
+                    app.logger.error("Specify --model or define the environmental variable MODEL_TO_LOAD")
+                    return
+
+            json_documents = list(islice(iter_corpus_file(kwargs['input_path']), kwargs['documents']))
+            if not json_documents:
+                app.logger.error(f"No documents in {kwargs['input_path']}")
+                return
+            texts = build_corpus_texts(json_documents)
+            model_path = get_model_path(model)
+            # the models are loaded one after the other, so that each takes the memory it grew the process by
+            inferencer, memory_mb = load_measured(lambda: model_loader(model_path))
+            reference = LoadedModel(model_path, inferencer, memory_mb=memory_mb)
+            inferencer, memory_mb = load_measured(lambda: quantize_inferencer(model_loader(model_path)))
+            quantized = LoadedModel(model_path, inferencer, quantized=True, memory_mb=memory_mb)
+            report = compare_models(reference, quantized, texts, top_n=kwargs['top_n'])
+            app.logger.info(f"Quantization of {model}: {report}")
+            print(json.dumps(report, indent=2))
+
+    class AutotuneCommand(Command):
+
+        description = ('Find the split of the cores between workers, intra- and inter-op threads '
+                       'with the highest throughput')
+
+        def __init__(self, documents=200, docs_per_request=10, requests=50):
+            self.documents = documents
+            self.docs_per_request = docs_per_request
+            self.requests = requests
+            super().__init__()
+
+        def get_options(self):
+            return (
+                Option('-i', '--input',
+                       dest='input_path',
+                       default=None,
+                       help="A json array or NDJSON file of documents. Defaults to synthetic documents"),
+                Option('-d', '--documents',
+                       dest='documents',
+                       type=int,
+                       default=self.documents),
+                Option('--docs-per-request',
+                       dest='docs_per_request',
+                       type=int,
+                       default=self.docs_per_request),
+                Option('-r', '--requests',
+                       dest='requests',
+                       type=int,
+                       default=self.requests,
+                       help="How many requests to time per layout"),
+                Option('--pin-cores',
+                       dest='pin_cores',
+                       action='store_true'),
+            )
+
+        def __call__(self, application=None, *arguments, **kwargs):
+            # the benchmark tooling is only needed by this command
+            from autotune import autotune, candidate_layouts, thread_args
+            from bench_text_extraction import make_corpus
+
+            if kwargs['input_path']:
+                corpus = list(islice(iter_corpus_file(kwargs['input_path']), kwargs['documents']))
+            else:
+                corpus = make_corpus(kwargs['documents'])
+            results = autotune(candidate_layouts(), corpus, docs_per_request=kwargs['docs_per_request'],
+                               requests=kwargs['requests'], pin=kwargs['pin_cores'], logger=app.logger)
+            print(f"{'workers':>8} {'intra-op':>9} {'inter-op':>9} {'docs/s':>9} {'p99 ms':>9} {'errors':>7}")
+            for r in results:
+                print(f"{r['workers']:>8} {r['intra_op_threads']:>9} {r['inter_op_threads']:>9} "
+                      f"{r['documents_per_second']:>9.1f} {r['p99_ms'] or 0:>9.1f} {r['errors']:>7}")
+            best = results[0]
+            print("Best layout: python serve_model.py gunicorn " +
+                  " ".join(["-w", str(best['workers'])] + thread_args(best, pin=kwargs['pin_cores'])))
+
     manager = Manager(app)
 
     manager.add_command('gunicorn', GunicornServer(host='0.0.0.0',
                                                    port=5001,
-                                                   workers=4,
+                                                   workers=None,
+                                                   threads=1,
                                                    worker_class="sync",
                                                    timeout=3600,
                                                    logger=app.logger,
-                                                   download_model=True))
+                                                   download_model=True,
+                                                   preload_model=True,
+                                                   job_runner=True,
+                                                   job_runner_threads=1))
+    manager.add_command('async-server', AsyncServer(host='0.0.0.0',
+                                                    port=5001,
+                                                    executors=None,
+                                                    io_threads=4,
+                                                    logger=app.logger,
+                                                    download_model=True,
+                                                    preload_model=True))
+    manager.add_command('job-runner', JobRunnerCommand(threads=1))
+    manager.add_command('predict-file', PredictFileCommand(processes=2, chunk_size=256, top_n=4))
+    manager.add_command('validate-quantization', ValidateQuantizationCommand(documents=500, top_n=4))
+    manager.add_command('autotune', AutotuneCommand(documents=200, docs_per_request=10, requests=50))
 
-    parser = OptionParser()
-    (options, args) = parser.parse_args()
     manager.run()
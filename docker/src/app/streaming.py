@@ -0,0 +1,211 @@
+import codecs
+import json
+import zlib
+
+from itertools import chain, islice
+
+# how many bytes we read from the request stream at a time
+READ_SIZE = 64 * 1024
+# the characters a single document or line may have, so that a malformatted stream cannot fill the memory
+MAX_DOCUMENT_SIZE = 64 * 1024 * 1024
+
+
+def iter_body(stream, gzipped=False, read_size=READ_SIZE):
+    """
+    Read a (possibly gzipped) request body incrementally.
+
+    :param stream: A file-like object, e.g. flask.request.stream
+    :param gzipped: Whether the body is gzipped. Concatenated gzip members are supported
+    :param read_size: How many bytes to read at a time
+    :return: A generator over the uncompressed chunks of the body
+    """
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS) if gzipped else None
+    while True:
+        data = stream.read(read_size)
+        if not data:
+            break
+        if decompressor is None:
+            yield data
+            continue
+        while data:
+            chunk = decompressor.decompress(data)
+            if chunk:
+                yield chunk
+            # anything after the end of a gzip member is the start of the next one
+            data = decompressor.unused_data
+            if decompressor.eof:
+                decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            else:
+                data = b""
+    if decompressor is not None:
+        chunk = decompressor.flush()
+        if chunk:
+            yield chunk
+
+
+def iter_text(chunks, encoding="utf-8"):
+    """
+    Decode a stream of byte chunks, taking care of multi-byte characters split between chunks.
+    """
+    decoder = codecs.getincrementaldecoder(encoding)()
+    for chunk in chunks:
+        text = decoder.decode(chunk)
+        if text:
+            yield text
+    text = decoder.decode(b"", final=True)
+    if text:
+        yield text
+
+
+def iter_lines(chunks, max_line_size=MAX_DOCUMENT_SIZE):
+    """
+    Split a stream of byte chunks into lines of text, without the trailing new-line.
+
+    :raises ValueError: If a line is longer than 'max_line_size' characters
+    """
+    return _split_lines(iter_text(chunks), max_line_size)
+
+
+def _split_lines(text_chunks, max_line_size):
+    rest = ""
+    for text in text_chunks:
+        lines = (rest + text).split("\n")
+        rest = lines.pop()
+        for line in lines:
+            yield line
+        if len(rest) > max_line_size:
+            raise ValueError(f"A line is longer than {max_line_size} characters")
+    if rest:
+        yield rest
+
+
+def iter_json_documents(chunks, max_document_size=MAX_DOCUMENT_SIZE):
+    """
+    Parse the documents of a JSON corpus incrementally.
+
+    The corpus is either a JSON array of documents, as expected by /predict, or NDJSON with one document per line.
+    Only the document being parsed and the unparsed rest of the last chunk are kept in memory.
+
+    :param chunks: A stream of byte chunks, e.g. as returned by iter_body
+    :param max_document_size: The characters a document may have. Since an incomplete document cannot be told from
+                              a malformatted one, it bounds the data read after a malformatted document as well
+    :return: A generator over the parsed documents
+    :raises ValueError: If the data is malformatted
+    """
+    text_chunks = iter_text(chunks)
+    decoder = json.JSONDecoder()
+    buffer = ""
+    # skip the leading whitespace, so we know whether we got an array or NDJSON
+    for text in text_chunks:
+        buffer += text
+        if buffer.strip():
+            break
+    buffer = buffer.lstrip()
+    if buffer == "":
+        return
+
+    if not buffer.startswith("["):
+        # NDJSON, one document per line
+        for line in _split_lines(chain([buffer], text_chunks), max_document_size):
+            if line.strip():
+                yield json.loads(line)
+        return
+
+    position = 1
+    expect_separator = False
+    # after a ',' another document must follow
+    expect_document = False
+    exhausted = False
+    while True:
+        # skip whitespace and the separators between documents
+        while position < len(buffer) and buffer[position] in " \t\r\n":
+            position += 1
+        if position < len(buffer):
+            if buffer[position] == "]":
+                if expect_document:
+                    raise ValueError("Unexpected ']' after ',' in JSON array")
+                if buffer[position + 1:].strip() or any(text.strip() for text in text_chunks):
+                    raise ValueError("Unexpected data after the end of the JSON array")
+                return
+            if expect_separator:
+                if buffer[position] != ",":
+                    raise ValueError(f"Expected ',' or ']' in JSON array, got '{buffer[position]}'")
+                position += 1
+                expect_separator = False
+                expect_document = True
+                continue
+            try:
+                document, position = decoder.raw_decode(buffer, position)
+                expect_separator = True
+                expect_document = False
+                # drop what has been parsed already
+                buffer = buffer[position:]
+                position = 0
+                yield document
+                continue
+            except json.JSONDecodeError:
+                # most likely the document is not complete yet
+                if exhausted:
+                    raise
+                if len(buffer) - position > max_document_size:
+                    raise ValueError(f"A document is malformatted or longer than {max_document_size} characters")
+        elif exhausted:
+            raise ValueError("Unexpected end of the JSON array")
+
+        text = next(text_chunks, None)
+        if text is None:
+            exhausted = True
+        else:
+            buffer = buffer[position:] + text
+            position = 0
+
+
+def iter_corpus_file(path):
+    """
+    Parse the documents of a corpus file incrementally. The file is a json array or NDJSON, optionally gzipped.
+    """
+    with open(path, "rb") as f:
+        gzipped = f.read(2) == b"\x1f\x8b"
+        f.seek(0)
+        for document in iter_json_documents(iter_body(f, gzipped=gzipped)):
+            yield document
+
+
+def iter_chunks(iterable, chunk_size):
+    """
+    Split an iterable into lists of at most chunk_size items.
+    """
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, chunk_size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def iter_compressed(chunks, compress_level=6):
+    """
+    Gzip a stream of byte chunks. Every chunk is flushed, so that the client can decompress it as soon as it arrives.
+    """
+    compressor = zlib.compressobj(compress_level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        data = compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def iter_ndjson(records, gzipped=False, compress_level=6):
+    """
+    Encode records as NDJSON, one record per line, optionally as a gzip stream.
+
+    :param records: An iterable over lists of JSON-serializable records. Each list is encoded in one go
+    :param gzipped: Whether to gzip the output
+    :param compress_level: The gzip compression level
+    :return: A generator over the encoded chunks
+    """
+    chunks = ("".join(json.dumps(record) + "\n" for record in record_list).encode("utf-8")
+              for record_list in records)
+    if gzipped:
+        return iter_compressed(chunks, compress_level)
+    return (chunk for chunk in chunks if chunk)
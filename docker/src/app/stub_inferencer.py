@@ -0,0 +1,102 @@
+"""
+A deterministic stand-in for the FARM Inferencer, so that the server can be benchmarked offline without model weights.
+
+Select it with the environmental variable INFERENCER=stub. It is configured with
+    STUB_LABELS: the number of labels (default 100)
+    STUB_DELAY_MS: the simulated cost of an inference call in milliseconds (default 20)
+    STUB_DELAY_PER_DOC_MS: the simulated cost of every document in milliseconds (default 2)
+"""
+import numpy as np
+import os
+import time
+import zlib
+
+
+class _StubTokenizer:
+    """
+    Mimics the parts of a transformers tokenizer used by the server. Every word is a token, with a hashed id
+    """
+    is_fast = True
+    vocab_size = 30000
+    pad_token_id = 0
+    cls_token_id = 1
+    sep_token_id = 2
+
+    def __len__(self):
+        return self.vocab_size
+
+    @staticmethod
+    def tokenize(text):
+        return text.split()
+
+    def batch_encode_plus(self, texts, add_special_tokens=True):
+        input_ids = [[3 + zlib.crc32(word.encode("utf-8")) % (self.vocab_size - 3) for word in self.tokenize(text)]
+                     for text in texts]
+        if add_special_tokens:
+            input_ids = [self.build_inputs_with_special_tokens(ids) for ids in input_ids]
+        return {'input_ids': input_ids}
+
+    @staticmethod
+    def num_special_tokens_to_add():
+        return 2
+
+    def build_inputs_with_special_tokens(self, ids):
+        return [self.cls_token_id] + list(ids) + [self.sep_token_id]
+
+
+class _StubProcessor:
+
+    def __init__(self, n_labels, max_seq_len=256):
+        self.tasks = {'text_classification': {'label_list': [f"stub-label-{i}" for i in range(n_labels)]}}
+        self.max_seq_len = max_seq_len
+        self.tokenizer = _StubTokenizer()
+
+
+class StubInferencer:
+    """
+    Mimics the parts of farm.infer.Inferencer used by the server.
+
+    The probabilities of a text are derived from a hash of the text, so the same text always gets the same prediction.
+    """
+
+    def __init__(self, n_labels=100, delay_ms=20, delay_per_doc_ms=2, batch_size=4):
+        self.processor = _StubProcessor(n_labels)
+        self.n_labels = n_labels
+        self.delay = delay_ms / 1000.0
+        self.delay_per_doc = delay_per_doc_ms / 1000.0
+        self.batch_size = batch_size
+
+    def predict_proba(self, text):
+        return self._proba(zlib.crc32(text.encode("utf-8")))
+
+    def _proba(self, seed):
+        rng = np.random.RandomState(seed)
+        logits = rng.normal(size=self.n_labels).astype(np.float32) * 3
+        proba = np.exp(logits - logits.max())
+        return proba / proba.sum()
+
+    def inference_from_dicts(self, dicts):
+        time.sleep(self.delay + self.delay_per_doc * len(dicts))
+        # like FARM, return one entry per inference batch
+        result = []
+        for start in range(0, len(dicts), self.batch_size):
+            predictions = [{"label": None, "probability": self.predict_proba(d["text"])}
+                           for d in dicts[start:start + self.batch_size]]
+            result.append({"task": "text_classification", "predictions": predictions})
+        return result
+
+    def predict_token_ids(self, input_ids):
+        """
+        Like inference_from_dicts, for pre-tokenized texts
+        """
+        time.sleep(self.delay + self.delay_per_doc * len(input_ids))
+        return [self._proba(zlib.crc32(np.asarray(ids, dtype=np.int64).tobytes())) for ids in input_ids]
+
+
+def load_stub_inferencer(model_path, num_processes=0):
+    """
+    A loader for the ModelRegistry, which ignores the model path
+    """
+    return StubInferencer(n_labels=int(os.environ.get('STUB_LABELS', 100)),
+                          delay_ms=float(os.environ.get('STUB_DELAY_MS', 20)),
+                          delay_per_doc_ms=float(os.environ.get('STUB_DELAY_PER_DOC_MS', 2)))
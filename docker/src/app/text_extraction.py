@@ -0,0 +1,150 @@
+import os
+
+from bs4 import BeautifulSoup
+from bs4.dammit import EntitySubstitution
+from html.parser import HTMLParser
+
+try:
+    import lxml  # noqa: F401
+    HAS_LXML = True
+except ImportError:
+    HAS_LXML = False
+
+
+def extract_text_bs4(html):
+    """
+    Extract the text of an html document with BeautifulSoup and the pure-python "html.parser" tree builder.
+    This is the reference backend, all other backends are checked against it.
+    """
+    return BeautifulSoup(html, "html.parser").text
+
+
+def extract_text_lxml(html):
+    """
+    Extract the text of an html document with BeautifulSoup and the C-backed lxml tree builder.
+    lxml repairs malformatted html differently than "html.parser", so the text can differ on broken documents.
+    """
+    return BeautifulSoup(html, "lxml").text
+
+
+class _TagStripper(HTMLParser):
+    """
+    Collects the text of an html document without building a document tree.
+
+    Mirrors what BeautifulSoup(html, "html.parser").text returns: the text nodes and CDATA sections, but not
+    the content of <script>, <style> and <template> tags, comments, doctypes or processing instructions.
+    Character references and whitespace-only strings are handled as in BeautifulSoup.
+    """
+
+    # tags whose content BeautifulSoup does not consider text
+    SKIPPED_TAGS = {"script", "style", "template"}
+    # tags in which BeautifulSoup does not collapse whitespace-only strings
+    PRESERVE_WHITESPACE_TAGS = {"pre", "textarea"}
+    ASCII_SPACES = "\x20\x0a\x09\x0c\x0d"
+
+    def __init__(self):
+        super().__init__(convert_charrefs=False)
+        self.parts = []
+        self.current_data = []
+        self.skipped_depth = 0
+        self.preserve_depth = 0
+
+    def end_data(self):
+        # called at every tag boundary, like BeautifulSoup.endData
+        if not self.current_data:
+            return
+        data = "".join(self.current_data)
+        self.current_data = []
+        if self.skipped_depth > 0:
+            return
+        if self.preserve_depth == 0 and data.strip(self.ASCII_SPACES) == "":
+            data = "\n" if "\n" in data else " "
+        self.parts.append(data)
+
+    def handle_starttag(self, tag, attrs):
+        self.end_data()
+        if tag in self.SKIPPED_TAGS:
+            self.skipped_depth += 1
+        if tag in self.PRESERVE_WHITESPACE_TAGS:
+            self.preserve_depth += 1
+
+    def handle_endtag(self, tag):
+        self.end_data()
+        if tag in self.SKIPPED_TAGS and self.skipped_depth > 0:
+            self.skipped_depth -= 1
+        if tag in self.PRESERVE_WHITESPACE_TAGS and self.preserve_depth > 0:
+            self.preserve_depth -= 1
+
+    def handle_data(self, data):
+        self.current_data.append(data)
+
+    def handle_charref(self, name):
+        codepoint = int(name[1:], 16) if name.startswith(("x", "X")) else int(name)
+        if codepoint == 0 or 0xD800 <= codepoint <= 0xDFFF or codepoint > 0x10FFFF:
+            data = "\N{REPLACEMENT CHARACTER}"
+        elif 0x80 <= codepoint <= 0x9F:
+            # these references are usually meant as windows-1252, e.g. &#150; for an en dash
+            try:
+                data = bytes([codepoint]).decode("windows-1252")
+            except UnicodeDecodeError:
+                data = chr(codepoint)
+        else:
+            data = chr(codepoint)
+        self.current_data.append(data)
+
+    def handle_entityref(self, name):
+        character = EntitySubstitution.HTML_ENTITY_TO_CHARACTER.get(name)
+        self.current_data.append(character if character is not None else "&" + name)
+
+    def handle_comment(self, data):
+        self.end_data()
+
+    def handle_decl(self, decl):
+        self.end_data()
+
+    def handle_pi(self, data):
+        self.end_data()
+
+    def unknown_decl(self, data):
+        self.end_data()
+        if data.upper().startswith("CDATA[") and self.skipped_depth == 0:
+            self.parts.append(data[len("CDATA["):])
+
+    def close(self):
+        super().close()
+        self.end_data()
+
+
+def extract_text_stripper(html):
+    """
+    Extract the text of an html document with a streaming tag stripper, which skips building a document tree.
+    """
+    stripper = _TagStripper()
+    stripper.feed(html)
+    stripper.close()
+    return "".join(stripper.parts)
+
+
+EXTRACTION_BACKENDS = {
+    "html.parser": extract_text_bs4,
+    "stripper": extract_text_stripper,
+}
+if HAS_LXML:
+    EXTRACTION_BACKENDS["lxml"] = extract_text_lxml
+
+# the backend used by Document, can be changed with the environmental variable TEXT_EXTRACTION_BACKEND
+DEFAULT_BACKEND = os.environ.get("TEXT_EXTRACTION_BACKEND", "html.parser")
+if DEFAULT_BACKEND not in EXTRACTION_BACKENDS:
+    raise ValueError(f"Unknown text extraction backend '{DEFAULT_BACKEND}'. "
+                     f"One of {', '.join(EXTRACTION_BACKENDS)}")
+
+
+def extract_text(html, backend=None):
+    """
+    Extract the text of an html document.
+
+    :param html: The html document
+    :param backend: One of EXTRACTION_BACKENDS. Defaults to DEFAULT_BACKEND
+    :return: The text of the document, with all tags removed
+    """
+    return EXTRACTION_BACKENDS[backend or DEFAULT_BACKEND](html)
@@ -0,0 +1,179 @@
+"""
+A fast path from texts to model inputs, which bypasses the tokenization of the FARM Processor.
+
+    1. Texts are cut to a character budget derived from the max_seq_len of the model before they are tokenized,
+       since everything beyond max_seq_len tokens is discarded anyway. The cut is exact: texts that turn out to have
+       fewer tokens than the model takes are tokenized again in full.
+    2. All texts of a call are tokenized in one batch by a fast (Rust) tokenizer.
+    3. The input ids of texts we have seen before are served from an LRU cache, as compact int32 arrays.
+The input ids are then predicted in batches of similar length, see run_model.
+"""
+import hashlib
+import numpy as np
+import threading
+
+from collections import OrderedDict
+from bucketing import plan_batches
+
+
+def load_fast_tokenizer(tokenizer, model_path, logger=None):
+    """
+    :param tokenizer: The tokenizer of the FARM Processor
+    :param model_path: The path of the FARM model, where the Processor saved the files of its tokenizer
+    :return: A fast tokenizer equivalent to 'tokenizer', or 'tokenizer' itself if there is none
+    """
+    if getattr(tokenizer, 'is_fast', False):
+        return tokenizer
+    try:
+        from transformers import AutoTokenizer
+        return AutoTokenizer.from_pretrained(model_path, use_fast=True)
+    except Exception as ex:
+        if logger:
+            logger.warning(f"No fast tokenizer for {model_path}, using {type(tokenizer).__name__}: {ex}")
+        return tokenizer
+
+
+def pre_truncate(text, char_budget):
+    """
+    Cut a text after the last whitespace within 'char_budget' characters. The words before the cut are tokenized
+    the same as in the full text, since tokenizers split texts at whitespace first.
+
+    :return: The text, cut or not
+    """
+    if char_budget is None or len(text) <= char_budget:
+        return text
+    cut = text.rfind(" ", 0, char_budget + 1)
+    if cut <= 0:
+        # a single huge word, which we cannot cut safely
+        return text
+    return text[:cut]
+
+
+class FastTokenizer:
+    """
+    Turns texts into the input ids of a model, truncated to its max_seq_len like the FARM Processor does.
+    """
+
+    def __init__(self, tokenizer, max_seq_len, cache_size=10000, chars_per_token=8.0):
+        """
+        :param tokenizer: A tokenizer of the transformers library, preferably a fast one
+        :param max_seq_len: The maximum sequence length of the model, including the special tokens
+        :param cache_size: How many tokenized texts to cache. 0 disables the cache
+        :param chars_per_token: Texts are cut to that many characters per token before they are tokenized.
+                                0 disables the pre-truncation
+        """
+        self.tokenizer = tokenizer
+        self.max_seq_len = max_seq_len
+        self.max_tokens = max_seq_len - tokenizer.num_special_tokens_to_add()
+        self.char_budget = int(self.max_tokens * chars_per_token) if chars_per_token else None
+        self.cache_size = cache_size
+        self.hits = 0
+        self.misses = 0
+        # texts that were cut, but turned out to be shorter than max_seq_len tokens
+        self.retokenized = 0
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def get_key(text):
+        return hashlib.sha1(text.encode("utf-8")).digest()
+
+    def _tokenize(self, texts):
+        return self.tokenizer.batch_encode_plus(texts, add_special_tokens=False)['input_ids']
+
+    def encode(self, texts):
+        """
+        :param texts: A list of texts
+        :return: A list with the input ids of every text as an int32 array, including the special tokens
+        """
+        keys = [self.get_key(text) for text in texts] if self.cache_size else None
+        input_ids = [None] * len(texts)
+        if self.cache_size:
+            with self._lock:
+                for i, key in enumerate(keys):
+                    ids = self._cache.get(key)
+                    if ids is not None:
+                        self._cache.move_to_end(key)
+                        input_ids[i] = ids
+        missing = [i for i, ids in enumerate(input_ids) if ids is None]
+        with self._lock:
+            self.hits += len(texts) - len(missing)
+            self.misses += len(missing)
+        if not missing:
+            return input_ids
+
+        cut_texts = [pre_truncate(texts[i], self.char_budget) for i in missing]
+        tokens = self._tokenize(cut_texts)
+        # the cut is only exact if the model would have truncated the full text anyway
+        retry = [j for j, i in enumerate(missing) if len(tokens[j]) < self.max_tokens and cut_texts[j] != texts[i]]
+        if retry:
+            self.retokenized += len(retry)
+            for j, ids in zip(retry, self._tokenize([texts[missing[j]] for j in retry])):
+                tokens[j] = ids
+        for j, i in enumerate(missing):
+            # an array takes 4 bytes per id, a list of ints about 36
+            input_ids[i] = np.array(self.tokenizer.build_inputs_with_special_tokens(tokens[j][:self.max_tokens]),
+                                    dtype=np.int32)
+
+        if self.cache_size:
+            with self._lock:
+                for i in missing:
+                    self._cache[keys[i]] = input_ids[i]
+                while len(self._cache) > self.cache_size:
+                    self._cache.popitem(last=False)
+        return input_ids
+
+    def stats(self):
+        return {'entries': len(self._cache), 'max_entries': self.cache_size, 'hits': self.hits,
+                'misses': self.misses, 'retokenized': self.retokenized}
+
+
+def validate_input_ids(input_ids, max_seq_len, vocab_size):
+    """
+    Check pre-tokenized input ids sent by a client.
+
+    :raise ValueError: If they are not a list of non-empty lists of valid token ids of at most max_seq_len tokens
+    """
+    if not isinstance(input_ids, list):
+        raise ValueError("Expected a list of lists of input ids")
+    for ids in input_ids:
+        if not isinstance(ids, list) or not 0 < len(ids) <= max_seq_len:
+            raise ValueError(f"Every document must have between 1 and {max_seq_len} input ids")
+        # json true and false are parsed as bools, which are ints as well
+        if not all(isinstance(i, int) and not isinstance(i, bool) and 0 <= i < vocab_size for i in ids):
+            raise ValueError(f"Input ids must be integers between 0 and {vocab_size - 1}")
+
+
+def run_model(model, input_ids, pad_id=0, token_budget=4096):
+    """
+    Predict input ids with the AdaptiveModel of a FARM Inferencer, in batches of similar length,
+    each padded only to its longest sequence.
+
+    :param model: The AdaptiveModel
+    :param input_ids: A list with the input ids of every document, including the special tokens, as lists or arrays
+    :param pad_id: The id of the padding token
+    :param token_budget: The number of tokens (batch size x sequence length) of a batch
+    :return: A list with the predicted probabilities of every document
+    """
+    import torch
+
+    if not input_ids:
+        return []
+    # plan_batches adds 2 special tokens to every length, which the input ids include already
+    lengths = [len(ids) - 2 for ids in input_ids]
+    probabilities = [None] * len(input_ids)
+    with torch.no_grad():
+        for seq_len, indices in plan_batches(lengths, max(len(ids) for ids in input_ids),
+                                             token_budget=token_budget):
+            batch = np.full((len(indices), seq_len), pad_id, dtype=np.int64)
+            padding_mask = np.zeros((len(indices), seq_len), dtype=np.int64)
+            for row, i in enumerate(indices):
+                batch[row, :len(input_ids[i])] = input_ids[i]
+                padding_mask[row, :len(input_ids[i])] = 1
+            batch = torch.from_numpy(batch)
+            logits = model.forward(input_ids=batch, segment_ids=torch.zeros_like(batch),
+                                   padding_mask=torch.from_numpy(padding_mask))
+            probas = model.prediction_heads[0].logits_to_probs(logits[0], return_class_probs=True)
+            for i, proba in zip(indices, probas):
+                probabilities[i] = proba
+    return probabilities
@@ -1,5 +1,5 @@
 from datetime import datetime
-from bs4 import BeautifulSoup
+from text_extraction import extract_text
 
 
 class Document:
@@ -50,8 +50,7 @@ class Document:
                 self.title = content['title'].replace("\n", "").replace("\t", "")
             if "fullTextHtml" in content:
                 # we strip the html tags and remove a few annoying characters
-                self.content = ''.join(
-                    BeautifulSoup(content['fullTextHtml'], "html.parser").text.replace("\n", "").replace("\t", ""))
+                self.content = extract_text(content['fullTextHtml']).replace("\n", "").replace("\t", "")
 
             self.sections = []
             if "sections" in content:
@@ -96,3 +95,64 @@ class Document:
             yield self.get_text() + "\t" + labels
         else:
             return None
+
+
+def get_document_text(content):
+    """
+    The text of a Document to predict, as returned by Document.get_text, without building the Document.
+
+    :param content: The 'content' of a document following the json schema of the challenge, or a raw text
+    """
+    if isinstance(content, dict):
+        text = ""
+        if "fullTextHtml" in content:
+            # we strip the html tags and remove a few annoying characters
+            text = extract_text(content['fullTextHtml']).replace("\n", "").replace("\t", "")
+        title = content.get('title', "").replace("\n", "").replace("\t", "")
+        if title != "":
+            # add the title as the first sentence in the text
+            return title + "." + text
+        return text
+    elif isinstance(content, str):
+        # this is a raw text supplied to /predict_raw
+        return content.replace("\n", "").replace("\t", "")
+    return ""
+
+
+def build_texts(json_documents):
+    """
+    The texts of documents following the json schema of the challenge, e.g. a corpus sent to /predict,
+    without building a Document for each of them.
+    """
+    return [get_document_text(doc['content']) for doc in json_documents]
+
+
+class PredictionDocument:
+    """
+    A lean Document for prediction, which only ever needs the text of a Document.
+
+    The html of the content is stripped and the publication date is parsed only when they are first read,
+    and the fields used for training, e.g. sections and labels, are skipped.
+    """
+    __slots__ = ('metadata', 'raw_content', '_text', '_published_at')
+
+    def __init__(self, metadata=None, content=""):
+        self.metadata = metadata
+        self.raw_content = content
+        self._text = None
+        self._published_at = None
+
+    @property
+    def raw_text(self):
+        return not isinstance(self.raw_content, dict)
+
+    @property
+    def publishedAt(self):
+        if self._published_at is None and self.metadata is not None:
+            self._published_at = Document.get_datetime(self.metadata['publishedAt'])
+        return self._published_at
+
+    def get_text(self):
+        if self._text is None:
+            self._text = get_document_text(self.raw_content)
+        return self._text
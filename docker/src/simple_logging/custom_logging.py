@@ -1,26 +1,214 @@
+import atexit
 import logging
+import logging.handlers
 import os
 import errno
+import queue
+import threading
+import time
 import types
 
 
-def log_newline(self, how_many_lines=1):
-    file_handler = None
-    if self.handlers:
-        file_handler = self.handlers[0]
+class BlankLineFormatter(logging.Formatter):
+    """
+    Formats records logged by log_newline as empty lines
+    """
+
+    def format(self, record):
+        if getattr(record, 'blank_line', False):
+            return ''
+        return super().format(record)
 
-    # Switch formatter, output a blank line
-    file_handler.setFormatter(self.blank_formatter)
+
+def log_newline(self, how_many_lines=1):
+    # the records are marked instead of switching the formatter of the handler, which would also blank the records
+    # that other threads log at the same time, or that the background thread of an AsyncHandler formats later
     for i in range(how_many_lines):
-        self.info('')
+        self.info('', extra={'blank_line': True})
+
+
+class LogFileHandler(logging.handlers.RotatingFileHandler):
+    """
+    A file handler for a log file shared by several processes.
+
+    With per_process=True every process writes to its own file <name>.<pid><extension>, which is opened after the fork.
+    The file is rotated once it grows beyond max_bytes, unless max_bytes is 0. Rotation implies per_process, since
+    processes rotating the same file would rename it under each other and lose records.
+    With autoflush=False records are not flushed one by one, the AsyncHandler flushes them in batches.
+    """
+
+    def __init__(self, filename, max_bytes=0, backup_count=0, per_process=False, autoflush=True):
+        self.filename_template = filename
+        self.per_process = per_process or max_bytes > 0
+        self.autoflush = autoflush
+        self._pid = os.getpid()
+        self._size = None
+        super().__init__(self._process_filename(), maxBytes=max_bytes, backupCount=backup_count, delay=True)
+
+    def _process_filename(self):
+        if not self.per_process:
+            return self.filename_template
+        root, extension = os.path.splitext(self.filename_template)
+        return f"{root}.{os.getpid()}{extension}"
+
+    def emit(self, record):
+        if self.per_process and self._pid != os.getpid():
+            # we were forked. The open file belongs to the parent, so we drop it without flushing its buffer
+            self._pid = os.getpid()
+            self.stream = None
+            self._size = None
+            self.baseFilename = os.path.abspath(self._process_filename())
+        super().emit(record)
+
+    def shouldRollover(self, record):
+        # we keep track of the size ourselves, asking the file for it would flush every record
+        if self.maxBytes <= 0:
+            return False
+        if self._size is None:
+            self._size = os.path.getsize(self.baseFilename) if os.path.exists(self.baseFilename) else 0
+        self._size += len(self.format(record)) + len(self.terminator)
+        return self._size >= self.maxBytes
+
+    def doRollover(self):
+        super().doRollover()
+        self._size = None
+
+    def flush(self):
+        if self.autoflush:
+            super().flush()
+
+    def flush_batch(self):
+        super().flush()
+
+
+class AsyncHandler(logging.handlers.QueueHandler):
+    """
+    Takes the writing of log records off the logging thread.
+
+    Records are formatted by the logging thread and queued in memory. A background thread writes them to the
+    target handler in batches of up to 'batch_size' records and flushes the target once per batch.
+    The background thread is started lazily in every process that logs, since threads do not survive a fork.
+    """
+
+    def __init__(self, target, batch_size=256):
+        """
+        :param target: A LogFileHandler with autoflush=False
+        :param batch_size: The maximum number of records written between two flushes
+        """
+        super().__init__(None)
+        self.target = target
+        self.batch_size = batch_size
+        self._start_lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+        atexit.register(self.close)
+
+    def enqueue(self, record):
+        if self._pid != os.getpid():
+            self._start()
+        self.queue.put_nowait(record)
+
+    def _start(self):
+        with self._start_lock:
+            if self._pid != os.getpid():
+                self.queue = queue.SimpleQueue()
+                self._thread = threading.Thread(target=self._run, args=(self.queue,), name="log-writer",
+                                                daemon=True)
+                self._pid = os.getpid()
+                self._thread.start()
+
+    def _run(self, records):
+        while True:
+            batch = [records.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(records.get_nowait())
+                except queue.Empty:
+                    break
+            for record in batch:
+                if record is not None:
+                    self.target.handle(record)
+            self.target.flush_batch()
+            if None in batch:
+                return
+
+    def close(self):
+        """
+        Write the queued records and stop the background thread of this process
+        """
+        with self._start_lock:
+            if self._pid == os.getpid() and self._thread is not None:
+                self.queue.put_nowait(None)
+                self._thread.join()
+            self._pid = None
+            self._thread = None
+        self.target.close()
+        super().close()
+
+
+class RateLimitFilter(logging.Filter):
+    """
+    Thins out the records of hot code paths, e.g. a line logged on every request.
+
+    The limits apply to every line of code that logs separately, so that rare records always pass:
+        sample_rate: only every (1 / sample_rate)-th record of a line passes
+        rate: at most 'rate' records of a line pass per second, in bursts of up to 'burst'
+    Records of level 'min_level' and above always pass. The next record that passes notes how many were dropped.
+    """
+
+    def __init__(self, rate=None, burst=None, sample_rate=1.0, min_level=logging.WARNING):
+        super().__init__()
+        self.rate = rate
+        self.burst = burst or max(1, rate or 1)
+        self.sample_every = max(1, int(round(1.0 / sample_rate))) if sample_rate > 0 else None
+        self.min_level = min_level
+        # (path, line) -> [tokens, time of the last refill, records seen, records dropped since the last pass]
+        self._sites = {}
+        self._lock = threading.Lock()
 
-    # Switch back
-    file_handler.setFormatter(self.default_formatter)
+    def filter(self, record):
+        if record.levelno >= self.min_level or getattr(record, 'blank_line', False):
+            return True
+        now = time.monotonic()
+        with self._lock:
+            site = self._sites.get((record.pathname, record.lineno))
+            if site is None:
+                site = self._sites[(record.pathname, record.lineno)] = [self.burst, now, 0, 0]
+            site[2] += 1
+            passes = self.sample_every is not None and (site[2] - 1) % self.sample_every == 0
+            if passes and self.rate:
+                site[0] = min(self.burst, site[0] + (now - site[1]) * self.rate)
+                site[1] = now
+                passes = site[0] >= 1
+                if passes:
+                    site[0] -= 1
+            if not passes:
+                site[3] += 1
+                return False
+            dropped, site[3] = site[3], 0
+        if dropped:
+            record.msg = f"{record.msg} [{dropped} more records of this line were dropped]"
+        return True
 
 
 def setup_custom_logger(name, logging_level, flog=None,
                         log_format='%(asctime)s - %(levelname)s - %(process)d - '
-                                   '%(module)s.%(funcName)s:%(lineno)d\t%(message)s'):
+                                   '%(module)s.%(funcName)s:%(lineno)d\t%(message)s',
+                        async_mode=False, per_process=False, max_bytes=0, backup_count=0,
+                        rate=None, sample_rate=1.0):
+    """
+    :param name: The name of the logger
+    :param logging_level: The logging level
+    :param flog: The path of the log file
+    :param log_format: The format of the records
+    :param async_mode: Write the records from a background thread in batches, see AsyncHandler
+    :param per_process: Every process writes its own log file, see LogFileHandler
+    :param max_bytes: Rotate the log file once it grows beyond that many bytes. 0 disables the rotation,
+                      anything else implies per_process
+    :param backup_count: How many rotated files to keep
+    :param rate: If given, at most that many records per second pass from each line of code, see RateLimitFilter
+    :param sample_rate: The fraction of the records of each line of code that pass, see RateLimitFilter
+    """
 
     if flog is None:
         raise TypeError("setup_custom_logger::Argument flog cannot be None")
@@ -31,16 +219,23 @@ def setup_custom_logger(name, logging_level, flog=None,
         except OSError as exc:  # Guard against race condition
             if exc.errno != errno.EEXIST:
                 raise
-    formatter = logging.Formatter(fmt=log_format)
+    formatter = BlankLineFormatter(fmt=log_format)
 
-    fhandler = logging.FileHandler(flog)
+    fhandler = LogFileHandler(flog, max_bytes=max_bytes, backup_count=backup_count, per_process=per_process,
+                              autoflush=not async_mode)
+    if async_mode:
+        # the records reach the file handler formatted already
+        fhandler.setFormatter(logging.Formatter(fmt="%(message)s"))
+        fhandler = AsyncHandler(fhandler)
     fhandler.setFormatter(formatter)
     fhandler.setLevel(logging_level)
 
     logger = logging.getLogger(name)
     logger.setLevel(logging_level)
     logger.addHandler(fhandler)
+    if rate or sample_rate < 1.0:
+        logger.addFilter(RateLimitFilter(rate=rate, sample_rate=sample_rate))
     logger.default_formatter = formatter
     logger.blank_formatter = logging.Formatter(fmt="")
     logger.newline = types.MethodType(log_newline, logger)
-    return logger
\ No newline at end of file
+    return logger
@@ -0,0 +1,8 @@
+import os
+import sys
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+# the modules of the app import each other by their plain names, as they do in the container,
+# where simple_logging is a package next to them
+sys.path.insert(0, os.path.join(HERE, os.pardir))
+sys.path.insert(0, os.path.join(HERE, os.pardir, "app"))
@@ -0,0 +1,76 @@
+import multiprocessing
+import time
+
+import pytest
+
+from admission import AdmissionController, DeadlineExceeded, check_deadline, get_deadline
+
+
+def test_everything_is_admitted_without_a_bound():
+    controller = AdmissionController(max_pending_documents=0, slots=2)
+    assert controller.try_admit(10 ** 6)
+    controller.release(10 ** 6)
+    assert controller.pending_documents() == 0
+
+
+def test_the_bound_covers_all_workers():
+    controller = AdmissionController(max_pending_documents=10, slots=2)
+    controller.set_slot(0)
+    assert controller.try_admit(6)
+    controller.set_slot(1)
+    # an idle worker admits a request, no matter how large
+    assert controller.try_admit(6)
+    assert controller.pending_documents() == 12
+    # a busy worker does not take the pending documents beyond the bound
+    assert not controller.try_admit(1)
+    controller.set_slot(0)
+    controller.release(6)
+    controller.set_slot(1)
+    assert controller.try_admit(4)
+    assert not controller.try_admit(1)
+
+
+def test_an_idle_worker_admits_a_request_larger_than_the_bound():
+    controller = AdmissionController(max_pending_documents=10, slots=1)
+    assert controller.try_admit(100)
+    assert not controller.try_admit(1)
+    controller.release(100)
+    assert controller.pending_documents() == 0
+
+
+def test_the_slot_of_a_dead_worker_is_cleared():
+    controller = AdmissionController(max_pending_documents=10, slots=2)
+    controller.set_slot(1)
+    assert controller.try_admit(8)
+    controller.clear_slot(1)
+    assert controller.pending_documents() == 0
+
+
+def _admit_in_child(controller, slot, n_documents):
+    controller.set_slot(slot)
+    controller.try_admit(n_documents)
+
+
+def test_the_counts_are_shared_with_forked_workers():
+    controller = AdmissionController(max_pending_documents=100, slots=2)
+    worker = multiprocessing.get_context("fork").Process(target=_admit_in_child, args=(controller, 1, 7))
+    worker.start()
+    worker.join(timeout=10)
+    assert controller.pending_documents() == 7
+
+
+def test_deadline_headers():
+    now = time.time()
+    assert get_deadline({}) is None
+    assert get_deadline({'X-Request-Deadline': str(now + 5)}) == pytest.approx(now + 5)
+    assert get_deadline({'X-Request-Timeout': '5'}) == pytest.approx(now + 5, abs=1)
+    assert get_deadline({}, default_timeout=5) == pytest.approx(now + 5, abs=1)
+    with pytest.raises(ValueError):
+        get_deadline({'X-Request-Timeout': 'soon'})
+
+
+def test_check_deadline():
+    check_deadline(None)
+    check_deadline(time.time() + 10)
+    with pytest.raises(DeadlineExceeded):
+        check_deadline(time.time() - 1)
@@ -0,0 +1,142 @@
+import os
+import zipfile
+
+import pytest
+
+import artifacts
+from artifacts import ModelArtifactCache
+
+MODEL = "model"
+
+
+def make_archive(directory, content):
+    """
+    :return: A file:// url of the directory holding the archive of MODEL, as MODEL_SOURCE would be
+    """
+    os.makedirs(directory, exist_ok=True)
+    with zipfile.ZipFile(os.path.join(directory, MODEL + ".zip"), "w") as archive:
+        archive.writestr(f"content/trained_models/{MODEL}/weights.txt", content)
+    return "file://" + directory
+
+
+def read_weights(cache):
+    with open(os.path.join(cache.model_dir(MODEL), "content/trained_models", MODEL, "weights.txt")) as f:
+        return f.read()
+
+
+@pytest.fixture
+def hashed(monkeypatch):
+    """
+    Counts the archives hashed
+    """
+    calls = []
+
+    def sha256sum(path):
+        calls.append(path)
+        return original(path)
+
+    original = artifacts.sha256sum
+    monkeypatch.setattr(artifacts, "sha256sum", sha256sum)
+    return calls
+
+
+@pytest.fixture
+def downloads(monkeypatch):
+    """
+    Counts the archives fetched from their source
+    """
+    calls = []
+
+    def copy_from_source(source, model_name, destination):
+        calls.append(source)
+        original(source, model_name, destination)
+
+    original = artifacts._copy_from_source
+    monkeypatch.setattr(artifacts, "_copy_from_source", copy_from_source)
+    return calls
+
+
+def test_a_verified_archive_is_reused_without_hashing_it(tmp_path, hashed, downloads):
+    source = make_archive(str(tmp_path / "source"), "v1")
+    cache = ModelArtifactCache(str(tmp_path / "models"))
+    version, timings = cache.ensure_model(MODEL, source)
+    assert set(timings) == {"download", "verify", "extract"}
+    assert len(downloads) == 1 and len(hashed) == 1
+    assert read_weights(cache) == "v1"
+
+    assert cache.ensure_model(MODEL, source)[0] == version
+    assert len(downloads) == 1 and len(hashed) == 1
+    assert cache.active_version(MODEL) == version
+
+
+def test_a_changed_archive_is_hashed_again(tmp_path, hashed, downloads):
+    source = make_archive(str(tmp_path / "source"), "v1")
+    cache = ModelArtifactCache(str(tmp_path / "models"))
+    version, _ = cache.ensure_model(MODEL, source)
+
+    # touched, but the same content
+    os.utime(cache.archive_path(MODEL), ns=(0, 0))
+    assert cache.ensure_model(MODEL, source)[0] == version
+    assert len(hashed) == 2 and len(downloads) == 1
+    # the new modification time is recorded
+    cache.ensure_model(MODEL, source)
+    assert len(hashed) == 2
+
+    # replaced by something else
+    with open(cache.archive_path(MODEL), "ab") as f:
+        f.write(b"garbage")
+    assert cache.ensure_model(MODEL, source)[0] == version
+    assert len(downloads) == 2
+    assert read_weights(cache) == "v1"
+
+
+def test_an_archive_is_downloaded_again_when_its_source_changes(tmp_path, downloads):
+    cache = ModelArtifactCache(str(tmp_path / "models"))
+    first, _ = cache.ensure_model(MODEL, make_archive(str(tmp_path / "first"), "v1"))
+    second, _ = cache.ensure_model(MODEL, make_archive(str(tmp_path / "second"), "v2"))
+    assert len(downloads) == 2
+    assert first != second
+    assert cache.active_version(MODEL) == second
+    assert read_weights(cache) == "v2"
+
+
+def test_a_pinned_checksum_is_enforced(tmp_path):
+    source = make_archive(str(tmp_path / "source"), "v1")
+    cache = ModelArtifactCache(str(tmp_path / "models"))
+    with pytest.raises(RuntimeError):
+        cache.ensure_model(MODEL, source, sha256="0" * 64)
+    assert not os.path.exists(cache.model_dir(MODEL))
+    checksum = artifacts.sha256sum(os.path.join(str(tmp_path / "source"), MODEL + ".zip"))
+    assert cache.ensure_model(MODEL, source, sha256=checksum)[0] == checksum[:16]
+
+
+def test_versions_are_swapped_by_the_link(tmp_path):
+    cache = ModelArtifactCache(str(tmp_path / "models"))
+    first, _ = cache.ensure_model(MODEL, make_archive(str(tmp_path / "first"), "v1"))
+    first_dir = os.path.realpath(cache.model_dir(MODEL))
+
+    # extracted next to the active version, which stays in use until the swap
+    second, _ = cache.ensure_model(MODEL, make_archive(str(tmp_path / "second"), "v2"), activate=False)
+    assert cache.active_version(MODEL) == first
+    assert read_weights(cache) == "v1"
+    cache.activate(MODEL, second)
+    assert os.path.islink(cache.model_dir(MODEL))
+    assert cache.active_version(MODEL) == second
+    assert read_weights(cache) == "v2"
+    # the previous version is kept, since workers may still be serving it
+    assert os.path.isdir(first_dir)
+
+    third, _ = cache.ensure_model(MODEL, make_archive(str(tmp_path / "third"), "v3"))
+    assert read_weights(cache) == "v3"
+    versions = sorted(os.listdir(os.path.join(str(tmp_path / "models"), ".versions", MODEL)))
+    assert versions == sorted([second, third])
+
+
+def test_a_model_extracted_in_place_is_kept_as_a_version(tmp_path):
+    cache = ModelArtifactCache(str(tmp_path / "models"))
+    legacy_dir = os.path.join(cache.model_dir(MODEL), "content/trained_models", MODEL)
+    os.makedirs(legacy_dir)
+    version, _ = cache.ensure_model(MODEL, make_archive(str(tmp_path / "source"), "v1"))
+    assert cache.active_version(MODEL) == version
+    versions = os.listdir(os.path.join(str(tmp_path / "models"), ".versions", MODEL))
+    assert len(versions) == 2 and any(v.startswith("unversioned-") for v in versions)
@@ -0,0 +1,118 @@
+import threading
+import time
+
+import pytest
+
+from admission import DeadlineExceeded
+from batching import MicroBatcher
+
+
+class RecordingPredictor:
+    """
+    Predicts every text as its upper case version, and records the batches it got
+    """
+
+    def __init__(self, delay=0.0):
+        self.delay = delay
+        self.batches = []
+
+    def __call__(self, texts):
+        self.batches.append(list(texts))
+        time.sleep(self.delay)
+        return [text.upper() for text in texts]
+
+
+def predict_concurrently(batcher, requests):
+    results = [None] * len(requests)
+    errors = [None] * len(requests)
+
+    def predict(i):
+        try:
+            results[i] = batcher.predict(requests[i])
+        except Exception as ex:
+            errors[i] = ex
+
+    threads = [threading.Thread(target=predict, args=(i,)) for i in range(len(requests))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(timeout=10)
+        assert not thread.is_alive()
+    return results, errors
+
+
+def test_concurrent_requests_are_batched_and_scattered_back_in_order():
+    predictor = RecordingPredictor()
+    batcher = MicroBatcher(predictor, max_batch_size=100, max_wait_ms=200)
+    requests = [[f"r{i}-a", f"r{i}-b"] for i in range(5)]
+    results, errors = predict_concurrently(batcher, requests)
+    assert errors == [None] * 5
+    assert results == [[text.upper() for text in texts] for texts in requests]
+    assert len(predictor.batches) < 5
+    batcher.close()
+
+
+def test_batches_are_capped():
+    predictor = RecordingPredictor(delay=0.05)
+    batcher = MicroBatcher(predictor, max_batch_size=4, max_wait_ms=200)
+    results, errors = predict_concurrently(batcher, [["a", "b", "c"] for _ in range(6)])
+    assert errors == [None] * 6
+    # a request is never split, so a batch exceeds the cap by less than one request
+    assert all(len(batch) < 4 + 3 for batch in predictor.batches)
+    batcher.close()
+
+
+def test_errors_reach_every_request_of_the_batch():
+    def fail(texts):
+        raise KeyError("boom")
+
+    batcher = MicroBatcher(fail, max_batch_size=100, max_wait_ms=100)
+    results, errors = predict_concurrently(batcher, [["a"], ["b"], ["c"]])
+    assert all(isinstance(error, KeyError) for error in errors)
+    batcher.close()
+
+
+def test_empty_request():
+    predictor = RecordingPredictor()
+    assert MicroBatcher(predictor).predict([]) == []
+    assert predictor.batches == []
+
+
+def test_expired_requests_are_not_predicted():
+    predictor = RecordingPredictor()
+    batcher = MicroBatcher(predictor, max_wait_ms=50)
+    with pytest.raises(DeadlineExceeded):
+        batcher.predict(["late"], deadline=time.time() - 1)
+    assert predictor.batches == []
+    assert batcher.predict(["in time"], deadline=time.time() + 10) == ["IN TIME"]
+    batcher.close()
+
+
+def test_requests_after_close_are_predicted_directly():
+    predictor = RecordingPredictor()
+    batcher = MicroBatcher(predictor, max_wait_ms=1)
+    assert batcher.predict(["a"]) == ["A"]
+    batcher.close()
+    batcher._thread.join(timeout=5)
+    assert not batcher._thread.is_alive()
+    assert batcher.predict(["b"]) == ["B"]
+
+
+def test_close_while_requests_are_in_flight():
+    predictor = RecordingPredictor(delay=0.01)
+    batcher = MicroBatcher(predictor, max_batch_size=2, max_wait_ms=5)
+    requests = [[f"t{i}"] for i in range(50)]
+    results = [None] * len(requests)
+
+    def predict(i):
+        results[i] = batcher.predict(requests[i])
+
+    threads = [threading.Thread(target=predict, args=(i,)) for i in range(len(requests))]
+    for i, thread in enumerate(threads):
+        thread.start()
+        if i == len(threads) // 2:
+            batcher.close()
+    for thread in threads:
+        thread.join(timeout=10)
+        assert not thread.is_alive()
+    assert results == [[text.upper() for text in texts] for texts in requests]
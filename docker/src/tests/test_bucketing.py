@@ -0,0 +1,83 @@
+import re
+
+import pytest
+
+from bucketing import max_token_count, plan_batches
+from model_registry import LoadedModel
+
+TEXTS = [
+    "short",
+    "a few plain words of english",
+    "https://example.com/a/very/long/path?with=query&and=more#fragment" * 3,
+    "1234567890" * 20,
+    "Donaudampfschifffahrtsgesellschaftskapitänswitwe",
+    "def f(x):{return [x**2 for x in range(10)]};" * 4,
+    "東京都は日本の首都であり、世界最大級の都市圏を形成している。" * 3,
+    "ünïcödé wörds " * 30,
+    "",
+]
+
+
+class GreedyTokenizer:
+    """
+    A tokenizer that makes many tokens: every non-ascii byte, digit and punctuation mark is a token of its own,
+    and words are split into pieces of 3 characters
+    """
+
+    def tokenize(self, text):
+        tokens = []
+        for word in text.split():
+            for piece in re.findall(r"[a-zA-Z]{1,3}|[^a-zA-Z]", word):
+                tokens.extend(piece.encode("utf-8") if ord(piece[0]) > 127 else [piece])
+        return tokens
+
+
+class Processor:
+
+    def __init__(self, max_seq_len):
+        self.max_seq_len = max_seq_len
+        self.tokenizer = GreedyTokenizer()
+        self.tasks = {'text_classification': {'label_list': ["a", "b"]}}
+
+
+class RecordingInferencer:
+    """
+    Records the tokens FARM would feed to the model, i.e. truncated to the max_seq_len of the processor
+    """
+
+    def __init__(self, max_seq_len):
+        self.processor = Processor(max_seq_len)
+        self.batch_size = 4
+        self.inputs = {}
+
+    def inference_from_dicts(self, dicts):
+        for d in dicts:
+            self.inputs[d["text"]] = self.processor.tokenizer.tokenize(d["text"])[:self.processor.max_seq_len - 2]
+        return [{"predictions": [{"probability": [0.5, 0.5]} for _ in dicts]}]
+
+
+@pytest.mark.parametrize("text", TEXTS)
+def test_the_bound_never_undercounts(text):
+    assert max_token_count(text) >= len(GreedyTokenizer().tokenize(text))
+
+
+@pytest.mark.parametrize("max_seq_len", [16, 64, 256])
+def test_bucketing_feeds_the_model_the_same_tokens(max_seq_len):
+    unbucketed = RecordingInferencer(max_seq_len)
+    LoadedModel("/models/m", unbucketed).run_inference(TEXTS)
+    bucketed = RecordingInferencer(max_seq_len)
+    model = LoadedModel("/models/m", bucketed, bucketing_options={'token_budget': 128})
+    assert len(model.run_inference(TEXTS)) == len(TEXTS)
+    assert bucketed.inputs == unbucketed.inputs
+    assert bucketed.processor.max_seq_len == max_seq_len
+
+
+def test_batches_are_sorted_by_length_and_within_the_budget():
+    lengths = [100, 3, 50, 7, 400, 20]
+    batches = plan_batches(lengths, 256, token_budget=256, granularity=16)
+    assert sorted(i for _, indices in batches for i in indices) == list(range(len(lengths)))
+    for seq_len, indices in batches:
+        assert seq_len <= 256 and seq_len % 16 == 0
+        assert all(min(lengths[i] + 2, 256) <= seq_len for i in indices)
+        assert len(indices) == 1 or len(indices) * seq_len <= 256
+    assert [seq_len for seq_len, _ in batches] == sorted(seq_len for seq_len, _ in batches)
@@ -0,0 +1,82 @@
+import pytest
+
+import cpu_topology
+from cpu_topology import get_cgroup_cpu_limit, get_cpu_budget, get_physical_cores, get_worker_cpus, plan_layout
+
+
+@pytest.fixture
+def machine(monkeypatch):
+    """
+    A machine with 'cpus' CPUs, two hyperthreads per core (n and n + cores), and the given cgroup files
+    """
+
+    def configure(cpus=8, files=None):
+        files = dict(files or {})
+        cores = cpus // 2
+        for cpu in range(cpus):
+            files[f"/sys/devices/system/cpu/cpu{cpu}/topology/thread_siblings_list"] = \
+                f"{cpu % cores},{cpu % cores + cores}"
+        monkeypatch.setattr(cpu_topology, "_read_first_line", files.get)
+        monkeypatch.setattr(cpu_topology, "get_available_cpus", lambda: list(range(cpus)))
+
+    return configure
+
+
+def test_hyperthreads_are_grouped_by_core(machine):
+    machine(cpus=8)
+    assert get_physical_cores(range(8)) == [[0, 4], [1, 5], [2, 6], [3, 7]]
+    # e.g. an affinity that only allows some of the CPUs
+    assert get_physical_cores([1, 5, 2]) == [[1, 5], [2]]
+
+
+@pytest.mark.parametrize("files,limit", [
+    ({}, None),
+    ({cpu_topology.CGROUP_V2_CPU_MAX: "max 100000"}, None),
+    ({cpu_topology.CGROUP_V2_CPU_MAX: "250000 100000"}, 2.5),
+    ({cpu_topology.CGROUP_V1_CPU_QUOTA: "-1", cpu_topology.CGROUP_V1_CPU_PERIOD: "100000"}, None),
+    ({cpu_topology.CGROUP_V1_CPU_QUOTA: "150000", cpu_topology.CGROUP_V1_CPU_PERIOD: "100000"}, 1.5),
+])
+def test_cgroup_cpu_limit(machine, files, limit):
+    machine(files=files)
+    assert get_cgroup_cpu_limit() == limit
+
+
+@pytest.mark.parametrize("cpus,files,budget", [
+    (8, {}, 4),
+    (8, {cpu_topology.CGROUP_V2_CPU_MAX: "250000 100000"}, 2),
+    (8, {cpu_topology.CGROUP_V2_CPU_MAX: "50000 100000"}, 1),
+    (2, {cpu_topology.CGROUP_V2_CPU_MAX: "800000 100000"}, 1),
+])
+def test_cpu_budget_is_capped_by_the_affinity_and_the_quota(machine, cpus, files, budget):
+    machine(cpus=cpus, files=files)
+    assert get_cpu_budget() == budget
+
+
+@pytest.mark.parametrize("kwargs,workers,threads", [
+    ({"cpu_budget": 8}, 4, 2),
+    ({"cpu_budget": 1}, 1, 1),
+    ({"cpu_budget": 8, "workers": 3}, 3, 2),
+    ({"cpu_budget": 8, "intra_op_threads": 4}, 2, 4),
+    ({"cpu_budget": 8, "intra_op_threads": 16}, 1, 16),
+    ({"cpu_budget": 8, "workers": 16}, 16, 1),
+    ({"cpu_budget": 8, "workers": 2, "intra_op_threads": 1}, 2, 1),
+])
+def test_plan_layout(kwargs, workers, threads):
+    layout = plan_layout(**kwargs)
+    assert (layout["workers"], layout["intra_op_threads"]) == (workers, threads)
+    assert layout["inter_op_threads"] == 1
+    assert layout["cpu_budget"] == kwargs["cpu_budget"]
+
+
+def test_plan_layout_uses_the_cpu_budget(machine):
+    machine(cpus=8, files={cpu_topology.CGROUP_V2_CPU_MAX: "200000 100000"})
+    assert plan_layout() == {"workers": 1, "intra_op_threads": 2, "inter_op_threads": 1, "cpu_budget": 2}
+
+
+def test_every_worker_gets_its_own_cores(machine):
+    machine(cpus=8)
+    layout = plan_layout(workers=2, cpu_budget=4)
+    assert get_worker_cpus(0, layout) == [0, 4, 1, 5]
+    assert get_worker_cpus(1, layout) == [2, 6, 3, 7]
+    # not enough cores for a third worker, so it may run anywhere
+    assert get_worker_cpus(2, layout) == list(range(8))
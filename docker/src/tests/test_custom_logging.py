@@ -0,0 +1,106 @@
+import logging
+import os
+import types
+
+import pytest
+
+from simple_logging import custom_logging
+from simple_logging.custom_logging import AsyncHandler, LogFileHandler, RateLimitFilter, setup_custom_logger
+
+
+def make_record(message, line=10, level=logging.INFO):
+    return logging.LogRecord("test", level, "/app/module.py", line, message, None, None)
+
+
+class Clock:
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(custom_logging, "time", types.SimpleNamespace(monotonic=clock.monotonic))
+    return clock
+
+
+def test_rate_limit_per_line(clock):
+    log_filter = RateLimitFilter(rate=2, burst=2)
+    assert [log_filter.filter(make_record("hot")) for _ in range(4)] == [True, True, False, False]
+    # another line has its own bucket
+    assert log_filter.filter(make_record("rare", line=20))
+    # the bucket refills at 'rate' records per second
+    clock.now += 0.5
+    record = make_record("hot")
+    assert log_filter.filter(record)
+    assert record.getMessage() == "hot [2 more records of this line were dropped]"
+    assert not log_filter.filter(make_record("hot"))
+
+
+def test_sampling(clock):
+    log_filter = RateLimitFilter(sample_rate=0.25)
+    passed = [log_filter.filter(make_record(f"record {i}")) for i in range(9)]
+    assert passed == [True, False, False, False, True, False, False, False, True]
+
+
+def test_warnings_and_blank_lines_always_pass(clock):
+    log_filter = RateLimitFilter(rate=1, burst=1, sample_rate=0.1)
+    assert all(log_filter.filter(make_record("bad", level=logging.WARNING)) for _ in range(10))
+    assert all(log_filter.filter(make_record("worse", level=logging.ERROR)) for _ in range(10))
+    blank = make_record("")
+    blank.blank_line = True
+    assert all(log_filter.filter(blank) for _ in range(10))
+
+
+def read_lines(path):
+    with open(path) as f:
+        return f.read().splitlines()
+
+
+def test_per_process_file_names(tmp_path):
+    handler = LogFileHandler(str(tmp_path / "server.log"), per_process=True)
+    handler.setFormatter(logging.Formatter("%(message)s"))
+    handler.handle(make_record("hello"))
+    handler.close()
+    assert read_lines(str(tmp_path / f"server.{os.getpid()}.log")) == ["hello"]
+
+
+def test_rotation_implies_per_process_files(tmp_path):
+    handler = LogFileHandler(str(tmp_path / "server.log"), max_bytes=100, backup_count=2)
+    handler.setFormatter(logging.Formatter("%(message)s"))
+    for i in range(30):
+        handler.handle(make_record(f"record {i:02d}"))
+    handler.close()
+    name = f"server.{os.getpid()}.log"
+    assert sorted(os.listdir(str(tmp_path))) == [name, name + ".1", name + ".2"]
+    assert read_lines(str(tmp_path / name))[-1] == "record 29"
+    assert all(os.path.getsize(str(tmp_path / f)) <= 100 for f in os.listdir(str(tmp_path)))
+
+
+def test_async_handler_writes_the_queue_on_close(tmp_path):
+    target = LogFileHandler(str(tmp_path / "server.log"), autoflush=False)
+    target.setFormatter(logging.Formatter("%(message)s"))
+    handler = AsyncHandler(target, batch_size=8)
+    handler.setFormatter(logging.Formatter("%(message)s"))
+    for i in range(100):
+        handler.handle(make_record(f"record {i}"))
+    handler.close()
+    assert read_lines(str(tmp_path / "server.log")) == [f"record {i}" for i in range(100)]
+
+
+def test_setup_custom_logger(tmp_path):
+    flog = str(tmp_path / "log" / "server.log")
+    logger = setup_custom_logger("test_setup_custom_logger", logging.INFO, flog=flog, log_format="%(message)s",
+                                 async_mode=True, rate=1)
+    for _ in range(5):
+        logger.info("hot")
+    logger.warning("always")
+    logger.newline()
+    for handler in list(logger.handlers):
+        handler.close()
+        logger.removeHandler(handler)
+    assert read_lines(flog) == ["hot", "always", ""]
@@ -0,0 +1,112 @@
+import gzip
+import io
+import json
+import os
+import time
+
+import pytest
+
+from jobs import JOB_DONE, JOB_FAILED, JOB_QUEUED, JobRunner, JobStore
+
+DOCUMENTS = [{"content": f"document {i}"} for i in range(10)]
+
+
+def predict(model_name, json_documents, top_n):
+    return [[[document["content"], 1.0]] for document in json_documents]
+
+
+def read_results(store, job_id):
+    with open(store.results_path(job_id)) as f:
+        return [json.loads(line) for line in f]
+
+
+class Interrupted(BaseException):
+    """
+    Stands in for the runner being killed, which the runner must not catch
+    """
+
+
+def test_job_runs_to_completion(tmp_path):
+    store = JobStore(str(tmp_path))
+    status = store.submit(io.BytesIO(json.dumps(DOCUMENTS).encode("utf-8")), False, "model", top_n=1)
+    assert status["state"] == JOB_QUEUED
+    assert [s["job_id"] for s in store.list_pending()] == [status["job_id"]]
+
+    JobRunner(store, predict, chunk_size=3).run_job(status)
+    status = store.get_status(status["job_id"])
+    assert status["state"] == JOB_DONE
+    assert status["documents_done"] == len(DOCUMENTS)
+    assert read_results(store, status["job_id"]) == predict("model", DOCUMENTS, 1)
+    assert not os.path.exists(store.input_path(status["job_id"]))
+    assert store.list_pending() == []
+
+
+def test_interrupted_job_resumes_after_its_last_checkpoint(tmp_path):
+    store = JobStore(str(tmp_path))
+    data = gzip.compress("\n".join(json.dumps(d) for d in DOCUMENTS).encode("utf-8"))
+    job_id = store.submit(io.BytesIO(data), True, "model")["job_id"]
+    calls = []
+
+    def crash_on_third_chunk(model_name, json_documents, top_n):
+        calls.append(len(json_documents))
+        if len(calls) == 3:
+            raise Interrupted()
+        return predict(model_name, json_documents, top_n)
+
+    with pytest.raises(Interrupted):
+        JobRunner(store, crash_on_third_chunk, chunk_size=3).run_job(store.get_status(job_id))
+    status = store.get_status(job_id)
+    assert status["documents_done"] == 6
+    assert [s["job_id"] for s in store.list_pending()] == [job_id]
+
+    # results written after the last checkpoint are dropped on resume
+    with open(store.results_path(job_id), "ab") as f:
+        f.write(b'[["partial", 1.0]]\n')
+    resumed = []
+
+    def record(model_name, json_documents, top_n):
+        resumed.extend(json_documents)
+        return predict(model_name, json_documents, top_n)
+
+    JobRunner(store, record, chunk_size=3).run_job(status)
+    assert resumed == DOCUMENTS[6:]
+    assert store.get_status(job_id)["state"] == JOB_DONE
+    assert read_results(store, job_id) == predict("model", DOCUMENTS, 4)
+
+
+def test_malformatted_corpus_fails_the_job(tmp_path):
+    store = JobStore(str(tmp_path))
+    status = store.submit(io.BytesIO(b'[{"content": "a"},'), False, "model")
+    JobRunner(store, predict).run_job(status)
+    status = store.get_status(status["job_id"])
+    assert status["state"] == JOB_FAILED
+    assert status["error"]
+
+
+def test_submissions_are_capped(tmp_path):
+    store = JobStore(str(tmp_path))
+    with pytest.raises(OverflowError):
+        store.submit(io.BytesIO(b"x" * 100), False, "model", max_bytes=10)
+    assert os.listdir(str(tmp_path)) == []
+
+
+def test_finished_jobs_expire(tmp_path):
+    store = JobStore(str(tmp_path), results_ttl=60)
+    done = store.submit(io.BytesIO(json.dumps(DOCUMENTS).encode("utf-8")), False, "model")
+    JobRunner(store, predict).run_job(done)
+    queued = store.submit(io.BytesIO(json.dumps(DOCUMENTS).encode("utf-8")), False, "model")
+    assert store.remove_expired() == []
+
+    status = store.get_status(done["job_id"])
+    status["updated_at"] = time.time() - 120
+    with open(os.path.join(store.job_dir(done["job_id"]), "status.json"), "w") as f:
+        json.dump(status, f)
+    assert store.remove_expired() == [done["job_id"]]
+    assert store.get_status(done["job_id"]) is None
+    assert store.get_status(queued["job_id"]) is not None
+
+
+def test_job_ids_are_not_paths(tmp_path):
+    store = JobStore(str(tmp_path))
+    assert store.get_status("../" + "0" * 29) is None
+    assert store.get_status("0" * 32) is None
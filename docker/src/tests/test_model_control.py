@@ -0,0 +1,141 @@
+import multiprocessing
+import os
+import threading
+import time
+
+import pytest
+
+from model_control import ActiveModelState, ModelSwapWatcher, is_valid_model_name, swap_model
+
+
+class FakeModel:
+
+    def run_inference(self, texts):
+        return [[0.5, 0.5] for _ in texts]
+
+
+def _run_worker(state_dir, events_dir, gate_path):
+    def load(model_name, version):
+        # blocks for as long as the gate exists, like a slow load
+        while os.path.exists(gate_path):
+            time.sleep(0.01)
+        open(os.path.join(events_dir, f"{os.getpid()}-{model_name}-{version}"), "w").close()
+        return FakeModel()
+
+    ModelSwapWatcher(ActiveModelState(state_dir), load, poll_interval=0.01).ensure_started()
+    while True:
+        time.sleep(1)
+
+
+@pytest.fixture
+def workers(tmp_path):
+    """
+    Starts forked workers that each watch the state and load the staged model with a fake load function
+    """
+    processes = []
+    events_dir = str(tmp_path / "events")
+    os.makedirs(events_dir)
+    gate_path = str(tmp_path / "gate")
+
+    def start(n):
+        for _ in range(n):
+            process = multiprocessing.get_context("fork").Process(
+                target=_run_worker, args=(str(tmp_path / "state"), events_dir, gate_path), daemon=True)
+            process.start()
+            processes.append(process)
+        return events_dir, gate_path
+
+    yield start
+    for process in processes:
+        process.terminate()
+        process.join()
+
+
+def test_state_is_shared_and_versioned(tmp_path):
+    first = ActiveModelState(str(tmp_path / "state"))
+    second = ActiveModelState(str(tmp_path / "state"))
+    assert first.read()["active"] is None
+    state = first.reset("model-a")
+    assert state["active"] == "model-a" and state["staged"] is None
+    assert second.read()["active"] == "model-a"
+    first.update(staged="model-b", staged_version="0123")
+    assert second.read()["staged"] == "model-b"
+    assert second.read()["version"] == state["version"] + 1
+
+
+def test_ready_markers_of_dead_processes_are_ignored(tmp_path):
+    state = ActiveModelState(str(tmp_path / "state"))
+    process = multiprocessing.get_context("fork").Process(target=time.sleep, args=(0,))
+    process.start()
+    process.join()
+    state.mark_ready("model-b", os.getpid())
+    state.mark_ready("model-b", process.pid)
+    assert state.ready_workers("model-b") == [os.getpid()]
+    state.reset("model-a")
+    assert state.ready_workers("model-b") == []
+
+
+def test_all_workers_switch_at_once(tmp_path, workers):
+    state = ActiveModelState(str(tmp_path / "state"))
+    state.reset("model-a")
+    events_dir, gate_path = workers(3)
+    # the workers are slow to load the staged model
+    open(gate_path, "w").close()
+    activated = []
+    result = {}
+    swap = threading.Thread(target=lambda: result.update(swap_model(
+        state, "model-b", 3, prepare_fn=lambda: "0123456789abcdef", activate_fn=activated.append,
+        timeout=30, poll_interval=0.01)))
+    swap.start()
+
+    time.sleep(0.3)
+    assert state.read()["staged"] == "model-b"
+    assert state.read()["active"] == "model-a"
+    assert activated == []
+    os.remove(gate_path)
+    swap.join(timeout=30)
+
+    assert result["active"] == "model-b" and result["staged"] is None and result["error"] is None
+    assert activated == ["0123456789abcdef"]
+    # every worker loaded the staged version before the switch
+    assert len(os.listdir(events_dir)) == 3
+    assert all(name.endswith("-model-b-0123456789abcdef") for name in os.listdir(events_dir))
+
+
+def test_a_swap_is_abandoned_after_the_timeout(tmp_path, workers):
+    state = ActiveModelState(str(tmp_path / "state"))
+    state.reset("model-a")
+    workers(1)
+    activated = []
+    start = time.time()
+    result = swap_model(state, "model-b", 2, prepare_fn=lambda: "0123", activate_fn=activated.append,
+                        timeout=0.5, poll_interval=0.01)
+    assert time.time() - start < 10
+    assert result["active"] == "model-a" and result["staged"] is None
+    assert result["error"].startswith("TimeoutError")
+    assert activated == []
+
+
+def test_a_failed_preparation_keeps_the_active_model(tmp_path):
+    state = ActiveModelState(str(tmp_path / "state"))
+    state.reset("model-a")
+
+    def fail():
+        raise RuntimeError("download failed")
+
+    result = swap_model(state, "model-b", 1, prepare_fn=fail, timeout=1, poll_interval=0.01)
+    assert result["active"] == "model-a" and result["staged"] is None
+    assert result["error"] == "RuntimeError: download failed"
+
+
+@pytest.mark.parametrize("model_name,valid", [
+    ("distilbert-base-cased_n_epochs_3", True),
+    ("model.v2", True),
+    ("../etc", False),
+    ("a/b", False),
+    (".hidden", False),
+    ("", False),
+    (None, False),
+])
+def test_model_names(model_name, valid):
+    assert is_valid_model_name(model_name) == valid
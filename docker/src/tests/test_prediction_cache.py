@@ -0,0 +1,72 @@
+import sqlite3
+
+import numpy as np
+
+from prediction_cache import PredictionCache
+
+
+def proba(i):
+    return np.array([i, 1 - i / 10], dtype=np.float32)
+
+
+def test_misses_then_hits():
+    cache = PredictionCache(max_entries=10)
+    assert cache.get_many("model", ["a", "b"]) == [None, None]
+    cache.put_many("model", ["a"], [proba(1)])
+    cached = cache.get_many("model", ["a", "b"])
+    np.testing.assert_array_equal(cached[0], proba(1))
+    assert cached[1] is None
+    assert cache.stats() == {"entries": 1, "hits": 1, "disk_hits": 0, "misses": 3}
+
+
+def test_least_recently_used_entries_are_evicted():
+    cache = PredictionCache(max_entries=2)
+    cache.put_many("model", ["a", "b"], [proba(1), proba(2)])
+    # 'a' becomes the most recently used
+    cache.get_many("model", ["a"])
+    cache.put_many("model", ["c"], [proba(3)])
+    assert [p is not None for p in cache.get_many("model", ["a", "b", "c"])] == [True, False, True]
+
+
+def test_the_key_includes_the_model_and_its_version():
+    cache = PredictionCache()
+    cache.put_many("model@0123456789abcdef", ["a"], [proba(1)])
+    assert cache.get_many("model@fedcba9876543210", ["a"]) == [None]
+    assert cache.get_many("other", ["a"]) == [None]
+    assert cache.get_many("model@0123456789abcdef", ["a"])[0] is not None
+
+
+def test_the_database_is_shared_by_caches(tmp_path):
+    db_path = str(tmp_path / "cache" / "predictions.sqlite")
+    PredictionCache(max_entries=10, db_path=db_path).put_many("model", ["a", "b"], [proba(1), proba(2)])
+    # e.g. another worker, with an empty in-process tier
+    cache = PredictionCache(max_entries=10, db_path=db_path)
+    cached = cache.get_many("model", ["a", "b", "c"])
+    np.testing.assert_array_equal(cached[0], proba(1))
+    np.testing.assert_array_equal(cached[1], proba(2))
+    assert cached[1].dtype == np.float32
+    assert cached[2] is None
+    assert cache.stats()["disk_hits"] == 2
+    # found on disk, so now served from memory
+    cache.get_many("model", ["a"])
+    assert cache.stats()["hits"] == 1
+
+
+def test_lookups_beyond_the_sqlite_parameter_limit(tmp_path):
+    cache = PredictionCache(max_entries=0, db_path=str(tmp_path / "predictions.sqlite"))
+    texts = [f"text {i}" for i in range(1200)]
+    cache.put_many("model", texts, [proba(i % 10) for i in range(1200)])
+    assert all(p is not None for p in cache.get_many("model", texts))
+
+
+def test_the_database_keeps_the_newest_entries(tmp_path):
+    db_path = str(tmp_path / "predictions.sqlite")
+    cache = PredictionCache(max_entries=0, db_path=db_path, max_db_entries=5)
+    for i in range(12):
+        cache.put_many("model", [f"text {i}"], [proba(i % 10)])
+    # a replaced entry counts as new
+    cache.put_many("model", ["text 8"], [proba(8)])
+    with sqlite3.connect(db_path) as connection:
+        assert connection.execute("SELECT COUNT(*) FROM predictions").fetchone()[0] <= 5
+    cached = cache.get_many("model", [f"text {i}" for i in range(12)])
+    assert [p is not None for p in cached] == [False] * 8 + [True] * 4
@@ -0,0 +1,60 @@
+import numpy as np
+import pytest
+
+from ranking import format_top_n, rank_top_n, top_n_indices
+
+LABELS = np.array([f"label {i}" for i in range(10)], dtype=object)
+
+
+def sorted_top_n(probabilities, top_n):
+    """
+    The reference: a full stable sort of every row
+    """
+    indices = np.argsort(-probabilities, axis=1, kind='stable')[:, :top_n]
+    return indices, np.take_along_axis(probabilities, indices, axis=1)
+
+
+@pytest.mark.parametrize("top_n", [1, 3, 9, 10, 11, 100])
+def test_same_ranking_as_a_full_sort(top_n):
+    probabilities = np.random.RandomState(top_n).dirichlet(np.ones(len(LABELS)), size=50).astype(np.float32)
+    indices, probas = top_n_indices(probabilities, top_n)
+    expected_indices, expected_probas = sorted_top_n(probabilities, top_n)
+    assert indices.shape == (50, min(top_n, len(LABELS)))
+    np.testing.assert_array_equal(indices, expected_indices)
+    np.testing.assert_array_equal(probas, expected_probas)
+
+
+@pytest.mark.parametrize("top_n", [1, 2, 3, 4, 5, 10])
+def test_ties_are_ranked_by_label_index(top_n):
+    # coarse probabilities, so that many labels tie, also across the N-th place
+    probabilities = np.random.RandomState(0).randint(0, 3, size=(200, len(LABELS))).astype(np.float32) / 4
+    indices, probas = top_n_indices(probabilities, top_n)
+    expected_indices, expected_probas = sorted_top_n(probabilities, top_n)
+    np.testing.assert_array_equal(indices, expected_indices)
+    np.testing.assert_array_equal(probas, expected_probas)
+
+
+def test_list_of_vectors():
+    probabilities = [np.array([0.1, 0.6, 0.3]), np.array([0.5, 0.2, 0.3])]
+    indices, probas = top_n_indices(probabilities, 2)
+    assert indices.tolist() == [[1, 2], [0, 2]]
+    assert probas.tolist() == [[0.6, 0.3], [0.5, 0.3]]
+
+
+def test_empty_batch():
+    for probabilities in ([], np.empty((0, len(LABELS)))):
+        indices, probas = top_n_indices(probabilities, 4)
+        assert indices.shape[0] == probas.shape[0] == 0
+        assert format_top_n(indices, probas, LABELS) == []
+    assert rank_top_n([], LABELS) == []
+
+
+def test_zero_labels_requested():
+    indices, probas = top_n_indices(np.full((2, len(LABELS)), 0.1), 0)
+    assert indices.shape == probas.shape == (2, 0)
+
+
+def test_formatted_output():
+    probabilities = np.array([[0.1, 0.7, 0.2] + [0.0] * 7], dtype=np.float32)
+    assert rank_top_n(probabilities, LABELS, top_n=2) == [[["label 1", float(np.float32(0.7))],
+                                                          ["label 2", float(np.float32(0.2))]]]
@@ -0,0 +1,46 @@
+import json
+
+import numpy as np
+import pytest
+
+from ranking import format_top_n, top_n_indices
+from response_formats import decode_columnar, encode_columnar, encode_json, encode_legacy
+
+LABELS = np.array(["economy,finance", "it's", 'quote "d"', "ünïcödé", "back\\slash", "plain"], dtype=object)
+
+
+def ranked(n_documents, top_n, seed=0):
+    probas = np.random.RandomState(seed).dirichlet(np.ones(len(LABELS)), size=n_documents).astype(np.float32)
+    return top_n_indices(probas, top_n)
+
+
+@pytest.mark.parametrize("n_documents,top_n", [(0, 4), (1, 1), (7, 4), (3, len(LABELS))])
+def test_legacy_format_is_unchanged(n_documents, top_n):
+    indices, probas = ranked(n_documents, top_n)
+    assert encode_legacy(indices, probas, LABELS) == str(format_top_n(indices, probas, LABELS)).encode("utf-8")
+
+
+@pytest.mark.parametrize("n_documents,top_n", [(0, 4), (1, 1), (7, 4), (3, len(LABELS))])
+def test_json_format_is_unchanged(n_documents, top_n):
+    indices, probas = ranked(n_documents, top_n)
+    expected = json.dumps(format_top_n(indices, probas, LABELS), ensure_ascii=False, separators=(",", ":"))
+    assert encode_json(indices, probas, LABELS) == expected.encode("utf-8")
+    assert json.loads(encode_json(indices, probas, LABELS)) == format_top_n(indices, probas, LABELS)
+
+
+@pytest.mark.parametrize("n_documents,top_n", [(0, 4), (1, 1), (20, 4)])
+def test_columnar_format_round_trips(n_documents, top_n):
+    labels = np.array(["economy,finance", "sport", "ünïcödé", "it's", "5"], dtype=object)
+    rng = np.random.RandomState(n_documents)
+    indices = np.array([rng.permutation(len(labels))[:top_n] for _ in range(n_documents)],
+                       dtype=np.intp).reshape(n_documents, top_n)
+    probas = rng.uniform(size=(n_documents, top_n)).astype(np.float32)
+    decoded_labels, decoded_probas = decode_columnar(encode_columnar(indices, probas, labels))
+    assert decoded_labels.shape == decoded_probas.shape == (n_documents, top_n)
+    assert decoded_labels.tolist() == labels[indices].tolist()
+    np.testing.assert_array_equal(decoded_probas, probas)
+
+
+def test_columnar_format_is_checked():
+    with pytest.raises(ValueError):
+        decode_columnar(b"JSON" + bytes(12))
@@ -0,0 +1,92 @@
+import gzip
+import io
+import json
+import zlib
+
+import pytest
+
+from streaming import iter_body, iter_chunks, iter_json_documents, iter_lines, iter_ndjson
+
+DOCUMENTS = [{"content": "first"}, {"content": "ü, [ ] { } \" \\ ,"}, {"content": "third", "n": [1, 2]}]
+
+
+def split(data, size):
+    return [data[i:i + size] for i in range(0, len(data), size)]
+
+
+@pytest.mark.parametrize("size", [1, 2, 3, 7, 1000])
+def test_json_array_across_chunk_boundaries(size):
+    data = json.dumps(DOCUMENTS, ensure_ascii=False).encode("utf-8")
+    assert list(iter_json_documents(split(data, size))) == DOCUMENTS
+
+
+@pytest.mark.parametrize("size", [1, 5, 1000])
+def test_ndjson_across_chunk_boundaries(size):
+    data = "\n".join(json.dumps(d, ensure_ascii=False) for d in DOCUMENTS).encode("utf-8") + b"\n\n"
+    assert list(iter_json_documents(split(data, size))) == DOCUMENTS
+
+
+def test_whitespace_and_empty_input():
+    assert list(iter_json_documents([b" \n [ ", b"\t{\"a\": 1} ,\n", b"{\"b\": 2} ]\n "])) == [{"a": 1}, {"b": 2}]
+    assert list(iter_json_documents([b"[", b" ]"])) == []
+    assert list(iter_json_documents([b"  ", b"\n"])) == []
+
+
+@pytest.mark.parametrize("data", [
+    b'[{"a": 1},]',
+    b'[,]',
+    b'[{"a": 1} {"b": 2}]',
+    b'[{"a": 1}',
+    b'[{"a": 1}] trailing',
+    b'[{"a": tru}]',
+    b'{"a": 1}\nnot json\n',
+])
+def test_malformed_input(data):
+    with pytest.raises(ValueError):
+        list(iter_json_documents(split(data, 3)))
+
+
+def test_malformed_document_does_not_buffer_the_rest_of_the_stream():
+    def endless():
+        yield b'[{"a": 1 x'
+        while True:
+            yield b"y" * 1000
+
+    with pytest.raises(ValueError):
+        list(iter_json_documents(endless(), max_document_size=10000))
+
+
+def test_lines_are_bounded():
+    def endless():
+        while True:
+            yield b"y" * 1000
+
+    with pytest.raises(ValueError):
+        list(iter_lines(endless(), max_line_size=10000))
+
+
+def test_lines_with_split_multibyte_characters():
+    data = "ä\nbü\n\nc".encode("utf-8")
+    assert list(iter_lines(split(data, 1))) == ["ä", "bü", "", "c"]
+
+
+def test_gzip_body_with_concatenated_members():
+    data = gzip.compress(b'[{"a": 1},') + gzip.compress(b'{"b": 2}]')
+    body = iter_body(io.BytesIO(data), gzipped=True, read_size=5)
+    assert list(iter_json_documents(body)) == [{"a": 1}, {"b": 2}]
+
+
+def test_corrupt_gzip_body():
+    with pytest.raises(zlib.error):
+        list(iter_body(io.BytesIO(b"not gzipped at all"), gzipped=True))
+
+
+def test_ndjson_output_round_trips_through_gzip():
+    records = [[{"a": 1}, {"b": 2}], [], [{"c": 3}]]
+    data = b"".join(iter_ndjson(records, gzipped=True))
+    assert [json.loads(line) for line in gzip.decompress(data).splitlines()] == [{"a": 1}, {"b": 2}, {"c": 3}]
+
+
+def test_chunks():
+    assert list(iter_chunks(range(5), 2)) == [[0, 1], [2, 3], [4]]
+    assert list(iter_chunks([], 2)) == []
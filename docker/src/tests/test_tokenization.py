@@ -0,0 +1,119 @@
+import re
+import zlib
+
+import numpy as np
+import pytest
+
+from tokenization import FastTokenizer, pre_truncate, validate_input_ids
+
+CLS, SEP = 1, 2
+
+
+class StubTokenizer:
+    """
+    Splits words into pieces of at most 3 characters, and splits off punctuation, like a subword tokenizer would
+    """
+    is_fast = True
+
+    @staticmethod
+    def tokenize(text):
+        return [piece for word in text.split() for piece in re.findall(r"\w{1,3}|[^\w\s]", word)]
+
+    def batch_encode_plus(self, texts, add_special_tokens=True):
+        assert not add_special_tokens
+        return {'input_ids': [[3 + zlib.crc32(piece.encode("utf-8")) % 997 for piece in self.tokenize(text)]
+                              for text in texts]}
+
+    @staticmethod
+    def num_special_tokens_to_add():
+        return 2
+
+    @staticmethod
+    def build_inputs_with_special_tokens(ids):
+        return [CLS] + list(ids) + [SEP]
+
+
+def full_encoding(text, max_seq_len):
+    """
+    What the model gets without pre-truncation: the whole text tokenized, then truncated
+    """
+    ids = StubTokenizer().batch_encode_plus([text], add_special_tokens=False)['input_ids'][0]
+    return [CLS] + ids[:max_seq_len - 2] + [SEP]
+
+
+TEXTS = [
+    "",
+    "short text",
+    "a, b, c! " * 40,
+    "extraordinarily long words of considerable length " * 20,
+    "x" * 500,
+    "https://example.com/path?q=1 " + "word " * 5,
+    "ok " * 3 + "tail",
+]
+
+
+@pytest.mark.parametrize("chars_per_token", [0, 0.5, 1, 2, 8])
+@pytest.mark.parametrize("max_seq_len", [8, 32, 128])
+def test_pre_truncation_does_not_change_the_input_ids(chars_per_token, max_seq_len):
+    tokenizer = FastTokenizer(StubTokenizer(), max_seq_len, cache_size=0, chars_per_token=chars_per_token)
+    for ids, text in zip(tokenizer.encode(TEXTS), TEXTS):
+        assert ids.dtype == np.int32
+        assert ids.tolist() == full_encoding(text, max_seq_len)
+
+
+def test_texts_cut_too_short_are_tokenized_again():
+    # far fewer characters than tokens needed, so every cut text is too short
+    tokenizer = FastTokenizer(StubTokenizer(), 64, cache_size=0, chars_per_token=0.5)
+    tokenizer.encode(["word " * 100])
+    assert tokenizer.retokenized == 1
+    tokenizer.encode(["short"])
+    assert tokenizer.retokenized == 1
+
+
+def test_pre_truncate_cuts_at_whitespace():
+    assert pre_truncate("one two three", 100) == "one two three"
+    assert pre_truncate("one two three", None) == "one two three"
+    assert pre_truncate("one two three", 9) == "one two"
+    assert pre_truncate("one two three", 7) == "one two"
+    # a single huge word is not cut
+    assert pre_truncate("x" * 50, 10) == "x" * 50
+
+
+def test_cache():
+    tokenizer = FastTokenizer(StubTokenizer(), 32, cache_size=2)
+    first = tokenizer.encode(["a b", "c d"])
+    assert tokenizer.encode(["c d", "a b"])[0] is first[1]
+    assert tokenizer.stats()["hits"] == 2
+    tokenizer.encode(["e f"])
+    assert tokenizer.stats()["entries"] == 2
+    # 'a b' was used last, so 'c d' was evicted
+    tokenizer.encode(["a b"])
+    assert tokenizer.stats()["misses"] == 3
+    tokenizer.encode(["c d"])
+    assert tokenizer.stats()["misses"] == 4
+
+
+@pytest.mark.parametrize("input_ids", [
+    [[1, 5, 2], [1, 2]],
+    [[0] * 16],
+    [],
+])
+def test_valid_input_ids(input_ids):
+    validate_input_ids(input_ids, max_seq_len=16, vocab_size=100)
+
+
+@pytest.mark.parametrize("input_ids", [
+    {"ids": [1, 2]},
+    [1, 2, 3],
+    [[]],
+    [[1] * 17],
+    [[1, 100]],
+    [[1, -1]],
+    [[1, 2.0]],
+    [[1, "2"]],
+    [[True, False]],
+    [[1, None]],
+])
+def test_invalid_input_ids(input_ids):
+    with pytest.raises(ValueError):
+        validate_input_ids(input_ids, max_seq_len=16, vocab_size=100)